@@ -1,2 +1,11 @@
 __version__ = '0.1.0'
-from .core import *
+
+from .constants import AUTO_ENC, JSON_ENC, PKL_ENC, IJ_ENC
+
+def __getattr__(name):
+    # core (and with it numpy and OpenCV) is only imported once something from it is used.
+    if name == "convert":
+        from . import core
+        globals()[name] = core.convert
+        return core.convert
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -3,9 +3,6 @@ import pathlib
 import sys
 import os
 
-from annotation.utils import confirm_overwrite
-
-from . import core
 from .constants import IJ_ENC, JSON_ENC, PKL_ENC, AUTO_ENC
 
 def main():
@@ -23,6 +20,9 @@ def main():
         "-e", "--dest-encoding",
         choices=[IJ_ENC, JSON_ENC, PKL_ENC], required=True,
         help="destination encoding")
+    convert.add_argument(
+        "--compress", action="store_true",
+        help="compress rois in the output zip (ij only); smaller, but slower to write")
 
     args = root.parse_args()
     cmd = args.command
@@ -32,15 +32,20 @@ def main():
         sys.exit(1)
 
 def handle_convert(args):
+    # Imported here so that parsing arguments (and --help) doesn't load numpy and OpenCV.
+    from . import core
+    from .utils import confirm_overwrite
+
     src = args.src
     src_encoding = args.src_encoding
     dest = args.dest
     dest_encoding = args.dest_encoding
-    roi_path: pathlib.Path = dest / "rois.zip"
-    if roi_path.is_file():
-        if not confirm_overwrite(roi_path):
-            sys.exit(0)
-        else:
-            os.remove(roi_path)
-    for s in src:
-        core.convert(s, roi_path, src_encoding, dest_encoding)
+    if dest_encoding == IJ_ENC:
+        # ij rois are collected in a single zip; json and pkl files are written into dest itself.
+        dest = dest / "rois.zip"
+        if dest.is_file():
+            if not confirm_overwrite(dest):
+                sys.exit(0)
+            else:
+                os.remove(dest)
+    core.convert(src, dest, src_encoding, dest_encoding, compress=args.compress)
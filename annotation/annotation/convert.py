@@ -1,39 +1,156 @@
 from collections import defaultdict
-from typing import Tuple
-from zipfile import ZipFile
+from typing import Iterable, Iterator, Tuple
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
 
 import sys
 import json
+import math
+import pickle
+import re
 import struct
 import shutil
 import pathlib
+import itertools
 import tempfile
+import warnings
 
-from .ij_coding import encode as encode_ij
-from .types import Roi_ts, Roi
+import numpy as np
+
+from .constants import IJ_ENC, JSON_ENC, PKL_ENC
+from .ij_coding import decode as decode_ij, encode as encode_ij
+from .types import Point, Roi_ts, Roi
 from . import utils
 
+# Entries of roi zips written by write_ij: the roi at timepoint T of series id
+IJ_ENTRY = re.compile(r"T(\d+)_(.+)\.roi")
+
 def read_json(src: pathlib.Path) -> Roi_ts:
     well, id = utils.extract_well_and_id(src)
     with open(src) as f:
         rois = json.load(f)
     return Roi_ts(f"{well}_{id}", list(utils.make_rois(rois["data"])))
 
-def read_pkl(src: pathlib.Path):
-    pass
+def read_pkl(src: pathlib.Path) -> Iterator[Roi_ts]:
+    """Series of rois of every neuron in a <well>.p file of the survival tracker's rois output."""
+    well = src.name.split(".")[0]
+    with open(src, "rb") as f:
+        neurons = pickle.load(f)
+    for id, data in neurons.items():
+        rois = [Roi(Point(*np.asarray(centroid).tolist()), np.asarray(contour).reshape(-1, 2))
+                for centroid, contour in zip(data["centroids"], data["contours"])]
+        yield Roi_ts(f"{well}_{id}", rois)
+
+def _ij_entries(src: pathlib.Path) -> Iterator[Tuple[str, bytes]]:
+    """(name, contents) of every roi in an ImageJ roi zip or .roi file, read from the zip one entry at a time."""
+    if src.suffix == ".roi":
+        yield src.name, src.read_bytes()
+        return
+    with ZipFile(src) as archive:
+        for info in archive.infolist():
+            if info.filename.endswith(".roi"):
+                yield info.filename, archive.read(info)
+
+def read_ij(src: pathlib.Path) -> Iterator[Roi_ts]:
+    """
+    Series of rois in an ImageJ roi zip or .roi file, decoded lazily. Consecutive entries named T<t>_<id>.roi, as
+    write_ij names them, make up one series ordered by t; any other roi is a series of its own, named after its entry.
+    Entries which can't be decoded (e.g. composite rois) are skipped with a warning.
+    """
+    def entries():
+        for fname, roi_bytes in _ij_entries(src):
+            try:
+                _, roi = decode_ij(roi_bytes)
+            except ValueError as e:
+                warnings.warn(f"skipping {fname} of {src}: {e}")
+                continue
+            fname = fname.rpartition("/")[2]
+            if match := IJ_ENTRY.fullmatch(fname):
+                yield match[2], int(match[1]), roi
+            else:
+                yield fname[:-len(".roi")], 0, roi
+    for id, group in itertools.groupby(entries(), lambda entry: entry[0]):
+        yield Roi_ts(id, [roi for _, _, roi in sorted(group, key=lambda entry: entry[1])])
+
+def read(srcs: Iterable[pathlib.Path], encoding: str) -> Iterator[Roi_ts]:
+    """Series of rois in every source, all of the given encoding, read one source at a time."""
+    for src in srcs:
+        print(f"converting {src}")
+        if encoding == JSON_ENC:
+            yield read_json(src)
+        elif encoding == PKL_ENC:
+            yield from read_pkl(src)
+        elif encoding == IJ_ENC:
+            yield from read_ij(src)
+        else:
+            raise Exception(f"Unsupported source encoding {encoding}")
+
+def write_ij(roi_series: Iterable[Roi_ts], dest: pathlib.Path, compress=False) -> int:
+    """
+    Write every roi of every series into the ImageJ roi zip at dest, appending to it if it exists, and return the
+    number of rois written. The archive is opened once for the whole conversion; rois are stored uncompressed unless
+    compress is set, which makes a smaller archive but takes longer to write.
+    """
+    count = 0
+    with ZipFile(dest, mode="a", compression=ZIP_DEFLATED if compress else ZIP_STORED) as archive:
+        for roi_ts in roi_series:
+            for idx, roi in enumerate(roi_ts.rois):
+                archive.writestr(f"T{idx+1}_{roi_ts.id}.roi", encode_ij(roi, roi_ts.id))
+            count += len(roi_ts.rois)
+    return count
+
+def _split_id(id: str) -> Tuple[str, int]:
+    well, _, ix = id.rpartition("_")
+    if not well or not ix.isdigit():
+        raise ValueError(f"series {id} is not named <well>_<id>")
+    return well, int(ix)
+
+def _radius(contour: np.ndarray) -> float:
+    """Radius of the circle of the same area as the polygon contour."""
+    xs, ys = np.asarray(contour, dtype=np.float64).T
+    area = abs(np.dot(xs, np.roll(ys, -1)) - np.dot(ys, np.roll(xs, -1))) / 2
+    return math.sqrt(area / math.pi)
+
+def write_json(roi_series: Iterable[Roi_ts], dest: pathlib.Path) -> int:
+    """
+    Write each series as a masa json file, <well>-<id>.json in the directory dest, and return the number of files
+    written. masa rois are circles: each roi becomes the circle about its centroid of the same area.
+    """
+    dest.mkdir(parents=True, exist_ok=True)
+    count = 0
+    for roi_ts in roi_series:
+        well, id = _split_id(roi_ts.id)
+        data = [{'x': int(roi.centroid.x), 'y': int(roi.centroid.y), 'r': _radius(roi.contour)} for roi in roi_ts.rois]
+        with open(dest / f"{well}-{id}.json", "w") as f:
+            json.dump({'status': 'alive', 'data': data, 'id': id, 'lastIxAlive': len(data) - 1}, f)
+        count += 1
+    return count
 
-def read_ij(src: pathlib.Path):
-    pass
+def write_pkl(roi_series: Iterable[Roi_ts], dest: pathlib.Path) -> int:
+    """
+    Write the series as the survival tracker does, one <well>.p file per well in the directory dest mapping each
+    neuron id to its contours and centroids, and return the number of files written. Measurements made by the
+    tracker (areas, intensities) aren't part of the other encodings, so they are left out.
+    """
+    wells = defaultdict(dict)
+    for roi_ts in roi_series:
+        well, id = _split_id(roi_ts.id)
+        wells[well][id] = {'contours': [np.asarray(roi.contour).reshape(-1, 1, 2) for roi in roi_ts.rois],
+                           'centroids': [np.array([roi.centroid.x, roi.centroid.y]) for roi in roi_ts.rois]}
+    dest.mkdir(parents=True, exist_ok=True)
+    for well, neurons in wells.items():
+        with open(dest / f"{well}.p", "wb") as f:
+            pickle.dump(neurons, f)
+    return len(wells)
 
-def write_ij(roi_ts: Roi_ts, dest: pathlib.Path):
-    archive = ZipFile(dest, mode="a")
-    for idx, roi in enumerate(roi_ts.rois):
-        encoded = encode_ij(roi, roi_ts.id)
-        out_path = f"T{idx+1}_{roi_ts.id}.roi"
-        with archive.open(out_path, "w") as f:
-            f.write(encoded)
+def write(roi_series: Iterable[Roi_ts], dest: pathlib.Path, encoding: str, compress=False) -> int:
+    """Write the series in the given encoding: into the roi zip dest for ij, or into the directory dest otherwise."""
+    if encoding == IJ_ENC:
+        return write_ij(roi_series, dest, compress)
+    elif encoding == JSON_ENC:
+        return write_json(roi_series, dest)
+    elif encoding == PKL_ENC:
+        return write_pkl(roi_series, dest)
+    raise Exception(f"Unsupported destination encoding {encoding}")
 
-def json_to_ij(src: pathlib.Path, dest: pathlib.Path):
-    print(f"converting {src}")
-    rois = read_json(src)
-    write_ij(rois, dest)
+def json_to_ij(srcs: Iterable[pathlib.Path], dest: pathlib.Path, compress=False):
+    write_ij(read(srcs, JSON_ENC), dest, compress)
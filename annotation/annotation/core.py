@@ -1,18 +1,30 @@
 import pathlib
 
+from typing import Iterable, Union
+
 from .constants import AUTO_ENC, JSON_ENC, PKL_ENC, IJ_ENC
 
 from . import convert as vert
 from . import utils
 
-def convert(src: pathlib.Path, dest: pathlib.Path, src_encoding: str, dest_encoding: str):
+def convert(src: Union[pathlib.Path, Iterable[pathlib.Path]], dest: pathlib.Path, src_encoding: str, dest_encoding: str, compress=False):
+    """
+    Convert one annotation file, or several of the same encoding, into a single destination: a roi zip for ij, or a
+    directory of json or pkl files. Sources are read and converted one series at a time.
+    """
+    srcs = [src] if isinstance(src, pathlib.Path) else list(src)
     if src_encoding == AUTO_ENC:
-        if (encoding := utils.determine_file_encoding(src.name)) != None:
-            src_encoding = encoding
-        else:
-            raise Exception(f"Unknown encoding for file {src.name}")
+        encodings = set()
+        for s in srcs:
+            if (encoding := utils.determine_file_encoding(s.name)) != None:
+                encodings.add(encoding)
+            else:
+                raise Exception(f"Unknown encoding for file {s.name}")
+        if len(encodings) > 1:
+            raise Exception(f"Sources have different encodings: {', '.join(sorted(encodings))}")
+        src_encoding, = encodings
 
-    if [src_encoding, dest_encoding] == [JSON_ENC, IJ_ENC]:
-        vert.json_to_ij(src, dest)
-    else:
+    supported = [IJ_ENC, JSON_ENC, PKL_ENC]
+    if src_encoding not in supported or dest_encoding not in supported:
         raise Exception(f"Unsupported conversion between {src_encoding} and {dest_encoding}")
+    vert.write(vert.read(srcs, src_encoding), dest, dest_encoding, compress)
@@ -1,59 +1,114 @@
 import struct
-import zipfile
-import json
-import os
-
-from .types import Roi
-
-def encode(roi: Roi, id: str) -> bytes:
-    #+TAG:DIRTY
-    #Acquire bounding rectangle corner values necessary for roi encoding
-    #x, y, w, h = boundingRect(contour)
-    #top, left, bottom, right = y, x, y + h, x + w
-    top, left, bottom, right = 0, 0, 0, 0 # y + h, x + w
-    #Acquire coordinates
-    xs, ys = roi.contour[:, 0], roi.contour[:, 1]
-    #Begin encoding
-    num_coords = len(xs) #Length of either x or y yields total number of coordinates
-    roi_bytes = struct.pack('>4ch2B5h', b'I', b'o', b'u', b't', 225, 7, 0, top, left, bottom, right, num_coords)
-    #Extracted this value by decoding current rois, not too clear on its use for extracting color
-    #stroke_color = 4294901760L -- Python3 generated error due to 'L' suffix
-    stroke_color = 4294901760
-    #header2 is an extra set of parameters that can be specified and are placed after coordinates
-    header2_offset = 64 + num_coords * 2 #Multiply by two since each short is currently two bytes
-    roi_bytes += struct.pack('>4fh3I2h2Bh2I', 0.0, 0.0, 0.0, 0.0, 0, 0, stroke_color, 0, 0, 0, 0, 0, 0, 0, header2_offset)
-    for x in xs:
-        roi_bytes += struct.pack('>h', x)
-    for y in ys:
-        roi_bytes += struct.pack('>h', y)
-    #Add header2, primarily to add roi name
-    name = id
-    name_length = len(name)
-    name_offset = (6 * 4) + (2) + (2 * 1) + (4) + (4) + (2 * 4) #Sum of bytes in header2
-    roi_bytes += struct.pack('>6Ih2BIf2I', 0, 0, 0, 0, name_offset, name_length, 0, 0, 0, 0, 0.0, 0, 0)
-    for c in name:
-        roi_bytes += struct.pack('>h', ord(c))
+
+from typing import Optional, Tuple
+
+import numpy as np
+
+from .types import Point, Roi
+
+# Layout of ImageJ's .roi files (see ij.io.RoiEncoder): a 64 byte header, the x then y coordinates as big-endian
+# shorts relative to the bounding box (followed, for subpixel rois, by absolute x then y coordinates as floats), a
+# 64 byte second header, and the roi's name as UTF-16 characters.
+HEADER_SIZE = 64
+HEADER2_SIZE = 64
+HEADER2_NAME_OFFSET = 16
+VERSION = 225
+#Extracted this value by decoding current rois, not too clear on its use for extracting color
+STROKE_COLOR = 4294901760
+
+# Roi types
+POLYGON, RECT, OVAL, LINE, FREELINE, POLYLINE, NOROI, FREEHAND, TRACED, ANGLE, POINT = range(11)
+# Types stored as a list of vertices
+VERTEX_TYPES = {POLYGON, FREELINE, POLYLINE, FREEHAND, TRACED, POINT}
+# Option flags
+SUB_PIXEL_RESOLUTION = 128
+
+# magic, version, type, unused, top, left, bottom, right, n coordinates, x1, y1, x2, y2, stroke width, shape roi
+# size, stroke color, fill color, subtype, options, arrow style, arrow head size, arc size, position, header2 offset
+_HEADER = struct.Struct('>4sh2B4hH4fh3I2h2BhIi')
+# name offset, name length
+_HEADER2_NAME = struct.Struct('>2I')
+
+def encode(roi: Roi, id: str) -> bytearray:
+    """
+    roi as an ImageJ freehand roi named id, packed into a single preallocated buffer: the coordinates are written
+    through a big-endian view of it, rather than a short at a time. Contours of floats are written with subpixel
+    resolution.
+    """
+    contour = np.asarray(roi.contour)
+    subpixel = contour.dtype.kind == 'f'
+    if subpixel:
+        (left, top) = np.floor(contour.min(axis=0)).astype(int).tolist()
+        (right, bottom) = np.ceil(contour.max(axis=0)).astype(int).tolist()
+    else:
+        (left, top), (right, bottom) = contour.min(axis=0).tolist(), contour.max(axis=0).tolist()
+    if max(right - left, bottom - top) > 32767:
+        raise ValueError(f"roi {id} is too large to encode: {right - left}x{bottom - top}")
+    num_coords = len(contour)
+    name = id.encode('utf-16-be')
+
+    header2_offset = HEADER_SIZE + num_coords * (12 if subpixel else 4)
+    name_offset = header2_offset + HEADER2_SIZE
+    roi_bytes = bytearray(name_offset + len(name))
+    _HEADER.pack_into(roi_bytes, 0, b'Iout', VERSION, FREEHAND, 0, top, left, bottom, right, num_coords,
+                      0.0, 0.0, 0.0, 0.0, 0, 0, STROKE_COLOR, 0, 0, SUB_PIXEL_RESOLUTION if subpixel else 0,
+                      0, 0, 0, 0, header2_offset)
+    coords = np.frombuffer(roi_bytes, dtype='>i2', count=2 * num_coords, offset=HEADER_SIZE).reshape(2, num_coords)
+    np.subtract(contour.T, [[left], [top]], out=coords, casting='unsafe')
+    if subpixel:
+        coords = np.frombuffer(roi_bytes, dtype='>f4', count=2 * num_coords, offset=HEADER_SIZE + num_coords * 4)
+        coords.reshape(2, num_coords)[:] = contour.T
+    # The name offset is from the start of the file, as ImageJ reads it.
+    _HEADER2_NAME.pack_into(roi_bytes, header2_offset + HEADER2_NAME_OFFSET, name_offset, len(name) // 2)
+    roi_bytes[name_offset:] = name
     return roi_bytes
 
-def decode(roi_zip_path, outpath=''):
-    #+TAG: DIRTY
-    with zipfile.ZipFile(roi_zip_path) as roi_zip:
-        fnames = roi_zip.namelist()
-        for ix, fname in enumerate(fnames):
-            data = roi_zip.read(fname)
-            version = struct.unpack('>B', data[5:6])
-            roi_type = int(struct.unpack('>B', data[6:7])[0])
-            top = struct.unpack('>h', data[8:10])[0]
-            left = struct.unpack('>h', data[10:12])[0]
-            bottom = struct.unpack('>h', data[12:14])[0]
-            right = struct.unpack('>h', data[14:16])[0]
-
-            # Ensure output directory exists.
-            os.makedirs(outpath, exist_ok=True)
-
-            # This is an oval type. Will be taken to be a circle.
-            if roi_type in {2, 8}:
-                x, y = left, top
-                r = (right - left) / 2
-                data = {'status':'alive', 'data':[{'x':int(x+r),'y':int(y+r), 'r':r}], 'id':ix, 'lastIxAlive':0}
-                json.dump(data, open(f'{outpath}/{outpath}-{ix}.json', 'w'))
+def _ellipse(x, y, width, height) -> np.ndarray:
+    """Vertices along the outline of the ellipse inscribed in a rectangle, about one per pixel of its perimeter."""
+    n = max(8, int(np.ceil(np.pi * (width + height) / 2)))
+    t = np.linspace(0, 2 * np.pi, n, endpoint=False)
+    return np.stack([x + width / 2 * (1 + np.cos(t)), y + height / 2 * (1 + np.sin(t))], axis=1)
+
+def decode(roi_bytes: bytes) -> Tuple[Optional[str], Roi]:
+    """
+    The name (None if it has none) and roi of a .roi file. Polygon, freehand, traced, polyline and point rois keep
+    their vertices, rectangles become their four corners and ovals a polygon along their outline. Contours are int32,
+    or float32 for subpixel rois. Coordinates are read through big-endian views of roi_bytes, not a value at a time.
+    """
+    if len(roi_bytes) < HEADER_SIZE or roi_bytes[:4] != b'Iout':
+        raise ValueError("not an ImageJ roi")
+    (_, version, roi_type, _, top, left, bottom, right, num_coords, x1, y1, x2, y2, _, shape_roi_size, _, _, _,
+     options, _, _, _, _, header2_offset) = _HEADER.unpack_from(roi_bytes)
+    subpixel = bool(options & SUB_PIXEL_RESOLUTION) and version >= 222
+    if shape_roi_size > 0:
+        raise ValueError("composite (shape) rois are not supported")
+
+    if roi_type in VERTEX_TYPES:
+        if num_coords == 0:
+            # Rois of more than 65535 vertices keep their count where x1 would be.
+            num_coords, = struct.unpack_from('>i', roi_bytes, 18)
+        if subpixel:
+            coords = np.frombuffer(roi_bytes, dtype='>f4', count=2 * num_coords, offset=HEADER_SIZE + num_coords * 4)
+            contour = coords.reshape(2, num_coords).T.astype(np.float32)
+        else:
+            coords = np.frombuffer(roi_bytes, dtype='>i2', count=2 * num_coords, offset=HEADER_SIZE)
+            contour = coords.reshape(2, num_coords).T + np.array([left, top], dtype=np.int32)
+    elif roi_type in (RECT, OVAL):
+        # Subpixel rectangles and ovals keep x, y, width and height as floats in place of x1, y1, x2, y2.
+        x, y, width, height = (x1, y1, x2, y2) if subpixel else (left, top, right - left, bottom - top)
+        if roi_type == RECT:
+            contour = np.array([[x, y], [x + width, y], [x + width, y + height], [x, y + height]])
+        else:
+            contour = _ellipse(x, y, width, height)
+        contour = contour.astype(np.float32) if subpixel else np.rint(contour).astype(np.int32)
+    else:
+        raise ValueError(f"unsupported roi type {roi_type}")
+
+    name = None
+    if 0 < header2_offset and header2_offset + HEADER2_NAME_OFFSET + _HEADER2_NAME.size <= len(roi_bytes):
+        name_offset, name_length = _HEADER2_NAME.unpack_from(roi_bytes, header2_offset + HEADER2_NAME_OFFSET)
+        if name_offset > 0 and name_length > 0 and name_offset + 2 * name_length <= len(roi_bytes):
+            name = bytes(roi_bytes[name_offset:name_offset + 2 * name_length]).decode('utf-16-be')
+
+    centroid = Point(*(round(total / max(len(contour), 1)) for total in contour.sum(axis=0).tolist()))
+    return name, Roi(centroid, contour)
@@ -5,7 +5,6 @@ import pathlib
 import math
 
 from typing import Union
-from cv2 import cv2
 from . import constants
 from .types import Point, Roi
 
@@ -15,7 +14,7 @@ def determine_file_encoding(filename: str) -> Union[str, None]:
         return constants.PKL_ENC
     elif filename.endswith(".json"):
         return constants.JSON_ENC
-    elif filename.endswith(".roi"):
+    elif filename.endswith(".roi") or filename.endswith(".zip"):
         return constants.IJ_ENC
     else:
         return None
@@ -26,6 +25,8 @@ def extract_well_and_id(path: pathlib.Path) -> Tuple[str, int]:
 
 def make_rois(data):
     #+TAG:DIRTY
+    # OpenCV takes longer to import than everything else here; only drawing rois needs it.
+    import cv2
     for d in data:
         # Extract radius and center coordinates.
         r, x, y = d['r'], int(d['x']), int(d['y'])
@@ -2,3 +2,97 @@ from annotation import __version__
 
 def test_version():
     assert __version__ == '0.1.0'
+
+def test_encode_ij_writes_bounding_box_relative_coordinates_and_name(tmp_path):
+    import struct
+    import zipfile
+
+    import numpy as np
+
+    from annotation.convert import write_ij
+    from annotation.ij_coding import encode
+    from annotation.types import Point, Roi, Roi_ts
+
+    contour = np.array([[10, 20], [14, 21], [12, 25]], dtype=np.int32)
+    data = encode(Roi(Point(12, 22), contour), 'A01_3')
+    top, left, bottom, right, n = struct.unpack('>5h', data[8:18])
+    assert data[:4] == b'Iout' and data[6] == 7 and (top, left, bottom, right, n) == (20, 10, 25, 14, 3)
+    coords = np.frombuffer(data, '>i2', 6, 64).reshape(2, 3)
+    assert (coords.T + [left, top] == contour).all()
+    header2, = struct.unpack('>i', data[60:64])
+    name_offset, name_length = struct.unpack('>2I', data[header2 + 16:header2 + 24])
+    assert data[name_offset:name_offset + 2 * name_length].decode('utf-16-be') == 'A01_3'
+
+    series = [Roi_ts(f'A01_{i}', [Roi(Point(12, 22), contour + t) for t in range(3)]) for i in range(2)]
+    assert write_ij(iter(series), tmp_path / 'rois.zip') == 6
+    with zipfile.ZipFile(tmp_path / 'rois.zip') as archive:
+        assert sorted(archive.namelist()) == sorted(f'T{t + 1}_A01_{i}.roi' for i in range(2) for t in range(3))
+        assert archive.read('T1_A01_0.roi') == encode(series[0].rois[0], 'A01_0')
+
+def test_decode_ij_and_convert_between_encodings(tmp_path):
+    import json
+    import struct
+
+    import numpy as np
+
+    from annotation import core
+    from annotation.constants import AUTO_ENC, IJ_ENC, JSON_ENC, PKL_ENC
+    from annotation.convert import read_ij, read_pkl, write_pkl
+    from annotation.ij_coding import HEADER_SIZE, OVAL, RECT, decode, encode
+    from annotation.types import Point, Roi, Roi_ts
+
+    contour = np.array([[10, 20], [14, 21], [12, 25]], dtype=np.int32)
+    name, roi = decode(bytes(encode(Roi(Point(12, 22), contour), 'A01_3')))
+    assert name == 'A01_3' and roi.contour.dtype == np.int32 and (roi.contour == contour).all()
+    subpixel = contour + np.float32(0.25)
+    _, roi = decode(encode(Roi(Point(12, 22), subpixel), 'A01_3'))
+    assert roi.contour.dtype == np.float32 and (roi.contour == subpixel).all()
+
+    def shape(roi_type, top, left, bottom, right):
+        return struct.pack('>4sh2B4hH', b'Iout', 228, roi_type, 0, top, left, bottom, right, 0).ljust(HEADER_SIZE, b'\0')
+    _, rect = decode(shape(RECT, 5, 10, 15, 30))
+    assert rect.contour.tolist() == [[10, 5], [30, 5], [30, 15], [10, 15]] and rect.centroid == Point(20, 10)
+    _, oval = decode(shape(OVAL, 0, 0, 20, 20))
+    assert np.allclose(np.hypot(*(oval.contour - 10).T), 10, atol=0.75)
+
+    series = [Roi_ts(f'B02_{i}', [Roi(Point(12, 22), contour + t) for t in range(3)]) for i in range(2)]
+    write_pkl(series, tmp_path / 'pkl')
+    core.convert(tmp_path / 'pkl' / 'B02.p', tmp_path / 'rois.zip', AUTO_ENC, IJ_ENC)
+    core.convert(tmp_path / 'rois.zip', tmp_path / 'from_ij', AUTO_ENC, PKL_ENC)
+    for before, after in zip(series, read_ij(tmp_path / 'rois.zip')):
+        assert before.id == after.id and all((a.contour == b.contour).all() for a, b in zip(before.rois, after.rois))
+    assert [roi_ts.id for roi_ts in read_pkl(tmp_path / 'from_ij' / 'B02.p')] == ['B02_0', 'B02_1']
+
+    core.convert(tmp_path / 'rois.zip', tmp_path / 'json', IJ_ENC, JSON_ENC)
+    with open(tmp_path / 'json' / 'B02-1.json') as f:
+        masa = json.load(f)
+    assert masa['id'] == 1 and len(masa['data']) == 3 and masa['data'][0]['x'] == 12
+
+def test_read_ij_skips_rois_it_cannot_decode(tmp_path):
+    import struct
+    from zipfile import ZipFile
+
+    import numpy as np
+    import pytest
+
+    from annotation.convert import read_ij
+    from annotation.ij_coding import HEADER_SIZE, LINE, RECT, encode
+    from annotation.types import Point, Roi
+
+    def shape(roi_type, shape_roi_size=0):
+        header = struct.pack('>4sh2B4hH', b'Iout', 228, roi_type, 0, 0, 0, 10, 10, 0).ljust(HEADER_SIZE, b'\0')
+        return header[:36] + struct.pack('>I', shape_roi_size) + header[40:]
+
+    contour = np.array([[10, 20], [14, 21], [12, 25]], dtype=np.int32)
+    with ZipFile(tmp_path / 'rois.zip', 'w') as archive:
+        archive.writestr('T0_A01_1.roi', bytes(encode(Roi(Point(12, 22), contour), 'A01_1')))
+        archive.writestr('composite.roi', shape(RECT, shape_roi_size=4))
+        archive.writestr('T1_A01_1.roi', bytes(encode(Roi(Point(12, 22), contour + 1), 'A01_1')))
+        archive.writestr('line.roi', shape(LINE))
+
+    with pytest.warns(UserWarning) as record:
+        series = list(read_ij(tmp_path / 'rois.zip'))
+    assert [roi_ts.id for roi_ts in series] == ['A01_1']
+    assert [(roi.contour - contour).max() for roi in series[0].rois] == [0, 1]
+    messages = [str(warning.message) for warning in record]
+    assert len(messages) == 2 and 'composite.roi' in messages[0] and 'line.roi' in messages[1]
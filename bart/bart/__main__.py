@@ -1,9 +1,3 @@
-import globus_sdk
-from globus_sdk.authorizers import access_token
-from . import helpers
-from . import core
-
-import dotenv
 import argparse
 import sys
 import os
@@ -27,6 +21,10 @@ push_parser.add_argument("experiments", nargs="+", help="path to experiment", ty
 def main():
 
     args = root_parser.parse_args()
+    # The globus SDK is slow to import, so it (through helpers and core) is only loaded once a command is run.
+    from . import helpers
+    from . import core
+
     command = args.command
     secret_path = os.path.join(os.path.expanduser("~"), ".globusconf")
 
@@ -55,6 +53,7 @@ def main():
             print(f"Secrets file not found at {secret_path}; have you run the 'auth' command yet?")
             sys.exit(1)
 
+        import dotenv
         config = dotenv.dotenv_values(secret_path)
         client_id = config["CLIENT_ID"]
         refresh_token = config["TRANSFER_REFRESH_TOKEN"]
@@ -0,0 +1,55 @@
+'''
+Time mfile_to_config on synthetic 96- and 384-well plate mfiles, to check that config generation scales linearly
+with the number of wells, and loading configs back from the cache.
+
+    $ poetry run python benchmarks/bench_makeconfig.py
+'''
+import os
+import string
+import tempfile
+import time
+
+from common.utils.makeconfig import mfile_to_config
+
+EXPERIMENT_FIELDS = ['PlateID', 'email', 'Transfection date', 'Transfection time', 'Plate type', 'Objective',
+                     'microscope', 'binning', 'Montage XY', 'Tile overlap', 'Primary channel', 'Control group',
+                     'FP1 frames', 'FP2 frames', 'FP3 frames', 'FP4 frames', 'Make stacks']
+WELL_FIELDS = ['Well', 'DNA1', 'DNA2', 'Drug1', '[Drug1]', 'Drug2', '[Drug2]', 'Units', 'Cell type',
+               'FP1', 'FP2', 'FP3', 'FP4', 'Imaging hours post-transfection']
+
+def synthetic_mfile(path, n_rows, n_cols, n_timepoints=10, n_trailing=2000):
+    '''
+    Write an mfile for an n_rows x n_cols plate with every well imaged, followed by the long tail of zeroed time
+    rows that acquisition leaves behind.
+    '''
+    experiment = ['exp', 'lab@example.com', '1/1/2045', '12:00', f'{n_rows * n_cols}-well', '20x', 'flo', '1x1',
+                  '3', '10', 'RFP', 'ctrl', '1', '1', '0', '0', '0']
+    wells = [f'{string.ascii_uppercase[row]}{col + 1:02}' for row in range(n_rows) for col in range(n_cols)]
+    lines = [','.join(EXPERIMENT_FIELDS), ','.join(experiment), '', ','.join(WELL_FIELDS)]
+    for ix, well in enumerate(wells):
+        time = f'{ix + 1} {24 * ix} 1/{ix + 1}/2045' if ix < n_timepoints else ''
+        lines.append(','.join([well, f'dna{ix % 7}', 'NA' if ix % 3 else 'gfp', f'drug{ix % 4}', str(ix % 5 * 10),
+                               'NA', 'NA', 'uM', 'rat', 'RFP', 'GFP', '', '', time]))
+    lines += [',' * 13 + '0'] * n_trailing
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return wells
+
+def timed(func, repeats=5):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        func()
+    return (time.perf_counter() - start) / repeats
+
+def main():
+    print(f"{'wells':>6} {'parse ms':>9} {'cached ms':>10}")
+    for n_rows, n_cols in [(8, 12), (16, 24)]:
+        with tempfile.TemporaryDirectory() as indir:
+            synthetic_mfile(os.path.join(indir, 'Mfile.csv'), n_rows, n_cols)
+            parse = timed(lambda: mfile_to_config(indir, use_cache=False))
+            mfile_to_config(indir)
+            cached = timed(lambda: mfile_to_config(indir))
+            print(f"{n_rows * n_cols:>6} {parse * 1e3:>9.1f} {cached * 1e3:>10.2f}")
+
+if __name__ == "__main__":
+    main()
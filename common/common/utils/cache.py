@@ -0,0 +1,60 @@
+import contextlib
+import hashlib
+import os
+import pickle
+import sys
+
+# Where parsed experiment files are kept; shared by every tool, notebook and worker process of a user.
+CACHE_DIR = os.environ.get("LAB_TOOLS_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "lab_tools"))
+
+def atomic_pickle_dump(path, obj):
+    """
+    Pickle obj to path through a temporary file in the same directory, so that readers (and runs that are cut short)
+    only ever see the previous file or the complete new one.
+    """
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp)
+        raise
+
+def _source_digest(func) -> str:
+    """Digest of the source file defining func, so that changes to a parser invalidate what it parsed before."""
+    with open(sys.modules[func.__module__].__file__, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def parse_stamp(path, parse) -> tuple:
+    """What parse(path) depends on: the size and modification time of the file at path, and the parser's source."""
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns, _source_digest(parse))
+
+def cached_parse(kind: str, path, parse, cache_dir=None):
+    """
+    parse(path), kept on disk and reused for as long as the file at path (by its size and modification time) and
+    the parser's source are unchanged. kind names what parse produces, as one file may be parsed in several ways.
+    A cache that can't be read or written is simply bypassed.
+    """
+    path = os.path.abspath(path)
+    stamp = parse_stamp(path, parse)
+    cache_dir = cache_dir or CACHE_DIR
+    entry = os.path.join(cache_dir, hashlib.sha256(f"{kind}:{path}".encode()).hexdigest()[:32] + ".p")
+
+    try:
+        with open(entry, "rb") as f:
+            entry_stamp, value = pickle.load(f)
+        if entry_stamp == stamp:
+            return value
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError, AttributeError, ImportError):
+        pass
+
+    value = parse(path)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        atomic_pickle_dump(entry, (stamp, value))
+    except OSError:
+        pass
+    return value
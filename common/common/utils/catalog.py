@@ -0,0 +1,165 @@
+import itertools
+import os
+import pathlib
+import sqlite3
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional
+
+from common.types import ImgMeta
+from common.utils.experiments import extract_meta
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS dirs_by_parent ON dirs (parent);
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    dir TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    time_point INTEGER NOT NULL,
+    col INTEGER NOT NULL,
+    row INTEGER NOT NULL,
+    well TEXT NOT NULL,
+    montage_idx INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_by_well ON images (channel, well, time_point, montage_idx);
+CREATE INDEX IF NOT EXISTS images_by_dir ON images (dir);
+"""
+
+def _list(raw_imgs: str, rel: str, parent: str, known: dict[str, tuple[int, list[str]]]):
+    """
+    (dir, parent, mtime_ns, subdirs, files) of a directory relative to raw_imgs, or None if it no longer exists.
+    Directories whose mtime is the catalogued one aren't listed again, and their files are given as None.
+    """
+    try:
+        mtime = os.stat(os.path.join(raw_imgs, rel)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    cached = known.get(rel)
+    if cached is not None and cached[0] == mtime:
+        # Adding, removing or renaming an entry changes a directory's mtime, so its listing is unchanged.
+        return rel, parent, mtime, cached[1], None
+    subdirs, files = [], []
+    with os.scandir(os.path.join(raw_imgs, rel)) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                subdirs.append(entry.name)
+            elif entry.name.lower().endswith(".tif"):
+                files.append(entry.name)
+    return rel, parent, mtime, subdirs, files
+
+def _scan(raw_imgs: str, top: str, known: dict[str, tuple[int, list[str]]]):
+    """Every directory of the tree under top (relative to raw_imgs), as given by _list."""
+    found = []
+    pending = [(top, os.path.dirname(top))]
+    while pending:
+        listing = _list(raw_imgs, *pending.pop(), known)
+        if listing is None:
+            continue
+        found.append(listing)
+        rel, _, _, subdirs, _ = listing
+        pending += [(os.path.join(rel, subdir), rel) for subdir in subdirs]
+    return found
+
+class Catalog:
+    """
+    Index of an experiment's raw images, kept in an SQLite file so that they need not be globbed again.
+
+    refresh() walks raw_imgs once with os.scandir, each channel in its own thread, and only lists directories
+    whose mtime has changed since the last refresh. Files rewritten in place don't change their directory's
+    mtime, but the metadata catalogued from their paths stays the same.
+    """
+    def __init__(self, experiment_base, path=None):
+        self.experiment_base = pathlib.Path(experiment_base)
+        self.raw_imgs = self.experiment_base / "raw_imgs"
+        self.path = pathlib.Path(path) if path else self.experiment_base / "processed_imgs" / "catalog.sqlite"
+        os.makedirs(self.path.parent, exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _known_dirs(self) -> dict[str, tuple[int, list[str]]]:
+        known = {path: (mtime, []) for path, mtime in self.db.execute("SELECT path, mtime_ns FROM dirs")}
+        for path, parent in self.db.execute("SELECT path, parent FROM dirs"):
+            if parent in known and path != parent:
+                known[parent][1].append(os.path.basename(path))
+        return known
+
+    def _forget(self, rel):
+        """Drop a directory and everything under it."""
+        pattern = rel.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + os.sep + "%"
+        for table, column in (("dirs", "path"), ("images", "dir")):
+            self.db.execute(f"DELETE FROM {table} WHERE {column} = ? OR {column} LIKE ? ESCAPE '\\'", (rel, pattern))
+
+    def refresh(self, workers=None) -> int:
+        """Bring the catalog up to date with raw_imgs, returning the number of directories that were (re)listed."""
+        known = self._known_dirs()
+        raw_imgs = str(self.raw_imgs)
+        # raw_imgs itself is listed first; its subdirectories (the channels) are then walked in parallel.
+        root = _list(raw_imgs, "", "", known)
+        found = [root] if root else []
+        top_level = root[3] if root else []
+        with ThreadPoolExecutor(workers or max(1, len(top_level))) as pool:
+            for subtree in pool.map(lambda channel: _scan(raw_imgs, channel, known), top_level):
+                found += subtree
+
+        # Directories no longer reached have been removed, along with all they contained.
+        seen = {rel for rel, *_ in found}
+        changed = 0
+        with self.db:
+            for rel in set(known) - seen:
+                self._forget(rel)
+            for rel, parent, mtime, subdirs, files in found:
+                if files is None:
+                    continue
+                changed += 1
+                self.db.execute("DELETE FROM images WHERE dir = ?", (rel,))
+                self.db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)", (rel, parent, mtime))
+                self.db.executemany("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                    filter(None, (self._row(rel, name) for name in files)))
+        return changed
+
+    def _row(self, rel, name) -> Optional[tuple]:
+        path = os.path.join(rel, name)
+        try:
+            meta = extract_meta(self.raw_imgs / path)
+        except Exception:
+            return None
+        well = name.split(".")[0].split("_")[0]
+        return (path, rel, meta.channel, meta.time_point, meta.col, meta.row, well, meta.montage_idx)
+
+    def channels(self) -> list[str]:
+        return [channel for channel, in self.db.execute("SELECT DISTINCT channel FROM images ORDER BY channel")]
+
+    def wells(self, channel: str) -> list[str]:
+        return [well for well, in self.db.execute("SELECT DISTINCT well FROM images WHERE channel = ? ORDER BY well", (channel,))]
+
+    def _select(self, channel=None, well=None, time_point=None) -> Iterator[tuple[str, ImgMeta]]:
+        criteria = {"channel": channel, "well": well, "time_point": time_point}
+        where = [f"{column} = ?" for column, value in criteria.items() if value is not None]
+        sql = ("SELECT well, path, channel, time_point, col, row, montage_idx FROM images"
+               + (" WHERE " + " AND ".join(where) if where else "")
+               + " ORDER BY channel, well, time_point, montage_idx")
+        for well, path, *meta in self.db.execute(sql, [value for value in criteria.values() if value is not None]):
+            yield well, ImgMeta(self.raw_imgs / path, *meta)
+
+    def images(self, channel: str = None, well: str = None, time_point: int = None) -> list[ImgMeta]:
+        """Catalogued images matching every given criterion, ordered by channel, well, timepoint and montage index."""
+        return [meta for _, meta in self._select(channel, well, time_point)]
+
+    def montage_sets(self, channel: str, well: str = None) -> Iterator[tuple[str, int, list[ImgMeta]]]:
+        """Yield (well, time_point, tiles in montage order) for every montage of a channel, in well and time order."""
+        for (well, time_point), group in itertools.groupby(self._select(channel, well), lambda x: (x[0], x[1].time_point)):
+            yield well, time_point, [meta for _, meta in group]
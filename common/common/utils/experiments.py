@@ -7,6 +7,7 @@ import re
 from typing import Counter
 
 from common.types import Exposure, MFSpec, WellSpec, ImgMeta
+from common.utils.cache import cached_parse
 from common.utils.legacy import parse_datetime
 
 import charset_normalizer
@@ -20,20 +21,21 @@ def try_load_mfile(path: pathlib.Path) -> MFSpec:
         raise Exception(f'No csv of the form "{glob}" found in {path}')
     return read_mfile(csv)
 
+# Compiled once, as extract_meta is called for every image of an experiment.
+META_PATTERN = re.compile(r"""# Verbose regex
+    (?P<channel>(GFP)|(RFP)|(Cy5)|(white_light)|(DAPI))/ # Pick out the channel
+    T(?P<time>\d+)/                                      # Pick out the time
+    col_(?P<col>\d+)/                                    # pick out the row
+    (?P<row>[a-z])\d+_(?P<montage_idx>\d{2}).tif         # Pick out the row and montage index from the file name
+""", re.IGNORECASE | re.VERBOSE)
+
 def extract_meta(path: pathlib.Path) -> ImgMeta:
     """
     Extract image metadata from a standard experiment path
     e.g: experiment_root/raw_imgs/RFP/T1/col_01/A01_01.tif
     """
 
-    pattern = r"""# Verbose regex
-        (?P<channel>(GFP)|(RFP)|(Cy5)|(white_light)|(DAPI))/ # Pick out the channel
-        T(?P<time>\d+)/                                      # Pick out the time
-        col_(?P<col>\d+)/                                    # pick out the row
-        (?P<row>[a-z])\d+_(?P<montage_idx>\d{2}).tif         # Pick out the row and montage index from the file name
-    """
-
-    search = re.search(pattern, path.__str__(), re.IGNORECASE | re.VERBOSE)
+    search = META_PATTERN.search(path.__str__())
     if search is None:
         raise Exception("No match found for regex")
 
@@ -47,6 +49,13 @@ def extract_meta(path: pathlib.Path) -> ImgMeta:
     )
 
 def read_mfile(path: pathlib.Path) -> MFSpec:
+    """
+    Parse an mfile into an MFSpec. Parsed specs are cached on disk, so a file is only parsed (and its encoding
+    detected) once per version, however many tools and processes read it.
+    """
+    return cached_parse("spec", path, _parse_mfile)
+
+def _parse_mfile(path: pathlib.Path) -> MFSpec:
     # There doesn't seem to be a good way to automatically detect character encoding
     # using vanilla python... so we use this
     lines = str(charset_normalizer.from_path(path).best()).split("\n")
@@ -1,39 +1,44 @@
+import hashlib
 import os
 import io
 from glob import glob
 from os.path import join
 import sys
 
-import pandas as pd
 import yaml
 
+from .cache import cached_parse, parse_stamp
+
 import traceback
 
+# pandas is imported by the functions that parse an MFile, so that importing makeconfig doesn't wait on it.
+
 def homogenize_comma_quantity(mfile_path):
-    # Read-in Mfile.
+    # Read-in Mfile, counting the commas of every row once.
     with open(mfile_path) as mfile:
         mfile_rows = mfile.readlines()
+    comma_nums = [row.count(',') for row in mfile_rows]
 
     # Determine the maximum comma quantity within the file.
-    max_comma_num = max(row.count(',') for row in mfile_rows)
+    max_comma_num = max(comma_nums, default=0)
 
     # If any row has less commas than the maximum comma quantity, append the difference.
-    for ix, row in enumerate(mfile_rows):
-        if row.count(',') < max_comma_num:
-            num_to_add = max_comma_num - row.count(',')
-            mfile_rows[ix] = row.strip() + ',' * num_to_add + '\n'
-
-    return io.StringIO(''.join(mfile_rows))
+    return io.StringIO(''.join(row if comma_num == max_comma_num else row.strip() + ',' * (max_comma_num - comma_num) + '\n'
+                               for row, comma_num in zip(mfile_rows, comma_nums)))
 
-def parse_mfile(indir):
+def find_mfile(indir):
     '''Find MFile within directory.'''
     mfiles = glob(indir + '/M*.csv')
     if not mfiles:
         raise FileNotFoundError('\nNo MFile was found within ' + indir + '.')
+    # glob already gives the path within indir.
+    return mfiles[0]
 
-    mfile = mfiles[0]
-    path = join(indir, mfile)
+def parse_mfile(indir):
+    return _read_mfile(find_mfile(indir))
 
+def _read_mfile(path):
+    import pandas as pd
     stream = homogenize_comma_quantity(path)
 
     #acquire parameters
@@ -87,9 +92,33 @@ def _parse_fluor_to_frames(exp_df, fluor_dict):
         fluor_to_frames[fluor] = int(frames[label])
     return fluor_to_frames
 
-def mfile_to_config(indir, outdir=None):
+def mfile_to_config(indir, outdir=None, use_cache=True):
+    '''
+    Experiment config built from the MFile within indir, also written to config.yaml in outdir if given.
+    Configs are cached on disk (see cache.cached_parse). config.yaml starts with a comment identifying the MFile and
+    the version of _build_config it was built with, and is only rewritten once either of them changes.
+    '''
+    path = find_mfile(indir)
+    config = cached_parse('config', path, _build_config) if use_cache else _build_config(path)
+    if outdir != None:
+        yaml_path = join(outdir, 'config.yaml')
+        version = hashlib.sha256(repr(parse_stamp(path, _build_config)).encode()).hexdigest()[:16]
+        header = f"# built from {os.path.basename(path)}, version {version}\n"
+        try:
+            with open(yaml_path) as f:
+                current = f.readline() == header
+        except FileNotFoundError:
+            current = False
+        if not current:
+            with open(yaml_path, 'w') as f:
+                f.write(header)
+                yaml.dump(config, f, default_flow_style=False)
+    return config
+
+def _build_config(path):
+    import pandas as pd
     #acquire dataframes with experiment and image parameters
-    exp_df, img_df = parse_mfile(indir)
+    exp_df, img_df = _read_mfile(path)
     #acquire parameters
     montage_num = str(int(exp_df['montage xy'].loc[0]))
     #Expecting a value like: 20x or 4x -- an 'x' character always affixed to a number
@@ -144,57 +173,42 @@ def mfile_to_config(indir, outdir=None):
     #otherwise. Therefore will send the full DataFrame for parsing time data, but will limit it thereafter to ensure these
     #superfluous rows are not carried around.
     time_data, timepoint_num, hours = _parse_time(img_df)
-    img_df = img_df[:96]
+    # Only rows naming a well describe one; the time rows run on past the last well.
+    img_df = img_df[~img_df.well.isin(['NA', 0, '0'])]
     fluor_dict = _parse_fluors(img_df)
     fluor_to_frames = _parse_fluor_to_frames(exp_df, fluor_dict)
 
-    #Build mapping between wells and values describing actions done to wells
-    wells_dict = {}
+    #Build mapping between wells and values describing actions done to wells, a column at a time.
+    #A well listed more than once is described by its first row.
     #value_list = ['dna1', 'dna2', 'drug1', 'drug2', '[drug1]', '[drug2]']
     value_list = ['dna1', 'dna2', 'drug1', 'drug2']
-    group_labels = set()
+    well_df = img_df.drop_duplicates('well').set_index('well')
+    text = well_df[value_list + ['[drug1]', '[drug2]']].astype(str)
 
-    well_to_drug = {}
-    well_to_drug_conc = {}
-    well_to_drug_conc_units = {}
-    well_to_cell_type = {}
+    labels = pd.Series(['-'.join(value for value in values if value != 'NA') for values in zip(*(text[column] for column in value_list))],
+                       index=well_df.index)
+    wells_dict = pd.concat([well_df[value_list], labels.rename('label')], axis=1).to_dict('index')
 
-    make_stacks = False
-    for well in img_df.well:
-        values = list(img_df[img_df.well == well][value_list].iloc[0])
-        dna1, dna2, drug1, drug2 = list(map(str, values))
-        drug1_conc, drug2_conc = list(img_df[img_df.well == well][['[drug1]', '[drug2]']].iloc[0])
-        units = img_df[img_df.well == well]['units'].values[0]
-        cell_type = img_df[img_df.well == well]['cell type'].values[0]
-
-
-
-        label = '-'.join(map(str, filter(lambda s: s != 'NA', [dna1, dna2, drug1, drug2])))
+    def join_second(first, second):
+        return first.where(second == 'NA', first + '-' + second)
 
-        values_tuple = zip(value_list + ['label'], values + [label])
+    well_to_drug = join_second(text['drug1'], text['drug2']).to_dict()
+    well_to_drug_conc = join_second(text['[drug1]'], text['[drug2]']).to_dict()
+    well_to_drug_conc_units = well_df['units'].to_dict()
+    well_to_cell_type = well_df['cell type'].to_dict()
 
-        drug1_conc = str(drug1_conc)
-        drug2_conc = str(drug2_conc)
+    # Wells are grouped by label in a single pass; wells without any label belong to no group.
+    labelled = labels[labels != '']
+    group_labels_to_wells = {label: list(wells) for label, wells in labelled.groupby(labelled, sort=False).groups.items()}
+    group_labels = list(group_labels_to_wells)
 
-        well_to_drug[well] = drug1 + ('-' + drug2 if drug2 != 'NA' else '')
-        well_to_drug_conc[well] = drug1_conc + ('-' + drug2_conc if drug2_conc != 'NA' else '')
-        well_to_drug_conc_units[well] = units
-        well_to_cell_type[well] = cell_type
-
-        if label:
-            group_labels.add(label)
-        wells_dict[well] = dict(values_tuple)
+    make_stacks = False
+    if len(well_df):
         try:
             make_stacks = True if exp_df['make stacks'].loc[0] == 1 else False
         except:
             pass
 
-    group_labels_to_wells = {label : [] for label in group_labels}
-    for label in group_labels:
-        for well in wells_dict:
-            if wells_dict[well]['label'] == label:
-                group_labels_to_wells[label].append(well)
-
     # Currently done to raise an error if a wrong microscope name is chosen.
     from . import legacy
     um_to_px = legacy.microns_to_pixels(1, magnification, microscope, binning)
@@ -232,6 +246,4 @@ def mfile_to_config(indir, outdir=None):
                              }
                 }
              }
-    if outdir != None:
-        yaml.dump(config, open(join(outdir, 'config.yaml'), 'w'), default_flow_style=False)
     return config
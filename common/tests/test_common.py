@@ -0,0 +1,64 @@
+import os
+import shutil
+
+from common import __version__
+from common.utils import extract_meta
+from common.utils import cache, makeconfig
+from common.utils.cache import cached_parse
+from common.utils.catalog import Catalog
+
+
+def test_version():
+    assert __version__ == '0.1.0'
+
+
+def test_catalog_refreshes_incrementally(tmp_path):
+    for channel in ('RFP', 'GFP'):
+        for t in (1, 2):
+            os.makedirs(tmp_path / 'raw_imgs' / channel / f'T{t}' / 'col_01')
+            for ix in range(1, 5):
+                (tmp_path / 'raw_imgs' / channel / f'T{t}' / 'col_01' / f'A01_{ix:02}.tif').touch()
+
+    with Catalog(tmp_path) as catalog:
+        assert catalog.refresh() == 11 and catalog.refresh() == 0
+        expected = sorted(map(extract_meta, (tmp_path / 'raw_imgs').glob('RFP/**/A01*.tif')),
+                          key=lambda meta: (meta.time_point, meta.montage_idx))
+        assert catalog.images('RFP', 'A01') == expected
+        assert [(well, t, len(tiles)) for well, t, tiles in catalog.montage_sets('RFP')] == [('A01', 1, 4), ('A01', 2, 4)]
+
+        shutil.rmtree(tmp_path / 'raw_imgs' / 'GFP' / 'T2')
+        os.remove(tmp_path / 'raw_imgs' / 'RFP' / 'T1' / 'col_01' / 'A01_04.tif')
+        catalog.refresh()
+        assert len(catalog.images('GFP')) == 4 and len(catalog.images('RFP', time_point=1)) == 3
+
+
+def test_cached_parse_reparses_only_changed_files(tmp_path):
+    mfile = tmp_path / 'Mfile.csv'
+    mfile.write_text('PlateID,exp\n')
+    calls = []
+    def parse(path):
+        calls.append(path)
+        return open(path).read()
+
+    cache_dir = str(tmp_path / 'cache')
+    assert cached_parse('text', mfile, parse, cache_dir) == cached_parse('text', mfile, parse, cache_dir) == 'PlateID,exp\n'
+    assert len(calls) == 1
+    mfile.write_text('PlateID,other\n')
+    assert cached_parse('text', mfile, parse, cache_dir) == 'PlateID,other\n' and len(calls) == 2
+
+
+def test_config_yaml_is_rewritten_when_the_config_builder_changes(tmp_path, monkeypatch):
+    import yaml
+
+    monkeypatch.setattr(cache, 'CACHE_DIR', str(tmp_path / 'cache'))
+    (tmp_path / 'Mfile.csv').write_text('PlateID,exp\n')
+    read_yaml = lambda: yaml.safe_load(open(tmp_path / 'config.yaml'))
+
+    monkeypatch.setattr(makeconfig, '_build_config', lambda path: {'version': 1})
+    makeconfig.mfile_to_config(str(tmp_path), str(tmp_path))
+    assert read_yaml() == {'version': 1}
+
+    # The MFile is unchanged, but a new _build_config must not leave a stale config.yaml behind.
+    monkeypatch.setattr(makeconfig, '_build_config', lambda path: {'version': 2})
+    monkeypatch.setattr(cache, '_source_digest', lambda func: 'changed')
+    assert makeconfig.mfile_to_config(str(tmp_path), str(tmp_path)) == read_yaml() == {'version': 2}
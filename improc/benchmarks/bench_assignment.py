@@ -0,0 +1,42 @@
+'''
+Compare the greedy and global matchers of Tracker._assign_rois on synthetic dense wells.
+
+    $ poetry run python benchmarks/bench_assignment.py
+'''
+import time
+
+import numpy as np
+
+from improc.survival.assignment import MATCHERS
+
+def synthetic_well(n_neurons, size_px, jitter_px, drop_frac, extra_frac, seed=0):
+    '''Neuron centroids, and the candidates found for them one timepoint later (some lost, some spurious).'''
+    rng = np.random.default_rng(seed)
+    # Centroids are integer pixel coordinates, as in the tracker.
+    neurons = rng.integers(0, size_px, (n_neurons, 2))
+    found = rng.random(n_neurons) >= drop_frac
+    candidates = neurons[found] + rng.normal(0, jitter_px, (found.sum(), 2)).astype(int)
+    spurious = rng.integers(0, size_px, (int(extra_frac * n_neurons), 2))
+    truth = {ix: jx for jx, ix in enumerate(np.flatnonzero(found))}
+    return list(neurons), list(candidates) + list(spurious), truth
+
+def main():
+    max_dist = 62 # um_to_px(50) at 20x on flo
+    print(f"{'neurons':>8} {'matcher':>8} {'ms/frame':>9} {'matched':>8} {'correct':>8} {'shared':>7}")
+    for n_neurons in [100, 500, 2000, 8000]:
+        # Keep density high enough that neighbourhoods within max_dist routinely overlap.
+        size_px = int(np.sqrt(n_neurons) * 80)
+        neurons, candidates, truth = synthetic_well(n_neurons, size_px, jitter_px=12, drop_frac=0.1, extra_frac=0.2)
+        for name, match in MATCHERS.items():
+            repeats = 5
+            start = time.perf_counter()
+            for _ in range(repeats):
+                matches = match(neurons, candidates, len(candidates), max_dist)
+            elapsed = (time.perf_counter() - start) / repeats
+
+            correct = sum(truth.get(ix) == jx for ix, jx in matches.items())
+            shared = len(matches) - len(set(matches.values()))
+            print(f"{n_neurons:>8} {name:>8} {elapsed * 1e3:>9.2f} {len(matches):>8} {correct:>8} {shared:>7}")
+
+if __name__ == "__main__":
+    main()
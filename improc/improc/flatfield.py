@@ -1,15 +1,112 @@
+from concurrent.futures import ThreadPoolExecutor
 from typing import Iterable
 import numpy as np
+import os
 import pathlib
 import itertools
+import tempfile
+
+import tifffile
 
 from common import WellSpec
 
 from PIL import Image
 
-def background_from_paths(paths: list[pathlib.Path]) -> np.ndarray:
-    images = np.array([np.array(Image.open(path)) for path in paths])
-    return np.median(images, axis=0, overwrite_input=True).astype(images.dtype)
+BACKGROUND_METHODS = ('median', 'trimmed-mean', 'percentile')
+
+def _open_mapped(path, spill_dir, ix):
+    '''
+    The (first) image at path as a read-only memmap. Images that can't be mapped directly, i.e. compressed tifs and
+    other formats, are decoded once into a temporary file in spill_dir and mapped from there.
+    '''
+    try:
+        return tifffile.memmap(path, page=0, mode='r')
+    except (ValueError, tifffile.TiffFileError):
+        pass
+    try:
+        image = tifffile.imread(path, key=0)
+    except tifffile.TiffFileError:
+        image = np.array(Image.open(path))
+    spilled = np.lib.format.open_memmap(os.path.join(spill_dir, f'{ix}.npy'), mode='w+', dtype=image.dtype, shape=image.shape)
+    spilled[:] = image
+    spilled.flush()
+    return spilled
+
+def background_from_paths(paths: list[pathlib.Path], method='median', percentile=10.0, trim=0.1,
+                          memory_limit=2**28, workers=None) -> np.ndarray:
+    """
+    Per-pixel background of a set of images, computed a block of rows at a time so that memory use stays around
+    memory_limit bytes however many images there are.
+
+    Args:
+        method: 'median', 'trimmed-mean' (the mean without the lowest and highest `trim` fraction of values at each
+            pixel) or 'percentile' (the given percentile at each pixel, e.g. a low one for sparse foreground)
+        workers: number of threads reading rows from the images (by default one per CPU)
+    """
+    paths = list(paths)
+    if method not in BACKGROUND_METHODS:
+        raise ValueError(f"unsupported method {method}; expected one of {', '.join(BACKGROUND_METHODS)}")
+    if not paths:
+        raise ValueError("no images to compute a background from")
+
+    with tempfile.TemporaryDirectory() as spill_dir, ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+        images = list(pool.map(_open_mapped, paths, itertools.repeat(spill_dir), range(len(paths))))
+        shape, dtype = images[0].shape, images[0].dtype
+        if any(image.shape != shape for image in images):
+            raise ValueError("all images must have the same shape")
+
+        # Leave room for a float64 working copy of each block, as made by percentile and trim_mean.
+        rows_per_block = max(1, memory_limit // (len(images) * shape[1] * 8))
+        background = np.empty(shape, dtype=dtype)
+        block = np.empty((len(images), min(rows_per_block, shape[0]), shape[1]), dtype=dtype)
+        for y in range(0, shape[0], rows_per_block):
+            y1 = min(y + rows_per_block, shape[0])
+            rows = block[:, :y1 - y]
+            def read(ix):
+                rows[ix] = images[ix][y:y1]
+            list(pool.map(read, range(len(images))))
+
+            if method == 'median':
+                values = np.median(rows, axis=0, overwrite_input=True)
+            elif method == 'percentile':
+                values = np.percentile(rows, percentile, axis=0, overwrite_input=True)
+            else:
+                # scipy.stats takes longer to import than the rest of improc; only this method needs it.
+                import scipy.stats
+                values = scipy.stats.trim_mean(rows, trim, axis=0)
+            background[y:y1] = values.astype(dtype)
+        # Drop the maps before their spilled files are removed.
+        del images
+    return background
+
+def subtract_background(images, background: np.ndarray, flat: np.ndarray = None):
+    """
+    Subtract background from every image in place, saturating at zero, and return the images.
+
+    images may be a single image, a stack (whose frames are corrected one at a time) or a list of tiles, all of
+    background's unsigned integer dtype. Given a flat (gain) image, each frame is also corrected to
+    (img - background) / flat * mean(flat) in the same pass, rounded and clipped to the dtype's range.
+    Besides that one float frame reused for every image, nothing image-sized is allocated.
+    """
+    frames = [images] if isinstance(images, np.ndarray) and images.ndim == 2 else images
+    if flat is not None:
+        gain = np.zeros(flat.shape, dtype=np.float32)
+        np.divide(flat.mean(), flat, out=gain, where=flat > 0)
+        scratch = np.empty(flat.shape, dtype=np.float32)
+        max_value = np.iinfo(background.dtype).max
+
+    for img in frames:
+        if img.dtype != background.dtype:
+            raise ValueError(f"image dtype {img.dtype} does not match background dtype {background.dtype}")
+        # max(img, bg) - bg is img - bg where that is positive and zero elsewhere, without leaving the dtype.
+        np.maximum(img, background, out=img)
+        img -= background
+        if flat is not None:
+            np.multiply(img, gain, out=scratch)
+            np.rint(scratch, out=scratch)
+            np.clip(scratch, 0, max_value, out=scratch)
+            img[...] = scratch
+    return images
 
 def trunc_sub(a1: np.ndarray, a2: np.ndarray) -> np.ndarray:
     """
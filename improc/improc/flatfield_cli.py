@@ -1,24 +1,32 @@
 import argparse
 import pathlib
+import queue
 import sys
 import os
+import threading
+import time
 
-import matplotlib.pyplot as plt
-import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
-from PIL import Image
-
-from . import flatfield
+# numpy, PIL, matplotlib and flatfield are imported by the commands that use them, so that argument parsing (and
+# --help) doesn't wait on them.
 
 GENERATE_CMD = "generate"
 SUBTRACT_CMD = "subtract"
+# flatfield.BACKGROUND_METHODS, spelled out here so that building the parser needn't import flatfield.
+BACKGROUND_METHODS = ("median", "trimmed-mean", "percentile")
 
 def rlist_files(path, ftype):
     for root, _, files in os.walk(path):
         for _file in filter(lambda f: f.endswith(ftype), files):
             yield os.path.join(root, _file)
 
-def generate_background(inputs: list[pathlib.Path], output: pathlib.Path, display=False, force=False, recursive=False):
+def generate_background(inputs: list[pathlib.Path], output: pathlib.Path, display=False, force=False, recursive=False,
+                        method="median", percentile=10.0, trim=0.1):
+    import numpy as np
+    from PIL import Image
+    from . import flatfield
+
     paths = []
     for input_path in inputs:
         if os.path.isdir(input_path) and recursive:
@@ -40,9 +48,10 @@ def generate_background(inputs: list[pathlib.Path], output: pathlib.Path, displa
             else:
                 print("I'm afraid I can't do that, Dave.")
 
-    median = flatfield.background_from_paths(paths)
+    median = flatfield.background_from_paths(paths, method=method, percentile=percentile, trim=trim)
 
     if display:
+        import matplotlib.pyplot as plt
         plt.imshow(median)
         plt.show()
         return
@@ -50,7 +59,81 @@ def generate_background(inputs: list[pathlib.Path], output: pathlib.Path, displa
     Image.fromarray(median.astype(np.uint16)).save(output)
 
 
-def subtract(background_path, input_path, output_base, ftype, display=False, force=False):
+def _mirror_path(path, input_path, output_base):
+    mirror_path = os.path.relpath(path, input_path) if path != input_path else os.path.basename(path)
+    return os.path.join(output_base, mirror_path)
+
+def _up_to_date(output_path, *sources):
+    """Whether output_path exists and was written after all of its sources last changed."""
+    try:
+        output_mtime = os.stat(output_path).st_mtime_ns
+    except FileNotFoundError:
+        return False
+    return all(os.stat(source).st_mtime_ns <= output_mtime for source in sources)
+
+def _subtract_pipelined(tasks, background, jobs):
+    """
+    Subtract background from every (input, output) path pair, overlapping reads, subtraction and writes: a pool of
+    reader threads decodes and subtracts, and a pool of writer threads encodes and saves. A bounded queue between
+    them keeps at most 2 * jobs images in memory. Prints progress, then a throughput summary.
+    """
+    import numpy as np
+    from PIL import Image
+    from . import flatfield
+
+    pending = queue.Queue(maxsize=2 * jobs)
+    lock = threading.Lock()
+    progress = {"done": 0, "bytes": 0}
+    errors = []
+    start = time.perf_counter()
+
+    def read(task):
+        path, output_path = task
+        try:
+            img = np.array(Image.open(path)).astype(background.dtype)
+            subtracted = flatfield.subtract_background(img, background)
+        except Exception as e:
+            errors.append((path, e))
+            return
+        pending.put((output_path, subtracted))
+
+    def write():
+        while (item := pending.get()) is not None:
+            output_path, subtracted = item
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+                Image.fromarray(subtracted).save(output_path)
+            except Exception as e:
+                errors.append((output_path, e))
+                continue
+            with lock:
+                progress["done"] += 1
+                progress["bytes"] += subtracted.nbytes
+                print(f"\rsubtracted {progress['done']}/{len(tasks)}", end="", flush=True)
+
+    writers = [threading.Thread(target=write, daemon=True) for _ in range(jobs)]
+    for writer in writers:
+        writer.start()
+    # The writers are stopped even if reading fails, so that images already queued are still written.
+    try:
+        with ThreadPoolExecutor(jobs) as readers:
+            list(readers.map(read, tasks))
+    finally:
+        for _ in writers:
+            pending.put(None)
+        for writer in writers:
+            writer.join()
+
+    seconds = time.perf_counter() - start
+    print(f"\nsubtracted {progress['done']} images in {seconds:.1f}s "
+          f"({progress['done'] / max(seconds, 1e-9):.1f} images/s, {progress['bytes'] / 2**20 / max(seconds, 1e-9):.1f} MB/s)")
+    for path, e in errors:
+        print(f"failed {path}: {e!r}")
+
+def subtract(background_path, input_path, output_base, ftype, display=False, force=False, jobs=1):
+    import numpy as np
+    from PIL import Image
+    from . import flatfield
 
     if not os.path.isfile(background_path):
         print(f"input path {background_path} does not exist.")
@@ -74,19 +157,40 @@ def subtract(background_path, input_path, output_base, ftype, display=False, for
 
     background = np.array(Image.open(background_path))
 
+    if jobs > 1 and not display:
+        tasks = []
+        skipped = 0
+        for path in paths:
+            output_path = _mirror_path(path, input_path, output_base)
+            if not force and _up_to_date(output_path, path, background_path):
+                skipped += 1
+            elif (not force) and os.path.exists(output_path):
+                print(f"{output_path} exists; either delete the output or re-run subtract with -f to overwrite")
+                return
+            else:
+                tasks.append((path, output_path))
+        if skipped:
+            print(f"skipping {skipped} images already up to date")
+        _subtract_pipelined(tasks, background, jobs)
+        return
+
     for path in paths:
+        output_path = _mirror_path(path, input_path, output_base)
+        if not display and not force and _up_to_date(output_path, path, background_path):
+            print(f"{output_path} is up to date; skipping")
+            continue
+
         print(f"subtracting {path}")
         img = np.array(Image.open(path)).astype(background.dtype)
-        subtracted = flatfield.trunc_sub(img, background)
+        subtracted = flatfield.subtract_background(img, background)
 
-        mirror_path = os.path.relpath(path, input_path) if path != input_path else os.path.basename(path)
-        output_path = os.path.join(output_base, mirror_path)
         mirror_parent = os.path.abspath(os.path.join(output_path, os.path.pardir))
         print(f"writing to {mirror_parent}")
         if not os.path.isdir(mirror_parent):
             os.makedirs(mirror_parent)
 
         if display:
+            import matplotlib.pyplot as plt
             plt.imshow(subtracted)
             plt.show()
             continue
@@ -109,6 +213,9 @@ def main():
     generate_parser.add_argument("-r", "--recursive", action="store_true", help="Use all files in input directory")
     generate_parser.add_argument("-f", "--force", action="store_true", help="Force overwrite")
     generate_parser.add_argument("--display", action="store_true", help="Display the generated image and exit")
+    generate_parser.add_argument("--method", choices=BACKGROUND_METHODS, default="median", help="Per-pixel statistic used as the background")
+    generate_parser.add_argument("--percentile", type=float, default=10.0, help="Percentile to use with --method percentile")
+    generate_parser.add_argument("--trim", type=float, default=0.1, help="Fraction cut from each end with --method trimmed-mean")
 
     subtract_parser = subparsers.add_parser(SUBTRACT_CMD, help="Subtract background from images")
     subtract_parser.add_argument("background", type=pathlib.Path, help="Background image to subtract")
@@ -117,6 +224,7 @@ def main():
     subtract_parser.add_argument("--ftype", type=str, choices=["tif"], default="tif", help="filetype to filter for when recursing")
     subtract_parser.add_argument("-f", "--force", action="store_true", help="Force overwrite")
     subtract_parser.add_argument("--display", action="store_true", help="Display the generated image and exit")
+    subtract_parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of images read, subtracted and written concurrently")
 
     args = root_parser.parse_args()
     cmd = args.command
@@ -125,7 +233,10 @@ def main():
             inputs=args.inputs,
             output=args.output,
             recursive=args.recursive,
-            display=args.display)
+            display=args.display,
+            method=args.method,
+            percentile=args.percentile,
+            trim=args.trim)
     elif cmd == SUBTRACT_CMD:
         subtract(
             args.background,
@@ -133,7 +244,8 @@ def main():
             args.output_base,
             ftype=args.ftype,
             display=args.display,
-            force=args.force,)
+            force=args.force,
+            jobs=args.jobs)
     else:
         sys.exit(1)
 
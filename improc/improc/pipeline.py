@@ -0,0 +1,168 @@
+import contextlib
+import functools
+import itertools
+import os
+import pathlib
+import random
+
+from collections import defaultdict
+from dataclasses import dataclass
+
+import numpy as np
+import tifffile
+
+from multiprocess import Pool
+from PIL import Image
+
+from common import ImgMeta, MFSpec
+from common.utils import try_load_mfile
+from common.utils.catalog import Catalog
+
+from .flatfield import background_from_paths, subtract_background
+from .stitching import Mosaic
+
+# Number of images sampled from an acquisition group when computing its background.
+SAMPLE_SIZE = 100
+
+@dataclass
+class WellJob:
+    '''Everything needed to turn the raw tiles of one well and channel into a stack.'''
+    channel: str
+    well: str
+    background: np.ndarray
+    # Tiles of every timepoint in time order, each in montage order.
+    timepoints: list[list[ImgMeta]]
+    # Tiles per side of the montage, and the timepoints of the experiment, which every well must have in full.
+    montage_dim: int
+    time_points: list[int]
+
+def well_label(meta: ImgMeta) -> str:
+    return meta.path.name.split(".")[0].split("_")[0]
+
+def stack_path(experiment_base: pathlib.Path, channel: str, well: str) -> pathlib.Path:
+    return experiment_base / "processed_imgs" / "stacked" / channel / f"{well}.tif"
+
+def acquisition_groups(catalog: Catalog, spec: MFSpec) -> dict[tuple[str, int], list[ImgMeta]]:
+    '''Raw images of the experiment grouped by (channel, exposure), i.e. by common background profile.'''
+    groups = defaultdict(list)
+    for well in spec.wells:
+        for exposure in well.exposures:
+            groups[(exposure.channel, exposure.exposure_ms)] += catalog.images(channel=exposure.channel, well=well.label)
+    return groups
+
+def montage_sets(group: list[ImgMeta]):
+    '''
+    Yield (well, timepoints) for every well in an acquisition group, timepoints being the tiles of each timepoint in
+    montage order. groupby only merges adjacent items, so the group is sorted by the grouping keys first.
+    '''
+    well_key = lambda meta: (meta.row, meta.col, well_label(meta))
+    time_key = lambda meta: meta.time_point
+    ordered = sorted(group, key=lambda meta: (*well_key(meta), time_key(meta), meta.montage_idx))
+    for (_, _, well), metas in itertools.groupby(ordered, well_key):
+        yield well, [list(tiles) for _, tiles in itertools.groupby(metas, time_key)]
+
+def process_well(job: WellJob, experiment_base: pathlib.Path, microscope: str, t_o=0.1, blend="overwrite", save_stitched=False) -> pathlib.Path:
+    '''
+    Flatfield, stitch and stack every timepoint of a well, reading each tile once. Frames go straight into a
+    memory-mapped stack, so only one timepoint's tiles and mosaic are ever held in memory.
+
+    Raises ValueError if the well is missing a timepoint of the experiment or a tile of the montage, so that its
+    frames always line up with the experiment's timepoints. The partly written stack is removed on failure.
+    '''
+    well_time_points = [metas[0].time_point for metas in job.timepoints]
+    if well_time_points != job.time_points:
+        missing = sorted(set(job.time_points) - set(well_time_points))
+        raise ValueError(f"{job.well}: missing timepoint(s) {', '.join(f'T{t}' for t in missing)}")
+    for metas in job.timepoints:
+        if len(metas) != job.montage_dim ** 2:
+            raise ValueError(f"{job.well} T{metas[0].time_point}: {len(metas)} tiles, expected a {job.montage_dim}x{job.montage_dim} montage")
+
+    output_path = stack_path(experiment_base, job.channel, job.well)
+    os.makedirs(output_path.parent, exist_ok=True)
+    tmp_path = output_path.with_name(output_path.name + ".tmp")
+
+    try:
+        _stack_timepoints(job, tmp_path, experiment_base, microscope, t_o, blend, save_stitched)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, output_path)
+    return output_path
+
+def _stack_timepoints(job: WellJob, tmp_path, experiment_base, microscope, t_o, blend, save_stitched):
+    stack = None
+    for t, metas in enumerate(job.timepoints):
+        tiles = [np.array(Image.open(meta.path)).astype(job.background.dtype) for meta in metas]
+        subtract_background(tiles, job.background)
+        mosaic = Mosaic(microscope, tiles, t_o, blend=blend)
+        if stack is None:
+            stack = tifffile.memmap(tmp_path, shape=(len(job.timepoints), *mosaic.shape), dtype=mosaic.dtype)
+        elif mosaic.shape != stack.shape[1:]:
+            raise ValueError(f"{job.well} T{metas[0].time_point}: mosaic shape {mosaic.shape} differs from earlier timepoints' {stack.shape[1:]}")
+        stack[t] = mosaic.region(0, mosaic.shape[0], 0, mosaic.shape[1])
+
+        if save_stitched:
+            relative_path = metas[0].path.relative_to(experiment_base / "raw_imgs").parent.parent
+            stitched_base = experiment_base / "processed_imgs" / "stitched" / relative_path
+            os.makedirs(stitched_base, exist_ok=True)
+            Image.fromarray(stack[t]).save(stitched_base / f"{job.well}.tif", compression="tiff_lzw")
+
+    stack.flush()
+    del stack
+
+def _try_process_well(job: WellJob, **kwargs):
+    '''(job, stack path, None) or, if the well failed, (job, None, error), so one failed well doesn't stop the rest.'''
+    try:
+        return job, process_well(job, **kwargs), None
+    except Exception as e:
+        return job, None, e
+
+def process_experiment(experiment_base, spec: MFSpec = None, processes=None, sample_size=SAMPLE_SIZE, t_o=0.1,
+                       blend="overwrite", save_stitched=False, seed=None) -> list[pathlib.Path]:
+    '''
+    Turn an experiment's raw tiles into the per-well stacks at processed_imgs/stacked/<channel>/<well>.tif that
+    SurvivalAnalyzer reads.
+
+    Images are grouped by (channel, exposure), and each group's background is the median of a random sample of
+    sample_size of its images. A pool of processes then flatfields, stitches and stacks one well at a time. The
+    stitched mosaics of every timepoint are only written to processed_imgs/stitched if save_stitched is set.
+    A well that fails (e.g. an unreadable or missing tile) is reported at the end and left out of the returned stacks.
+
+    Args:
+        spec: the experiment's mfile spec (read from experiment_base by default)
+        blend: how stitched tiles are combined where they overlap; see stitching.Mosaic
+        seed: seed for sampling background images, for reproducible backgrounds
+    '''
+    experiment_base = pathlib.Path(experiment_base)
+    spec = spec or try_load_mfile(experiment_base)
+    rng = random.Random(seed)
+    with Catalog(experiment_base) as catalog:
+        catalog.refresh()
+        groups = acquisition_groups(catalog, spec)
+
+    jobs = []
+    for (channel, exposure_ms), group in groups.items():
+        if not group:
+            continue
+        print(f"computing background for {channel} at {exposure_ms} ms from {min(sample_size, len(group))} of {len(group)} images")
+        sample = rng.sample(group, k=min(sample_size, len(group)))
+        background = background_from_paths([meta.path for meta in sample]).astype(np.uint16)
+        time_points = sorted({meta.time_point for meta in group})
+        jobs += [WellJob(channel, well, background, timepoints, spec.montage_dim, time_points)
+                 for well, timepoints in montage_sets(group)]
+
+    process = functools.partial(_try_process_well, experiment_base=experiment_base, microscope=spec.microscope,
+                                t_o=t_o, blend=blend, save_stitched=save_stitched)
+    stacks = []
+    failures = []
+    with Pool(processes or os.cpu_count()) as pool:
+        for job, path, error in pool.imap_unordered(process, jobs):
+            if error is not None:
+                failures.append((job, error))
+                continue
+            stacks.append(path)
+            print(f"stacked {len(stacks)}/{len(jobs)}: {path}")
+    for job, error in failures:
+        print(f"{job.channel} {job.well} failed: {error!r}")
+    return sorted(stacks)
@@ -0,0 +1,27 @@
+import argparse
+import pathlib
+
+def main():
+    parser = argparse.ArgumentParser("improc-pipeline", description="Flatfield, stitch and stack an experiment's raw images")
+    parser.add_argument("experiment_base", type=pathlib.Path, help="Experiment directory, containing the mfile and raw_imgs")
+    parser.add_argument("-p", "--processes", type=int, default=None, help="Number of wells processed concurrently")
+    parser.add_argument("--sample-size", type=int, default=None, help="Number of images sampled per background (100 by default)")
+    parser.add_argument("--overlap", type=float, default=0.1, help="Fraction of each tile overlapping its neighbours")
+    parser.add_argument("--blend", choices=["overwrite", "linear"], default="overwrite", help="How overlapping tiles are combined")
+    parser.add_argument("--save-stitched", action="store_true", help="Also write each stitched timepoint to processed_imgs/stitched")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for sampling background images")
+
+    args = parser.parse_args()
+    # The pipeline pulls in numpy, tifffile and multiprocess; --help shouldn't have to wait on them.
+    from . import pipeline
+    pipeline.process_experiment(
+        args.experiment_base,
+        processes=args.processes,
+        sample_size=args.sample_size or pipeline.SAMPLE_SIZE,
+        t_o=args.overlap,
+        blend=args.blend,
+        save_stitched=args.save_stitched,
+        seed=args.seed)
+
+if __name__ == "__main__":
+    main()
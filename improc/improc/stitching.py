@@ -1,144 +1,412 @@
-from operator import itemgetter
+import functools
+import os
+import tempfile
+
+from collections import OrderedDict
 from typing import DefaultDict
 from common.utils import get_layout_indexing
-from scipy.sparse import linalg
 
 import numpy as np
+import tifffile
 
-def stitch(microscope: str, images: list[np.ndarray], t_o=0.1):
-    #+TAG:DIRTY
-    # Assumption made that stitched images all have square geometry.
-    dim = int(np.sqrt(len(images)))
-    layout = get_layout_indexing(microscope, dim)
-    # Flatten layout sequence and get permuted sequence of paths.
-    perm_paths = itemgetter(*(layout.reshape(-1)))(images)
-    # Reshape images into correct 2D locations but with each image being a 1D array.
-    imgarray = np.array(perm_paths)
-    # Assuming all images are of same size, reshape into larger array with images in place.
-    imgarray = imgarray.reshape((dim, dim, *imgarray[0].shape))
-
-    # Used in later computations.
-    img_size_y, img_size_x = imgarray[0, 0].shape
-
-    '''
-    #Same transform can be used for both x and y overlaps, which is tremendously useful
-    #Equation form is very reminiscent of a system of difference equations, and I'm sure it could be formulated as such
-    #Create transform matrix     0   1   2   3   4   5   6   7   8
-    mat = np.matrix(np.array([  [2, -1,  0, -1,  0,  0,  0,  0,  0],
-                                [0,  2, -1,  0, -1,  0,  0,  0,  0],
-                                [0,  0,  1,  0,  0, -1,  0,  0,  0],
-                                [0,  0,  0,  2, -1,  0, -1,  0,  0],
-                                [0,  0,  0,  0,  2, -1,  0, -1,  0],
-                                [0,  0,  0,  0,  0,  1,  0,  0, -1],
-                                [0,  0,  0,  0,  0,  0,  1, -1,  0],
-                                [0,  0,  0,  0,  0,  0,  0,  1, -1],
-                                [0,  0,  0,  0,  0,  0,  0,  0,  0] ]))
-    '''
-
-    #Build transform matrix
-    Y, X = imgarray.shape[0], imgarray.shape[1]
-    dim = Y * X
-
-    #Matrix full of zeros
-    a = np.zeros((dim, dim), dtype=np.int8)
-
-    #Increase every diagonal by one
-    diag = np.diag_indices(dim)
-
-    # 2 if the next k is less than one minus the last column?
-    a[diag] = [2 if ( (k+1) < (Y-1)*X ) and ( (k+1) % X != 0 ) else 1 for k in range(dim)]
-
-    def neighs(k):
-        if (k+1) < (Y-1)*X and ((k+1) % X) != 0:
-            return (k+1, k+X)
-        elif (k+1) > (Y-1)*X:
-            return (k+1,)
-        else:
-            return (k+X,)
-
-    for k, row in enumerate(a[:-1]):
-        for i in neighs(k):
-            row[i] = -1
-
-    a[-1, -1] = 0
-    mat = np.matrix(a)
-
-    #Could build auxiliary functions to determine whether in last row or last column -- would make code cleaner
-    #Build overlap vectors
-    xoverlaps = [t_o if (k+1) % Y != 0 else 0 for k in range(dim)]
-    yoverlaps = [t_o if (k+1) <= (Y-1)*Y else 0 for k in range(dim)]
-
-    xtrans = linalg.gmres(mat, xoverlaps)[0] * img_size_x
-    ytrans = linalg.gmres(mat, yoverlaps)[0] * img_size_y
-
-    #May also have to minimize values too..although, perhaps anotherway (shifting entire translation transform to another origin, as they are all relative)
-    ##Yes, this is an affine transformation and origin is irrelevant
-    #xtrans -= xtrans.max()
-    #ytrans -= ytrans.max()
-
-    xtrans -= xtrans[0]
-    ytrans -= ytrans[0]
-
-    #X DIFFERENCING MATRIX
-    a = np.zeros((dim, dim), dtype=np.int8)
-    for k, row in enumerate(a):
-        if k % X == 0:
-            row[k] = 1
-        else:
-            row[k-1], row[k] = 1, -1
-    a[0,0] = 0
-
-    xslices = np.dot(a, xtrans).astype(np.int32)
-
-    #Y DIFFERENCING MATRIX
-    a = np.zeros((dim, dim), dtype=np.int8)
-    for k, row in enumerate(a[:]):
-        if k < X:
-            row[k] = 1
-        else:
-            row[k-X], row[k] = 1, -1
-
-    a[0,0] = 0
-    yslices = np.dot(a, ytrans).astype(np.int32)
-
-    arr = imgarray
-
-
-    #Shift tiles and slice based on translations
-    slices = []
-    for i in range(Y):
-        for j in range(X):
-            slices.append(arr[i, j][yslices[i*X + j]:, xslices[i*X + j]:])
+def _translations(Y, X, img_size_y, img_size_x, t_o):
+    '''
+    Number of leading columns (xslices) and rows (yslices) cropped from each tile, in row-major order: every tile but
+    those of the first column (row) loses a fraction t_o of its width (height) to the overlap with its neighbour.
+    '''
+    # The difference equations relating neighbouring tiles have this closed-form solution. Solving them numerically
+    # (as was once done with gmres) gives the same crops, except that residual error could land exactly integral
+    # overlaps a pixel short on some tiles. The small epsilon keeps products like 0.29 * 100 from rounding down.
+    x_overlap = int(np.floor(t_o * img_size_x + 1e-6))
+    y_overlap = int(np.floor(t_o * img_size_y + 1e-6))
+    xslices = np.tile(np.r_[0, np.full(X - 1, x_overlap)], Y).astype(np.int32)
+    yslices = np.repeat(np.r_[0, np.full(Y - 1, y_overlap)], X).astype(np.int32)
+    return xslices, yslices
+
+@functools.lru_cache(maxsize=None)
+def _placements(Y, X, img_size_y, img_size_x, t_o):
+    '''
+    Where every tile of a Y x X montage goes, in row-major order: the (row, col) its crop starts at within the tile,
+    the (row, col) it is placed at in the mosaic, and the crop's size. Also returns the mosaic shape. The table only
+    depends on its arguments, so it is computed once and shared by every montage with the same geometry.
+    '''
+    xslices, yslices = _translations(Y, X, img_size_y, img_size_x, t_o)
 
-    ##Make blank array to be filled
-    stitched_arr = np.zeros((Y*img_size_y, X*img_size_x), dtype=np.uint16)
+    placements = []
     running_col_totals = DefaultDict(int)
     running_row_totals = DefaultDict(int)
-    for i, tile in enumerate(slices):
-        tile_rows, tile_cols = tile.shape
-        row = int(np.floor(i / X))
-        col = i % X
-
-        row_coord = running_row_totals[row]
-        col_coord = running_col_totals[col]
-
-        coords = (slice(col_coord, col_coord + tile_rows),
-                  slice(row_coord, row_coord + tile_cols))
-
-        stitched_arr[coords] = tile
+    for i in range(Y):
+        for j in range(X):
+            # Tiles are cropped as tile[yslice:, xslice:].
+            y_start, x_start = int(yslices[i*X + j]), int(xslices[i*X + j])
+            tile_rows, tile_cols = img_size_y - y_start, img_size_x - x_start
 
-        #Keep track of total pixels placed so next tile can be situated properly
-        running_row_totals[row] += tile_cols
-        running_col_totals[col] += tile_rows
+            row_coord = running_row_totals[i]
+            col_coord = running_col_totals[j]
+            placements.append(((y_start, x_start), (col_coord, row_coord), (tile_rows, tile_cols)))
 
+            #Keep track of total pixels placed so next tile can be situated properly
+            running_row_totals[i] += tile_cols
+            running_col_totals[j] += tile_rows
 
     max_col = max(running_col_totals.values())
     max_row = max(running_row_totals.values())
+    return tuple(placements), (max_col, max_row)
 
+def _load(image):
+    return tifffile.imread(image) if isinstance(image, (str, os.PathLike)) else image
 
-    img = stitched_arr[:max_col, :max_row]
-    # On special request, images taken via the 'ixm' need a 90 degree rotation.
-    if microscope in {'ixm'}:
-        img = np.rot90(img)
+class _TileReader:
+    '''
+    Tiles given either as arrays or as paths; paths are read on demand and kept only while the regions being stitched
+    still overlap them (see retain).
+    '''
+    def __init__(self, images):
+        self.images = images
+        self._cache = {}
+
+    @property
+    def tile_shape(self):
+        image = self.images[0]
+        if isinstance(image, (str, os.PathLike)):
+            with tifffile.TiffFile(image) as tif:
+                return tif.series[0].shape[-2:]
+        return image.shape
+
+    def retain(self, keys):
+        '''Drop every tile read so far except those in keys.'''
+        for k in [k for k in self._cache if k not in keys]:
+            del self._cache[k]
+
+    def __getitem__(self, k):
+        image = self.images[k]
+        if not isinstance(image, (str, os.PathLike)):
+            return image
+        if k not in self._cache:
+            self._cache[k] = _load(image)
+        return self._cache[k]
+
+@functools.lru_cache(maxsize=None)
+def _feather_ramp(rows, cols):
+    '''
+    Blending weight of every pixel of a tile: the product of its distances (in pixels, from 1) to the nearest top or
+    bottom edge and to the nearest left or right edge, so contributions fade out linearly toward a tile's borders.
+    '''
+    ramp_y = np.minimum(np.arange(1, rows + 1), np.arange(rows, 0, -1)).astype(np.float32)
+    ramp_x = np.minimum(np.arange(1, cols + 1), np.arange(cols, 0, -1)).astype(np.float32)
+    ramp = np.outer(ramp_y, ramp_x)
+    ramp.flags.writeable = False
+    return ramp
 
-    return img
+def _phase_correlate(a, b):
+    '''
+    Shift (dy, dx) of the content of every b relative to its a, for two stacks of equally sized strips, with the
+    height of the normalised correlation peak as a measure of confidence. All pairs go through one batched FFT.
+    '''
+    window = np.outer(np.hanning(a.shape[1]), np.hanning(a.shape[2]))
+    fa = np.fft.rfft2((a - a.mean(axis=(1, 2), keepdims=True)) * window)
+    fb = np.fft.rfft2((b - b.mean(axis=(1, 2), keepdims=True)) * window)
+    cross = fa * np.conj(fb)
+    cross /= np.maximum(np.abs(cross), 1e-12)
+    correlation = np.fft.irfft2(cross, s=a.shape[1:])
+
+    flat = correlation.reshape(len(a), -1)
+    peak = flat.argmax(axis=1)
+    dy, dx = np.unravel_index(peak, a.shape[1:])
+    # Peaks past the middle are negative shifts.
+    dy = np.where(dy > a.shape[1] // 2, dy - a.shape[1], dy)
+    dx = np.where(dx > a.shape[2] // 2, dx - a.shape[2], dx)
+    return dy, dx, flat[np.arange(len(a)), peak]
+
+def register_tiles(microscope: str, images: list, t_o=0.1, max_shift=0.05, min_confidence=0.1):
+    '''
+    Estimate where every tile of a montage really lies, in (row, col) pixels of the unrotated mosaic, one per montage
+    position in row-major order.
+
+    The deviation of each pair of neighbouring tiles from the nominal t_o grid is found by phase correlation of
+    their nominal overlap strips, and positions are then solved jointly by least squares over all pairs, weighted by
+    correlation confidence. Pairs whose match is weak (e.g. empty background) or further off than max_shift (a
+    fraction of the tile size) are ignored, so a tile without any trusted neighbour stays on the nominal grid.
+    '''
+    dim = int(np.sqrt(len(images)))
+    order = get_layout_indexing(microscope, dim).reshape(-1)
+    tiles = [np.asarray(_load(images[k]), dtype=np.float64) for k in order]
+    h, w = tiles[0].shape
+    overlap_y, overlap_x = int(np.floor(t_o * h + 1e-6)), int(np.floor(t_o * w + 1e-6))
+    step_y, step_x = h - overlap_y, w - overlap_x
+    nominal = np.array([(i * step_y, j * step_x) for i in range(dim) for j in range(dim)], dtype=np.float64)
+
+    pairs, offsets, weights = [], [], []
+    # Horizontal neighbours share the last columns of the left tile and the first columns of the right one.
+    horizontal = [(i * dim + j, i * dim + j + 1) for i in range(dim) for j in range(dim - 1)]
+    if horizontal and overlap_x > 1:
+        dy, dx, confidence = _phase_correlate(np.stack([tiles[k][:, step_x:] for k, _ in horizontal]),
+                                              np.stack([tiles[l][:, :overlap_x] for _, l in horizontal]))
+        pairs += horizontal
+        offsets += [(y, step_x + x) for y, x in zip(dy, dx)]
+        weights += list(confidence)
+    # Vertical neighbours share the last rows of the upper tile and the first rows of the lower one.
+    vertical = [(i * dim + j, (i + 1) * dim + j) for i in range(dim - 1) for j in range(dim)]
+    if vertical and overlap_y > 1:
+        dy, dx, confidence = _phase_correlate(np.stack([tiles[k][step_y:, :] for k, _ in vertical]),
+                                              np.stack([tiles[l][:overlap_y, :] for _, l in vertical]))
+        pairs += vertical
+        offsets += [(step_y + y, x) for y, x in zip(dy, dx)]
+        weights += list(confidence)
+
+    return _solve_positions(len(tiles), pairs, np.array(offsets, dtype=np.float64).reshape(-1, 2),
+                            np.array(weights), nominal, (max_shift * h, max_shift * w), min_confidence)
+
+def _solve_positions(n, pairs, offsets, weights, nominal, margins, min_confidence):
+    '''Least-squares tile positions from pairwise offsets, each pull toward the nominal grid weighted lightly.'''
+    rows, rhs, row_weights = [], [], []
+    for (k, l), offset, weight in zip(pairs, offsets, weights):
+        expected = nominal[l] - nominal[k]
+        # Matches that are weak, or further from the nominal grid than a stage could plausibly err, are left out;
+        # tiles they would have placed fall back on the prior below.
+        if weight < min_confidence or np.any(np.abs(offset - expected) > margins):
+            continue
+        row = np.zeros(n)
+        row[k], row[l] = -1, 1
+        rows.append(row)
+        rhs.append(offset)
+        row_weights.append(weight)
+
+    # A weak prior toward the nominal grid keeps the system well-posed, including its absolute position.
+    prior = 1e-3 * min_confidence
+    rows.extend(np.eye(n))
+    rhs.extend(nominal)
+    row_weights.extend([prior] * n)
+
+    sqrt_w = np.sqrt(np.array(row_weights))[:, None]
+    positions, *_ = np.linalg.lstsq(np.array(rows) * sqrt_w, np.array(rhs) * sqrt_w, rcond=None)
+    positions = np.round(positions - positions.min(axis=0)).astype(np.int64)
+    return positions
+
+def registered_positions(path, microscope: str, images: list, t_o=0.1, **kwargs):
+    '''
+    Tile positions of a well, registered on first use and stored at path (.npy) thereafter, so that later timepoints
+    and other channels of the same well are stitched identically without registering again.
+    '''
+    if os.path.exists(path):
+        return np.load(path)
+    positions = register_tiles(microscope, images, t_o, **kwargs)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    np.save(path, positions)
+    return positions
+
+class Mosaic:
+    '''
+    A stitched montage that is never held in memory as a whole. Any region of it is assembled on request from
+    just the tiles overlapping that region, so mosaics larger than memory can be written out piece by piece.
+
+    Tiles are laid on the nominal t_o grid, or, given positions (e.g. from register_tiles), each whole tile is placed
+    at its (row, col) position. Where tiles overlap, blend='overwrite' keeps the earlier tile in the montage, and
+    blend='linear' feathers them: every whole tile contributes with a weight falling off linearly toward its edges.
+    '''
+    def __init__(self, microscope: str, images: list, t_o=0.1, positions=None, blend='overwrite'):
+        #+TAG:DIRTY
+        # Assumption made that stitched images all have square geometry.
+        dim = int(np.sqrt(len(images)))
+        layout = get_layout_indexing(microscope, dim)
+        # Flatten layout sequence to get the image for each montage position, in row-major order.
+        self.order = layout.reshape(-1)
+        self.tiles = _TileReader(images)
+        tile_shape = tuple(map(int, self.tiles.tile_shape))
+        if positions is None:
+            self.placements, self.stitched_shape = _placements(dim, dim, *tile_shape, float(t_o))
+        else:
+            positions = np.asarray(positions, dtype=np.int64)
+            self.placements = tuple(((0, 0), (int(row), int(col)), tile_shape) for row, col in positions)
+            self.stitched_shape = tuple(int(n) for n in (positions + tile_shape).max(axis=0))
+        if blend not in {'overwrite', 'linear'}:
+            raise ValueError(f'Unknown blend mode {blend!r}, expected "overwrite" or "linear".')
+        self.blend = blend
+        self.tile_shape = tile_shape
+
+        # On special request, images taken via the 'ixm' need a 90 degree rotation.
+        self.rotate = microscope in {'ixm'}
+        self.shape = self.stitched_shape[::-1] if self.rotate else self.stitched_shape
+        self.dtype = np.dtype(np.uint16)
+
+    def _stitched_region(self, y0, y1, x0, x1):
+        # Mosaics are written a band at a time, top to bottom, so tiles which no longer overlap the current band have
+        # been passed and won't be needed again; only the tiles overlapping one band are ever kept.
+        rows, cols = self.tile_shape
+        self.tiles.retain({k for k, (row, col) in zip(self.order, self._whole_tiles())
+                           if row < y1 and y0 < row + rows and col < x1 and x0 < col + cols})
+        if self.blend == 'linear':
+            return self._blended_region(y0, y1, x0, x1)
+        return self._copied_region(y0, y1, x0, x1)
+
+    def _copied_region(self, y0, y1, x0, x1):
+        region = np.zeros((y1 - y0, x1 - x0), dtype=self.dtype)
+        # Tiles are drawn last to first, so that earlier tiles win where they overlap.
+        for k, ((y_start, x_start), (row, col), (rows, cols)) in reversed(list(zip(self.order, self.placements))):
+            top, bottom = max(y0, row), min(y1, row + rows)
+            left, right = max(x0, col), min(x1, col + cols)
+            if top >= bottom or left >= right:
+                continue
+            tile = self.tiles[k]
+            region[top - y0:bottom - y0, left - x0:right - x0] = tile[y_start + top - row:y_start + bottom - row,
+                                                                     x_start + left - col:x_start + right - col]
+        return region
+
+    def _whole_tiles(self):
+        '''(row, col) of every whole tile; grid placements crop the overlap off, so whole tiles start that much earlier.'''
+        return [(row - y_start, col - x_start) for (y_start, x_start), (row, col), _ in self.placements]
+
+    @functools.cached_property
+    def _overlaps(self):
+        '''Bounds (top, bottom, left, right) of where every pair of whole tiles overlaps; only there is blending needed.'''
+        rows, cols = self.tile_shape
+        corners = np.array(self._whole_tiles())
+        top = np.maximum(corners[:, None, 0], corners[None, :, 0])
+        left = np.maximum(corners[:, None, 1], corners[None, :, 1])
+        bottom = np.minimum(corners[:, None, 0], corners[None, :, 0]) + rows
+        right = np.minimum(corners[:, None, 1], corners[None, :, 1]) + cols
+        k, l = np.nonzero(np.triu((top < bottom) & (left < right), 1))
+        return np.stack([top[k, l], bottom[k, l], left[k, l], right[k, l]], axis=1)
+
+    def _blended_region(self, y0, y1, x0, x1):
+        # Pixels only one tile covers are simply copied; each overlap is then blended from all tiles covering it.
+        region = self._copied_region(y0, y1, x0, x1)
+        ramp = _feather_ramp(*self.tile_shape)
+        rows, cols = self.tile_shape
+        corners = self._whole_tiles()
+        for top, bottom, left, right in self._overlaps:
+            top, bottom, left, right = max(y0, top), min(y1, bottom), max(x0, left), min(x1, right)
+            if top >= bottom or left >= right:
+                continue
+            # Weighted sums of the tiles and their summed weights are accumulated a tile at a time, then divided.
+            values = np.zeros((bottom - top, right - left), dtype=np.float32)
+            weights = np.zeros((bottom - top, right - left), dtype=np.float32)
+            for k, (row, col) in zip(self.order, corners):
+                # Other tiles may cover just part of an overlap, e.g. at the corners of four tiles.
+                t, b, l, r = max(top, row), min(bottom, row + rows), max(left, col), min(right, col + cols)
+                if t >= b or l >= r:
+                    continue
+                inside = np.s_[t - row:b - row, l - col:r - col]
+                window = np.s_[t - top:b - top, l - left:r - left]
+                values[window] += self.tiles[k][inside] * ramp[inside]
+                weights[window] += ramp[inside]
+            region[top - y0:bottom - y0, left - x0:right - x0] = np.round(values / weights)
+        return region
+
+    def region(self, y0, y1, x0, x1) -> np.ndarray:
+        '''Rows y0:y1 and columns x0:x1 of the mosaic.'''
+        if not self.rotate:
+            return self._stitched_region(y0, y1, x0, x1)
+        # Row i, column j of the rotated mosaic is row j, column (width - 1 - i) of the stitched one.
+        width = self.stitched_shape[1]
+        return np.rot90(self._stitched_region(x0, x1, width - y1, width - y0))
+
+    def iter_tiles(self, tile, on_band=None):
+        '''
+        Yield the mosaic as tiles of the given shape in row-major order, stitching one band of rows (a row of tiles)
+        at a time. Tiles at the right and bottom edges are zero-padded to full size. on_band, if given, is called
+        with every band before its tiles are yielded.
+        '''
+        height, width = self.shape
+        for y in range(0, height, tile[0]):
+            band = self.region(y, min(y + tile[0], height), 0, width)
+            if on_band is not None:
+                on_band(band)
+            yield from _band_tiles(band, tile)
+
+def _band_tiles(band, tile):
+    '''Tiles of the given shape across a band of rows, zero-padded to full size at the band's right and bottom.'''
+    for x in range(0, band.shape[1], tile[1]):
+        data = band[:, x:x + tile[1]]
+        out = np.zeros(tile, dtype=band.dtype)
+        out[:data.shape[0], :data.shape[1]] = data
+        yield out
+
+def _downsample(img, factor):
+    '''Mean of every factor x factor block; partial blocks at the edges are averaged over the pixels they have.'''
+    rows, cols = -(-img.shape[0] // factor), -(-img.shape[1] // factor)
+    padded = np.pad(img.astype(np.float64), ((0, rows * factor - img.shape[0]), (0, cols * factor - img.shape[1])))
+    counts = np.pad(np.ones(img.shape), ((0, rows * factor - img.shape[0]), (0, cols * factor - img.shape[1])))
+    sums = padded.reshape(rows, factor, cols, factor).sum(axis=(1, 3))
+    n = counts.reshape(rows, factor, cols, factor).sum(axis=(1, 3))
+    return np.round(sums / n).astype(img.dtype)
+
+class _Pyramid:
+    '''
+    Downsampled levels of a mosaic, built while the mosaic itself is written: every band of rows of a level is
+    averaged 2x2 into the next level as soon as it arrives, holding back at most one odd row per level. A TIFF keeps
+    each level's tiles together after those of the level before, so each level's finished rows are kept in a
+    temporary memory-mapped file in spill_dir until it is written.
+    '''
+    def __init__(self, shape, dtype, levels, spill_dir):
+        self.heights = [shape[0]]
+        self.arrays = []
+        for level in range(1, levels + 1):
+            level_shape = tuple(-(-n // 2 ** level) for n in shape)
+            self.heights.append(level_shape[0])
+            self.arrays.append(np.lib.format.open_memmap(os.path.join(spill_dir, f'level{level}.npy'), mode='w+',
+                                                         dtype=dtype, shape=level_shape))
+        self.received = [0] * levels
+        self.filled = [0] * levels
+        self.held = [None] * levels
+
+    def add(self, rows, level=0):
+        '''Take the next rows of the given level (0 being the mosaic) and average them into the level below.'''
+        if level == len(self.arrays):
+            return
+        self.received[level] += len(rows)
+        if self.held[level] is not None:
+            rows = np.concatenate([self.held[level], rows])
+            self.held[level] = None
+        # Rows are averaged in pairs; a level's last row is averaged alone if its height is odd.
+        paired = len(rows) if self.received[level] == self.heights[level] else len(rows) // 2 * 2
+        if paired < len(rows):
+            self.held[level] = rows[paired:]
+        if paired:
+            band = _downsample(rows[:paired], 2)
+            self.arrays[level][self.filled[level]:self.filled[level] + len(band)] = band
+            self.filled[level] += len(band)
+            self.add(band, level + 1)
+
+    def iter_tiles(self, level, tile):
+        '''Yield the tiles of a level (from 1), read back a band of rows at a time.'''
+        array = self.arrays[level - 1]
+        for y in range(0, array.shape[0], tile[0]):
+            yield from _band_tiles(np.asarray(array[y:y + tile[0]]), tile)
+
+def stitch(microscope: str, images: list[np.ndarray], t_o=0.1, positions=None, blend='overwrite'):
+    mosaic = Mosaic(microscope, images, t_o, positions, blend)
+    return mosaic.region(0, mosaic.shape[0], 0, mosaic.shape[1])
+
+def stitch_to_tiff(microscope: str, images: list, path, t_o=0.1, tile=(512, 512), compression='zlib', levels=0, positions=None, blend='overwrite'):
+    '''
+    Stitch straight into a tiled, compressed BigTIFF, one band of output tiles at a time. Images may be arrays or paths
+    to tifs; paths are only read when an output band needs them and dropped once it has passed, so only the input
+    tiles overlapping one band are held however large the montage. Each of the optional pyramid levels is the 2x2
+    block mean of the one before and is stored as a SubIFD. Levels are built in the same pass, so every input tile is
+    read once; they are spilled to temporary files next to path until written.
+    '''
+    mosaic = Mosaic(microscope, images, t_o, positions, blend)
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(path))) as spill_dir:
+        pyramid = _Pyramid(mosaic.shape, mosaic.dtype, levels, spill_dir)
+        with tifffile.TiffWriter(path, bigtiff=True) as tif:
+            tif.write(mosaic.iter_tiles(tile, pyramid.add), shape=mosaic.shape, dtype=mosaic.dtype, tile=tile,
+                      compression=compression, subifds=levels or None)
+            for level in range(1, levels + 1):
+                tif.write(pyramid.iter_tiles(level, tile), shape=pyramid.arrays[level - 1].shape, dtype=mosaic.dtype,
+                          tile=tile, compression=compression, subfiletype=1)
+        # Close the memory maps before their files are removed.
+        del pyramid
+
+def stitch_to_memmap(microscope: str, images: list, path, t_o=0.1, rows_per_block=1024, positions=None, blend='overwrite'):
+    '''
+    Stitch into an uncompressed tif that is memory-mapped while writing, a block of rows at a time, and return the
+    memory-mapped mosaic. Suited to mosaics which are read back piecewise, e.g. by survival.stacks.StackReader.
+    '''
+    mosaic = Mosaic(microscope, images, t_o, positions, blend)
+    out = tifffile.memmap(path, shape=mosaic.shape, dtype=mosaic.dtype)
+    for y in range(0, mosaic.shape[0], rows_per_block):
+        y1 = min(y + rows_per_block, mosaic.shape[0])
+        out[y:y1] = mosaic.region(y, y1, 0, mosaic.shape[1])
+    out.flush()
+    return out
@@ -1,10 +1,9 @@
-import cv2
-
 import numpy as np
 
 import common.utils.legacy as transforms
 
 def compute_centroid(contour):
+    import cv2
     m = cv2.moments(contour)
     try: cx, cy = int(m['m10'] / m['m00']), int(m['m01'] / m['m00'])
     except ZeroDivisionError: cx, cy = 0, 0
@@ -19,6 +18,7 @@ def _transform_stack(stack: np.ndarray) -> np.ndarray:
 
 def annotate_fractionation(stack, cell_rois, unknown_rois, nuclear_rois,
                            nuclear_centroids=None, status_tags={}):
+    import cv2
     # Text drawing parameters.
     FONT_SCALE = 1.6
     ## Used to offset numeric identifier from cell a bit. Should be resolution-dependent.
@@ -50,22 +50,37 @@ def annotate_fractionation(stack, cell_rois, unknown_rois, nuclear_rois,
 
     return stack
 
-def annotate_survival(stack: np.ndarray, rois, width=2, thickness=2, font_scale=1.6, DELTA=25) -> np.ndarray:
+def annotate_survival(stack: np.ndarray, rois, width=2, thickness=2, font_scale=1.6, DELTA=25, offset=(0, 0)) -> np.ndarray:
+    stack = _transform_stack(stack)
+
+    for tp, frame in enumerate(stack):
+        _draw_survival(frame, tp, rois, width, thickness, font_scale, DELTA, offset)
+
+    return stack
+
+def annotate_survival_frame(img: np.ndarray, tp: int, rois, width=2, thickness=2, font_scale=1.6, DELTA=25, offset=(0, 0)) -> np.ndarray:
+    '''Annotate a single timepoint; allows annotated stacks to be written out one frame at a time.'''
+    frame = _transform_stack(img)[0]
+    _draw_survival(frame, tp, rois, width, thickness, font_scale, DELTA, offset)
+    return frame
+
+def _draw_survival(frame: np.ndarray, tp: int, rois, width, thickness, font_scale, DELTA, offset=(0, 0)):
+    '''Draw every ROI's contour for timepoint tp. Contours are drawn translated by offset (x, y).'''
+    import cv2
     # Text drawing parameters.
     FONT_SCALE = font_scale
     ## Used to offset numeric identifier from cell a bit. Should be resolution-dependent.
 
-    stack = _transform_stack(stack)
-
     # Draw data for each ROI.
     for ID, roi in rois.items():
-        for tp, contour in enumerate(roi):
-            cv2.drawContours(stack[tp], [contour], 0, (0, 255, 0), width)
+        if tp < len(roi):
+            contour = roi[tp]
+            cv2.drawContours(frame, [contour], 0, (0, 255, 0), width, offset=offset)
 
             # Draw numeric identifier.
-            cx, cy = compute_centroid(contour)
+            cx, cy = np.add(compute_centroid(contour), offset)
             cv2.putText(
-                img=stack[tp],
+                img=frame,
                 text=str(int(ID)+1),
                 org=(cx + DELTA, cy + DELTA),
                 fontFace=cv2.FONT_HERSHEY_SIMPLEX,
@@ -75,14 +90,14 @@ def annotate_survival(stack: np.ndarray, rois, width=2, thickness=2, font_scale=
             )
 
         # If total ROIs does not match total images/timepoints, then did not survive until end.
-        if len(roi) != len(stack):
+        elif tp == len(roi):
             #Draw final contour on first image where ROI was not re-identified.
-            cv2.drawContours(stack[len(roi)], [roi[-1]], 0, (255, 0, 0), 2)
+            cv2.drawContours(frame, [roi[-1]], 0, (255, 0, 0), 2, offset=offset)
 
             # Draw numeric identifier.
-            cx, cy = compute_centroid(roi[-1])
+            cx, cy = np.add(compute_centroid(roi[-1]), offset)
             cv2.putText(
-                img=stack[len(roi)],
+                img=frame,
                 text=str(int(ID)+1),
                 org=(cx + DELTA, cy + DELTA),
                 fontFace=cv2.FONT_HERSHEY_SIMPLEX,
@@ -90,5 +105,3 @@ def annotate_survival(stack: np.ndarray, rois, width=2, thickness=2, font_scale=
                 color=(255, 0, 0),
                 thickness=thickness
             )
-
-    return stack
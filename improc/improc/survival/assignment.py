@@ -0,0 +1,106 @@
+from math import isinf
+
+import numpy as np
+
+# Matchers pair the last known centroid of each living neuron (sources) with the centroids found in the
+# next timepoint (targets). Targets at index n_candidates and above belong to previously unassigned ROIs;
+# a neuron whose match is one of these is left unassigned. Each matcher returns a map from source index to
+# candidate index.
+
+def greedy_match(sources, targets, n_candidates, max_dist) -> dict[int, int]:
+    '''Nearest neighbour per neuron, in iteration order. Several neurons may claim the same candidate.'''
+    from scipy.spatial import KDTree
+    if len(sources) == 0:
+        return {}
+
+    # Create a map between a centroid and its index so it can be found.
+    centroid_to_ix = {tuple(map(int, centroid)) : ix for ix, centroid in enumerate(targets[:n_candidates])}
+
+    # Add each unassigned centroid to the map with an index of -1 as a sentinel.
+    centroid_to_ix.update({tuple(map(int, centroid)) : -1 for centroid in targets[n_candidates:]})
+
+    # Create 2D KDTree from all existing candidates and unassigned ROI centroids.
+    tree = KDTree(targets)
+
+    matches = {}
+    for source_ix, centroid in enumerate(sources):
+        # Find the distance of the nearest centroid and its index in the tree structure.
+        distance, ix = tree.query(centroid, distance_upper_bound=max_dist)
+
+        # If the nearest distance is infinity, then nothing was found. Go to next.
+        if isinf(distance): continue
+
+        nearest_centroid = tuple(tree.data[ix])
+        centroid_ix = centroid_to_ix[nearest_centroid]
+
+        # The nearest centroid belong to an unassigned ROI. Go to next.
+        if centroid_ix == -1: continue
+
+        matches[source_ix] = centroid_ix
+
+    return matches
+
+def global_match(sources, targets, n_candidates, max_dist) -> dict[int, int]:
+    '''
+    Globally optimal one-to-one matching: the largest number of pairs within max_dist, with the least
+    total travel among those. Only pairs within max_dist are considered, and each connected component
+    of that sparse graph is solved independently, so typical frames cost little more than the KDTree queries.
+    '''
+    from scipy.optimize import linear_sum_assignment
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    from scipy.spatial import KDTree
+    if len(sources) == 0 or len(targets) == 0:
+        return {}
+
+    source_tree = KDTree(np.asarray(sources, dtype=np.float64))
+    target_tree = KDTree(np.asarray(targets, dtype=np.float64))
+    pairs = source_tree.sparse_distance_matrix(target_tree, max_dist, output_type='ndarray')
+    if len(pairs) == 0:
+        return {}
+    src, tgt, dist = pairs['i'], pairs['j'], pairs['v']
+
+    # Split the bipartite graph into connected components; sources occupy the first n_sources nodes.
+    n_sources, n_targets = len(sources), len(targets)
+    n_nodes = n_sources + n_targets
+    graph = coo_matrix((np.ones(len(src)), (src, tgt + n_sources)), shape=(n_nodes, n_nodes))
+    _, component = connected_components(graph, directed=False)
+    pair_component = component[src]
+
+    matched_src, matched_tgt = [], []
+
+    # The common case of an isolated neuron with a single candidate in reach needs no solve.
+    edges_per_component = np.bincount(pair_component, minlength=n_nodes)
+    simple = edges_per_component[pair_component] == 1
+    matched_src.append(src[simple])
+    matched_tgt.append(tgt[simple])
+
+    order = np.argsort(pair_component[~simple], kind='stable')
+    c_src, c_tgt, c_dist = src[~simple][order], tgt[~simple][order], dist[~simple][order]
+    bounds = np.flatnonzero(np.diff(pair_component[~simple][order])) + 1
+    for s, t, d in zip(np.split(c_src, bounds), np.split(c_tgt, bounds), np.split(c_dist, bounds)):
+        if len(s) == 0:
+            continue
+        rows, s_local = np.unique(s, return_inverse=True)
+        cols, t_local = np.unique(t, return_inverse=True)
+        # Pairs out of reach cost more than every reachable pair combined, so the solver first maximises
+        # the number of reachable pairs, then minimises their total distance.
+        unreachable = d.sum() + 1
+        cost = np.full((len(rows), len(cols)), unreachable)
+        cost[s_local, t_local] = d
+        r, c = linear_sum_assignment(cost)
+        reachable = cost[r, c] < unreachable
+        matched_src.append(rows[r[reachable]])
+        matched_tgt.append(cols[c[reachable]])
+
+    matched_src = np.concatenate(matched_src)
+    matched_tgt = np.concatenate(matched_tgt)
+
+    # Neurons matched to a previously unassigned ROI are left without a candidate.
+    keep = matched_tgt < n_candidates
+    return dict(zip(matched_src[keep].tolist(), matched_tgt[keep].tolist()))
+
+MATCHERS = {
+    'greedy': greedy_match,
+    'global': global_match,
+}
@@ -0,0 +1,68 @@
+import glob
+import hashlib
+import json
+import os
+import pickle
+
+from os.path import join
+
+from common.utils.cache import atomic_pickle_dump
+
+def code_version():
+    '''Digest of the survival package's source, so that any change to the analysis invalidates cached results.'''
+    digest = hashlib.sha256()
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    for path in sorted(glob.glob(join(package_dir, '*.py'))):
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+def file_digest(path, chunk_size=2**24):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class ResultCache:
+    '''
+    Per-well store of tracking results, content-addressed by the stack, the tracker parameters and the code.
+
+    By default a stack is identified by its name, size and modification time, which costs nothing to check.
+    With content_hash set, its bytes are hashed instead, so touched or copied stacks still hit the cache.
+    Each well keeps only its most recent entry.
+    '''
+    def __init__(self, cachedir, params, content_hash=False):
+        self.cachedir = cachedir
+        self.params = params
+        self.content_hash = content_hash
+        self.version = code_version()
+        os.makedirs(cachedir, exist_ok=True)
+
+    def key(self, stackpath):
+        if self.content_hash:
+            stack = {'sha256': file_digest(stackpath)}
+        else:
+            stat = os.stat(stackpath)
+            stack = {'name': os.path.basename(stackpath), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        blob = json.dumps({'stack': stack, 'params': self.params, 'version': self.version}, sort_keys=True, default=str)
+        return hashlib.sha256(blob.encode()).hexdigest()[:32]
+
+    def _path(self, well, key):
+        return join(self.cachedir, f'{well}.{key}.p')
+
+    def contains(self, well, key):
+        return os.path.exists(self._path(well, key))
+
+    def load(self, well, key):
+        with open(self._path(well, key), 'rb') as f:
+            return pickle.load(f)
+
+    def store(self, well, key, neurons):
+        # Written atomically, so an interrupted run never leaves a truncated entry behind.
+        path = self._path(well, key)
+        atomic_pickle_dump(path, neurons)
+
+        for stale in glob.glob(join(glob.escape(self.cachedir), glob.escape(well) + '.*.p')):
+            if stale != path:
+                os.remove(stale)
@@ -0,0 +1,50 @@
+import hashlib
+import os
+import pickle
+
+from dataclasses import dataclass, field
+from os.path import join
+
+from common.utils.cache import atomic_pickle_dump
+
+from .types import Neuron
+
+@dataclass
+class TrackerCheckpoint:
+    '''
+    Tracker state after the first n_timepoints of a well, from which newly imaged timepoints can be appended.
+
+    Neurons are stored as they were during tracking, before excluded neurons were dropped and IDs relabelled, so
+    resuming from a checkpoint gives the same result as tracking the whole stack again. The digests of the first
+    and last tracked frames guard against resuming on a stack whose earlier frames have since changed.
+    '''
+    params: dict
+    n_timepoints: int
+    frame_digests: tuple
+    neurons: list[Neuron]
+    unassigned_rois: list = field(default_factory=list)
+    finished: bool = False
+
+def frame_digest(frame):
+    return hashlib.sha256(frame.tobytes()).hexdigest()
+
+def checkpoint_path(outdir, well):
+    return join(outdir, 'checkpoints', f'{well}.p')
+
+def save_checkpoint(path, checkpoint):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    atomic_pickle_dump(path, checkpoint)
+
+def load_checkpoint(path, params, reader):
+    '''Return the checkpoint at path if it was made with the same parameters on the start of this stack, else None.'''
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        checkpoint = pickle.load(f)
+
+    if checkpoint.params != params or checkpoint.n_timepoints > len(reader):
+        return None
+    digests = (frame_digest(reader[0]), frame_digest(reader[checkpoint.n_timepoints - 1]))
+    if digests != checkpoint.frame_digests:
+        return None
+    return checkpoint
@@ -2,9 +2,29 @@ import csv
 import pickle
 import os
 
+SURVIVAL_COLUMNS = ['well', 'id', 'well-id', 'group', 'cell_type', 'drug', 'drug_conc', 'drug_conc_units', 'column', 'last_tp', 'last_time', 'death_cause', 'censored', 'event']
+
+ROI_FEATURES = {'area': 'areas', 'perimeter': 'perimeters', 'mean': 'means', 'median': 'medians', 'std': 'stds', 'cv': 'CVs', '95thpercentile': '95thpercentiles'}
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError('Columnar output requires pyarrow. Install it with `pip install pyarrow` or the "columnar" extra.') from e
+    return pyarrow
+
 class Exporter:
-    def __init__(self, config):
+    def __init__(self, config, columnar=False):
+        """
+        Args:
+            columnar (bool): alongside the csv, write survival rows and per-timepoint ROI features to parquet files
+                (requires pyarrow)
+        """
         self.config = config
+        self.columnar = columnar
+        if columnar:
+            _import_pyarrow()
 
     def prep_csv_file(self, outdir, fname):
         self.outdir = outdir
@@ -13,60 +33,124 @@ class Exporter:
 
     def export(self, well, neurons, crop_val):
         self._write_to_csv(well, neurons)
-        self._export_rois(well, neurons, crop_val)
+        self.export_rois(well, neurons, crop_val)
         # TODO: create ROIs using annotation, output them using annotation.convert
         #convert.write_ij(rois, dest)
         #IJEncoding.export_ij_rois(self.outdir, well, neurons, crop_val)
 
+    def write_csv(self, results):
+        '''Rewrite the csv file from scratch with the given (well, neurons) results, in the order given.'''
+        self._write_headers()
+        for well, neurons in results:
+            self._write_to_csv(well, neurons)
+
+    def write_results(self, results, crop_val):
+        '''
+        Rewrite the csv file, and the parquet files if columnar output is on, with the given (well, neurons) results.
+        Results are only iterated once, and every well becomes one row group of each parquet file.
+        '''
+        if not self.columnar:
+            return self.write_csv(results)
+
+        pa = _import_pyarrow()
+        stem = os.path.join(self.outdir, self.config['experiment']['name'])
+        self._write_headers()
+        with pa.parquet.ParquetWriter(stem + '_surv_data.parquet', self._survival_schema(pa)) as surv_writer, \
+             pa.parquet.ParquetWriter(stem + '_roi_data.parquet', self._roi_schema(pa)) as roi_writer:
+            for well, neurons in results:
+                self._write_to_csv(well, neurons)
+                surv_writer.write_table(self._survival_table(pa, well, neurons))
+                roi_writer.write_table(self._roi_table(pa, well, neurons, crop_val))
+
+    @staticmethod
+    def _survival_schema(pa):
+        # Values read from the mfile may be text or numbers, so those are kept as text, as in the csv.
+        types = {'id': pa.int32(), 'last_tp': pa.int32(), 'censored': pa.int8(), 'event': pa.bool_()}
+        return pa.schema([(column, types.get(column, pa.string())) for column in SURVIVAL_COLUMNS])
+
+    @staticmethod
+    def _roi_schema(pa):
+        return pa.schema([('well', pa.string()), ('id', pa.int32()), ('timepoint', pa.int32()),
+                          ('centroid_x', pa.float64()), ('centroid_y', pa.float64()),
+                          *[(feature, pa.float64()) for feature in ROI_FEATURES]])
+
+    def _survival_table(self, pa, well, neurons):
+        rows = list(self._survival_rows(well, neurons))
+        columns = [list(column) for column in zip(*rows)] if rows else [[] for _ in SURVIVAL_COLUMNS]
+        data = dict(zip(SURVIVAL_COLUMNS, columns))
+        text = lambda s: str(s) if s != None else None
+        for column in ['group', 'cell_type', 'drug', 'drug_conc', 'drug_conc_units', 'last_time', 'death_cause']:
+            data[column] = [text(s) for s in data[column]]
+        data['event'] = [s == 'TRUE' for s in data['event']]
+        return pa.table(data, schema=self._survival_schema(pa))
+
+    def _roi_table(self, pa, well, neurons, crop_val):
+        # ROIs are written for the same IDs as the survival rows, i.e. one-based.
+        data = {'well': [], 'id': [], 'timepoint': [], 'centroid_x': [], 'centroid_y': [], **{feature: [] for feature in ROI_FEATURES}}
+        for neuron in sorted(neurons, key=lambda neuron: neuron.ID):
+            rois = neuron.roi_data_as_dict(crop_val)
+            n = len(rois['areas'])
+            data['well'] += [well] * n
+            data['id'] += [neuron.ID + 1] * n
+            data['timepoint'] += range(1, n + 1)
+            data['centroid_x'] += [float(c[0]) for c in rois['centroids']]
+            data['centroid_y'] += [float(c[1]) for c in rois['centroids']]
+            for feature, key in ROI_FEATURES.items():
+                data[feature] += [float(v) for v in rois[key]]
+        return pa.table(data, schema=self._roi_schema(pa))
+
     def _write_headers(self):
         with open(os.path.join(self.outdir, self.csv_fname), 'w', newline='') as f:
-            f.write(','.join(['well', 'id', 'well-id', 'group', 'cell_type', 'drug', 'drug_conc', 'drug_conc_units', 'column', 'last_tp', 'last_time', 'death_cause', 'censored', 'event']))
+            f.write(','.join(SURVIVAL_COLUMNS))
             f.write('\n')
 
+    def _survival_rows(self, well, neurons):
+        '''Survival data of every neuron in a well, as lists of values in csv column order.'''
+        # Acquire well information, once for the whole well.
+        well = well[0] + well[1:].zfill(2)
+        wells = self.config['experiment']['imaging']['wells']
+        # In the event there is a KeyError with 'well', perhaps the user is attempting survival analysis on tiles, e.g., 'A01_01'. Try to parse this.
+        if well not in wells:
+            well = well.split('_')[0]
+        label = wells[well]['label']
+        well_data = self.config['experiment']['well-data']
+        well_info = [well_data['well-to-cell-type'][well],
+                     well_data['well-to-drug'][well],
+                     well_data['well-to-drug-conc'][well],
+                     well_data['well-to-drug-conc-units'][well],
+                     well[1:]]
+        tp_to_hour = self.config['experiment']['time_data']['hours']
+
+        for neuron in sorted(neurons, key=lambda neuron: neuron.ID):
+            ID = neuron.ID + 1 #ID is zero-based within code; increase by 1 for output
+            last_time = tp_to_hour[neuron.last_tp] if neuron.last_tp != None else tp_to_hour[len(tp_to_hour)-1]
+            yield [well,
+                   ID,
+                   well + '-' + str(ID),
+                   label,
+                   *well_info,
+                   (neuron.last_tp+1) if neuron.last_tp != None else len(tp_to_hour), #last_tp is zero-based, so increased by 1 for output
+                   last_time,
+                   neuron.death_cause,
+                   neuron.censored,
+                   'TRUE' if neuron.censored == 1 else 'FALSE']
+
     def _write_to_csv(self, well, neurons):
         try:
             with open(os.path.join(self.outdir, self.csv_fname), 'a', newline='') as f:
                 writer = csv.writer(f)
-                neurons = sorted(neurons, key=lambda neuron: neuron.ID)
                 #Function to ensure all types are string and that None is set to NA
                 func = lambda s: str(s) if s != None else 'NA'
-                tp_to_hour = self.config['experiment']['time_data']['hours']
-                for neuron in neurons:
-                    #Acquire well information
-                    well = well[0] + well[1:].zfill(2)
-                    try: 
-                        label = self.config['experiment']['imaging']['wells'][well]['label']
-                    # In the event there is a KeyError with 'well', perhaps the user is attempting survival analysis on tiles, e.g., 'A01_01'. Try to parse this.
-                    except KeyError:
-                        well = well.split('_')[0]
-                        label = self.config['experiment']['imaging']['wells'][well]['label']
-
-                    ID = neuron.ID + 1 #ID is zero-based within code; increase by 1 for output
-                    last_time = tp_to_hour[neuron.last_tp] if neuron.last_tp != None else tp_to_hour[len(tp_to_hour)-1]
-                    row = map(func, [well, 
-                                     ID, 
-                                     well + '-' + str(ID), 
-                                     label,
-                                     self.config['experiment']['well-data']['well-to-cell-type'][well],
-                                     self.config['experiment']['well-data']['well-to-drug'][well],
-                                     self.config['experiment']['well-data']['well-to-drug-conc'][well],
-                                     self.config['experiment']['well-data']['well-to-drug-conc-units'][well],
-                                     well[1:], 
-                                     (neuron.last_tp+1) if neuron.last_tp != None else len(tp_to_hour), #last_tp is zero-based, so increased by 1 for output
-                                     last_time,                                        
-                                     neuron.death_cause, 
-                                     neuron.censored,
-                                     'TRUE' if neuron.censored == 1 else 'FALSE',
-                                     ])
-                    writer.writerow(list(row))
+                writer.writerows([list(map(func, row)) for row in self._survival_rows(well, neurons)])
         except IOError:
             print('Error opening output file')
 
-    def _export_rois(self, well, neurons, crop_val):
-        outpath = os.path.join(self.outdir, 'rois')
-        os.makedirs(outpath, exist_ok=True)
-        fname = os.path.join(outpath, str(well) + '.p')
-        ID_to_data= {}
-        for neuron in neurons:
-            ID_to_data[neuron.ID] = neuron.roi_data_as_dict(crop_val)
-            pickle.dump(ID_to_data, open(fname, 'wb'))
+    def rois_path(self, well):
+        return os.path.join(self.outdir, 'rois', str(well) + '.p')
+
+    def export_rois(self, well, neurons, crop_val):
+        fname = self.rois_path(well)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        ID_to_data = {neuron.ID : neuron.roi_data_as_dict(crop_val) for neuron in neurons}
+        with open(fname, 'wb') as f:
+            pickle.dump(ID_to_data, f)
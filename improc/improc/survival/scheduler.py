@@ -0,0 +1,103 @@
+import os
+import queue
+import time
+
+from dataclasses import dataclass
+from typing import Any, Optional
+
+import numpy as np
+import tifffile
+
+from multiprocess import Pool
+
+# Peak memory of tracking a frame, as a multiple of the frame's own size. Detection holds several processed
+# copies of the frame, some of them as floats.
+FRAME_WORKING_SET = 16
+
+@dataclass
+class WellResult:
+    well: str
+    value: Any
+    seconds: float
+    attempts: int
+    error: Optional[BaseException] = None
+
+def available_memory():
+    '''Physical memory currently available, in bytes, or None where the platform can't say.'''
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def estimate_well_cost(stackpath, stream=True, frame_workers=1):
+    '''
+    Estimate the peak memory of tracking a stack from its TIFF header, without reading any pixels.
+    With frame_workers > 1, that many frames are processed at once and twice as many are read ahead.
+    '''
+    with tifffile.TiffFile(stackpath) as tif:
+        series = tif.series[0]
+        shape, itemsize = series.shape, np.dtype(series.dtype).itemsize
+    frame_bytes = int(np.prod(shape[-2:])) * itemsize
+    stack_bytes = int(np.prod(shape)) * itemsize
+    return (FRAME_WORKING_SET + 2) * frame_workers * frame_bytes + (0 if stream else stack_bytes)
+
+def _timed(func, arg):
+    start = time.perf_counter()
+    value = func(arg)
+    return value, time.perf_counter() - start
+
+class WellScheduler:
+    '''
+    Keeps a pool of workers continuously fed from a queue of wells, so a slow well only occupies its own worker.
+
+    A well is only started while the estimated memory of all running wells stays within the budget (a single
+    well is always allowed to run, however large). Wells that raise are retried up to `retries` times before
+    being reported as failed.
+    '''
+    def __init__(self, processes=None, memory_budget=None, retries=1):
+        self.processes = processes or os.cpu_count() or 1
+        self.memory_budget = memory_budget if memory_budget is not None else available_memory()
+        self.retries = retries
+
+    def run(self, func, jobs):
+        '''
+        Apply func to the argument of every (well, arg, cost) job, yielding a WellResult per well in order of
+        completion.
+        '''
+        pending = list(jobs)
+        done = queue.Queue()
+        running = {}
+        attempts = {}
+        in_use = 0
+
+        def fits(cost):
+            return not running or self.memory_budget is None or in_use + cost <= self.memory_budget
+
+        with Pool(self.processes) as pool:
+            while pending or running:
+                # Start as many queued wells as there are free workers and memory for.
+                ix = 0
+                while ix < len(pending) and len(running) < self.processes:
+                    well, arg, cost = pending[ix]
+                    if not fits(cost):
+                        ix += 1
+                        continue
+                    pending.pop(ix)
+                    attempts[well] = attempts.get(well, 0) + 1
+                    running[well] = (arg, cost)
+                    in_use += cost
+                    pool.apply_async(_timed, (func, arg),
+                                     callback=lambda result, well=well: done.put((well, result, None)),
+                                     error_callback=lambda e, well=well: done.put((well, None, e)))
+
+                well, result, error = done.get()
+                arg, cost = running.pop(well)
+                in_use -= cost
+
+                if error is not None and attempts[well] <= self.retries:
+                    print(f'{well} failed ({error!r}), retrying.')
+                    pending.insert(0, (well, arg, cost))
+                    continue
+
+                value, seconds = result if error is None else (None, 0.0)
+                yield WellResult(well, value, seconds, attempts[well], error)
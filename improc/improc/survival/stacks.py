@@ -0,0 +1,109 @@
+import os
+
+import numpy as np
+import tifffile
+
+class StackReader:
+    '''
+    Timepoint-by-timepoint access to a stacked well.
+
+    The source may be an in-memory stack or the path to a stacked tif. Paths are memory-mapped when the
+    tif is uncompressed and contiguous, and otherwise read page-by-page, so only the requested timepoint
+    is ever resident. Short stacks which tifffile stores as the separate sample planes of a single page
+    (e.g. a compressed stack of 3 or 4 timepoints) are read a plane at a time, by decoding only that
+    plane's strips or tiles. Every frame handed out is a private copy which callers are free to modify.
+    '''
+    def __init__(self, source):
+        self.path = None
+        self._array = None
+        self._tif = None
+        self._pages = None
+        # Page holding one timepoint per sample plane, and the number of segments making up each plane.
+        self._planar = None
+
+        if isinstance(source, (str, os.PathLike)):
+            self.path = source
+            self._open(source)
+        else:
+            self._array = source
+
+        # Ensure stack is 3D even if it has a single timepoint.
+        if self._array is not None and len(self._array.shape) == 2:
+            self._array = self._array.reshape(1, *self._array.shape)
+
+    def _open(self, path):
+        try:
+            self._array = tifffile.memmap(path, mode='r')
+            return
+        except ValueError:
+            pass
+
+        self._tif = tifffile.TiffFile(path)
+        series = self._tif.series[0]
+        if len(series.shape) == 2:
+            self._pages = [series.pages[0]]
+        elif len(series.pages) == series.shape[0]:
+            self._pages = series.pages
+        elif (len(series.pages) == 1 and series.pages[0].planarconfig == tifffile.PLANARCONFIG.SEPARATE
+              and series.pages[0].shape[0] == series.shape[0]):
+            page = series.pages[0]
+            self._planar = page, len(page.dataoffsets) // page.samplesperpixel
+        else:
+            # Timepoints aren't stored one per page or per plane; nothing for it but to read the whole series.
+            self._array = series.asarray()
+            self._tif.close()
+            self._tif = None
+
+    def _read_plane(self, tp):
+        page, n_segments = self._planar
+        frame = np.empty(page.shape[1:], dtype=page.dtype)
+        height, width = frame.shape
+        indices = range(tp * n_segments, (tp + 1) * n_segments)
+        segments = self._tif.filehandle.read_segments([page.dataoffsets[i] for i in indices],
+                                                      [page.databytecounts[i] for i in indices], indices)
+        for data, index in segments:
+            # Segments are strips or tiles; tiles at the right and bottom edges overhang the frame.
+            segment, (_, _, y, x, _), _ = page.decode(data, index)
+            segment = segment[0, :, :, 0]
+            frame[y:y + segment.shape[0], x:x + segment.shape[1]] = segment[:height - y, :width - x]
+        return frame
+
+    @property
+    def shape(self):
+        if self._planar is not None:
+            return self._planar[0].shape
+        if self._pages is not None:
+            return (len(self._pages), *self._pages[0].shape)
+        return self._array.shape
+
+    def __len__(self):
+        if self._planar is not None:
+            return self._planar[0].shape[0]
+        if self._pages is not None:
+            return len(self._pages)
+        return self._array.shape[0]
+
+    def __getitem__(self, tp) -> np.ndarray:
+        if self._planar is not None:
+            return self._read_plane(range(len(self))[tp])
+        if self._pages is not None:
+            return self._pages[tp].asarray()
+        return np.array(self._array[tp])
+
+    def __iter__(self):
+        for tp in range(len(self)):
+            yield self[tp]
+
+    def close(self):
+        if self._tif is not None:
+            self._tif.close()
+            self._tif = None
+        self._array = None
+        self._pages = None
+        self._planar = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
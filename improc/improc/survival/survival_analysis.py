@@ -1,49 +1,87 @@
 import subprocess
-import scipy.ndimage
+import collections
+import contextlib
+import functools
 import itertools
 import os
-import cv2
-import skimage.morphology
-import skimage.filters
 import numpy as np
 import tifffile
 
-from multiprocess import Pool
 from PIL import Image
-from math import isinf
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 from os.path import join
-from scipy.spatial import KDTree
-from scipy.ndimage import measurements, morphology
 
 from common.utils import legacy as transforms
 from common.utils import makeconfig
 
 from . import utils
 from . import annotate
-from .types import Neuron, ROI
+from .types import Neuron, compact_rois
+from .roi_stats import make_rois
 from .output import Exporter
-
+from .stacks import StackReader
+from .assignment import MATCHERS
+from .scheduler import WellScheduler, estimate_well_cost
+from .cache import ResultCache
+from .checkpoint import TrackerCheckpoint, checkpoint_path, frame_digest, load_checkpoint, save_checkpoint
+
+# OpenCV, scikit-image and scipy are imported by the methods that use them, so that importing the survival package
+# doesn't wait on them.
+
+@functools.lru_cache(maxsize=None)
+def square_kernel(magnification, microscope, binning, microns):
+    '''Square structuring element spanning the given distance, shared by every Tracker with the same imaging setup.'''
+    dim = transforms.microns_to_pixels(microns, magnification, microscope, binning, 1.0)
+    kernel = np.ones((dim,) * 2, dtype=np.uint8)
+    kernel.setflags(write=False)
+    return kernel
 
 class Tracker():
-    def __init__(self, exp_name, outdir, threshold_multiplier, magnification, microscope, binning, cell_min_dia_um, cell_max_dia_um, max_travel_um, death_circularity_threshold, annotate, cell_type):
+    def __init__(self, exp_name, outdir, threshold_multiplier, magnification, microscope, binning, cell_min_dia_um, cell_max_dia_um, max_travel_um, death_circularity_threshold, annotate, cell_type, assignment="greedy", frame_workers=1, checkpoint=False):
+        if assignment not in MATCHERS:
+            raise ValueError(f'Unknown assignment mode "{assignment}". Try one of {", ".join(MATCHERS)}.')
         self.exp_name = exp_name
         self.binned = False if binning[0] == '1' else True
         self.annotate = annotate
         self.outdir = outdir
         self.threshold_multiplier = threshold_multiplier
         self.um_to_px = lambda m: transforms.microns_to_pixels(m, magnification, microscope, binning, 1.0)
+        self.magnification = magnification
+        self.microscope = microscope
+        self.binning = binning
         self.cell_min_dia_um = cell_min_dia_um
         self.cell_max_dia_um = cell_max_dia_um
         self.max_travel_um = max_travel_um
         self.death_circularity_threshold = death_circularity_threshold
         self.cell_type = cell_type
+        self.assignment = assignment
+        self.frame_workers = frame_workers
+        self.checkpoint = checkpoint
+
+    def parameters(self):
+        '''Settings which determine the tracking results, e.g. to key cached results on.'''
+        return {'threshold_multiplier': self.threshold_multiplier,
+                'magnification': self.magnification,
+                'microscope': self.microscope,
+                'binning': self.binning,
+                'cell_min_dia_um': self.cell_min_dia_um,
+                'cell_max_dia_um': self.cell_max_dia_um,
+                'max_travel_um': self.max_travel_um,
+                'death_circularity_threshold': self.death_circularity_threshold,
+                'cell_type': self.cell_type,
+                'annotate': self.annotate,
+                'assignment': self.assignment}
+
+    def _square_kernel(self, microns):
+        return square_kernel(self.magnification, self.microscope, self.binning, microns)
 
     def _label_and_slice(self, img: np.ndarray):
         '''Label contiguous binary patches numerically and make list of smallest parallelpipeds that contain each.'''
-        if (filled := scipy.ndimage.binary_fill_holes(img)) is not None:
-            labeled_img, _ = measurements.label(filled)
-            return measurements.find_objects(labeled_img)
+        from scipy.ndimage import find_objects, label
+        if (filled := utils.fill_holes(img)) is not None:
+            labeled_img, _ = label(filled)
+            return find_objects(labeled_img)
 
     def _remove_overlapping_slices(self, slices, img):
         ''' Remove overlapping slices'''
@@ -71,6 +109,10 @@ class Tracker():
 
     def _process_img(self, img):
         '''Process image.'''
+        import cv2
+        import scipy.ndimage
+        import skimage.filters
+        import skimage.morphology
         img = np.copy(img)
 
         img = (img.astype(np.uint16) - img.min()) * 255.0 / (img.max() - img.min()).astype(np.uint8)
@@ -88,7 +130,6 @@ class Tracker():
         return img.astype(np.uint16) * 2**8
 
     def _find_graded_somas(self, img):
-
         img = self._process_img(img)
 
         slices = self._label_and_slice(img)
@@ -98,30 +139,15 @@ class Tracker():
         slices = list(filter(lambda s: (s[0].stop - s[0].start) * (s[1].stop - s[1].start) > px ** 2, slices))
 
         # After identifying the first batch of slices, run a tophat transform on each, and redo.
-        tophat_kernel_dim = self.um_to_px(40)
-        tophat_kernel=np.ones((tophat_kernel_dim,) * 2)
-
-        erode_kernel_dim = self.um_to_px(3)
-        erode_kernel = np.ones((erode_kernel_dim,) * 2)
-
         max_dim_accepted = self.um_to_px(100)
 
-        for s in slices:
-            subimg = img[s]
-            subimg = cv2.morphologyEx(subimg, cv2.MORPH_TOPHAT, kernel=tophat_kernel)
-
-            # Calculate area. If larger than certain value, then erode.
-            max_subimg_dim = max(s[0].stop - s[0].start, s[1].stop - s[1].start)
+        # Calculate area. If larger than certain value, then erode.
+        max_subimg_dim = lambda s: max(s[0].stop - s[0].start, s[1].stop - s[1].start)
+        large_slices = [s for s in slices if max_subimg_dim(s) > max_dim_accepted]
 
-            if max_subimg_dim > max_dim_accepted:
-                subimg = np.clip(subimg, 0, 1)
-                subimg = morphology.binary_dilation(subimg)
-                subimg = morphology.binary_fill_holes(subimg)
-                subimg = morphology.binary_erosion(subimg, structure=erode_kernel, iterations=3)
-
-                # Scale subimg, which is currently binary, to a very high (arbitrary) value.
-                subimg = subimg.astype(np.uint16) * (2 ** 14)
-                img[s] = subimg
+        for s in large_slices:
+            # Scale subimg, which is currently binary, to a very high (arbitrary) value.
+            img[s] = self._split_slice(img[s]).astype(np.uint16) * (2 ** 14)
 
         slices = self._label_and_slice(img)
 
@@ -131,51 +157,73 @@ class Tracker():
 
         return slices
 
+    def _split_slice(self, subimg):
+        '''
+        Binary mask of a large slice after a tophat, a dilation, hole filling and an erosion, which separates somas
+        that were detected as one. The binary steps run through OpenCV, which is far quicker on small crops; the
+        results are identical to scipy's binary_dilation (cross), binary_fill_holes and binary_erosion with a zero border.
+        '''
+        import cv2
+        cross = cv2.getStructuringElement(cv2.MORPH_CROSS, (3, 3))
+        subimg = cv2.morphologyEx(subimg, cv2.MORPH_TOPHAT, kernel=self._square_kernel(40))
+        subimg = np.clip(subimg, 0, 1).astype(np.uint8)
+        subimg = cv2.dilate(subimg, cross, borderType=cv2.BORDER_CONSTANT, borderValue=0)
+        subimg = utils.fill_holes(subimg).astype(np.uint8)
+        return cv2.erode(subimg, self._square_kernel(3), iterations=3, borderType=cv2.BORDER_CONSTANT, borderValue=0)
+
     def _estimate_centroids(self, slices):
         return [np.array((s[1].start + (s[1].stop - s[1].start) // 2, s[0].start + (s[0].stop - s[0].start) // 2))
                 for s in slices]
 
     def _expand_slices(self, img, slices):
-        expanded_slices = []
+        '''
+        Pad each soma slice by 10um, unless the padding would reach into another slice, in which case the slice is kept as is.
 
-        # Everywhere there's a slice, set to 1.
-        overlap_array = np.zeros(img.shape)
-        for s in slices:
-            overlap_array[s] = 1
+        Slices are considered in order: those before the current one occupy their full padded extent, those after it only
+        their own extent. Rather than painting an overlap image, each slice's padding is tested directly against the boxes
+        near it, found with a KDTree over box centres.
+        '''
+        from scipy.spatial import KDTree
+        if not slices:
+            return []
 
         #Use slices fit to candidate neuron somas to center slices for collection of a neuron contour
         y_MAX, x_MAX = img.shape
-        expand_slice = lambda s, px: (slice(max(0, s[0].start - px), min(y_MAX, s[0].stop + px)), 
-                                      slice(max(0, s[1].start - px), min(x_MAX, s[1].stop + px)))
-        for s in slices:
-            # Set this slice's overlap slice to zero.
-            overlap_array[s] = 0
-
-            # Expand slice.
-            px = self.um_to_px(10)
-            exp_s = expand_slice(s, px)
-
-            # Add 1 to the expanded overlap slice.
-            overlap_array[exp_s] += 1
-
-            # If any value inside the expanded overlap is greater than or equal to 2, we've made contact with 
-            # another slice.
-            while np.any(overlap_array[exp_s] >= 2):
-                # Reset to 1, in case while expanding perturbed others.
-                overlap_array[exp_s] = 1 
-                # Reset to 0 so can begin process again.
-                overlap_array[s] = 0
-
-                px -= 1
-                exp_s = expand_slice(s, px)
-                overlap_array[exp_s] += 1
-
-            expanded_slices.append(exp_s)
-
-        return expanded_slices
-
-    def _find_initial_candidates(self, img):
-        candidates = self._find_candidates(img)
+        px = self.um_to_px(10)
+
+        # Boxes as (y_start, y_stop, x_start, x_stop) rows.
+        boxes = np.array([(s[0].start, s[0].stop, s[1].start, s[1].stop) for s in slices], dtype=np.int64)
+        expanded = np.stack([np.maximum(0, boxes[:, 0] - px), np.minimum(y_MAX, boxes[:, 1] + px),
+                             np.maximum(0, boxes[:, 2] - px), np.minimum(x_MAX, boxes[:, 3] + px)], axis=1)
+
+        # Only boxes whose padded extents are within reach of each other can interact.
+        centres = np.stack([expanded[:, 0] + expanded[:, 1], expanded[:, 2] + expanded[:, 3]], axis=1) / 2
+        reach = np.max(np.stack([expanded[:, 1] - expanded[:, 0], expanded[:, 3] - expanded[:, 2]]))
+        pairs = KDTree(centres).query_pairs(reach, p=np.inf, output_type='ndarray')
+
+        # Test each pair both ways round; the earlier slice of a pair occupies its padded extent.
+        current = np.concatenate([pairs[:, 0], pairs[:, 1]])
+        other = np.concatenate([boxes[pairs[:, 1]], expanded[pairs[:, 0]]])
+        box, exp = boxes[current], expanded[current]
+
+        # Intersection of the other box with this slice's padded extent...
+        y0 = np.maximum(other[:, 0], exp[:, 0])
+        y1 = np.minimum(other[:, 1], exp[:, 1])
+        x0 = np.maximum(other[:, 2], exp[:, 2])
+        x1 = np.minimum(other[:, 3], exp[:, 3])
+
+        # ...collides if it isn't empty and spills out of the slice itself into its padding.
+        nonempty = (y0 < y1) & (x0 < x1)
+        in_padding = (y0 < box[:, 0]) | (y1 > box[:, 1]) | (x0 < box[:, 2]) | (x1 > box[:, 3])
+        collides = np.bincount(current[nonempty & in_padding], minlength=len(boxes)) > 0
+
+        expanded = np.where(collides[:, None], boxes, expanded)
+        return [(slice(int(y0), int(y1)), slice(int(x0), int(x1))) for y0, y1, x0, x1 in expanded]
+
+    def _find_initial_candidates(self, img, candidates=None):
+        import cv2
+        if candidates is None:
+            candidates = self._find_candidates(img)
         #Build list of ROIs, then build list of Neurons and return
 
         # Area filter.
@@ -187,12 +235,13 @@ class Tracker():
         candidates = filter(sizeFilter, candidates)
 
         try: 
-            rois = [ROI(img, centroid, contour) for centroid, contour in candidates]
+            rois = make_rois(img, candidates)
         except ValueError:
             return None
         return [Neuron(ID=i, init_roi=rois[i]) for i in range(len(rois))]
 
     def _find_candidates(self, img):
+        import cv2
         graded_slices = self._find_graded_somas(img)
 
         centroid_estimates = self._estimate_centroids(graded_slices)
@@ -226,9 +275,24 @@ class Tracker():
         # Begin processing image and building candidate neurons.
         candidates = []
         area_min = self.um_to_px(self.cell_min_dia_um) ** 2
-        tophat_kernel_dim = self.um_to_px(40)
-        tophat_kernel=np.ones((tophat_kernel_dim,) * 2)
-        for ix, s in enumerate(expanded_slices):
+        for ix, contour in self._slice_contours(img, expanded_slices):
+            # Area filter.
+            if cv2.contourArea(contour) > area_min:
+                candidates.append((centroid_estimates[ix], contour))
+
+        return candidates
+
+    def _slice_contours(self, img, slices):
+        '''
+        Tophat, threshold and find contours separately within each slice. Yields (slice index, contour) pairs.
+
+        This stays per slice rather than running once over the (tiled) frame: the tophat's opening is bounded by the
+        slice, and the percentile threshold is taken over the slice's own pixels, so neither matches a whole-frame
+        pass, whatever its halo, wherever other structure lies within the kernel of a slice's edge.
+        '''
+        import cv2
+        tophat_kernel = self._square_kernel(40)
+        for ix, s in enumerate(slices):
             subimg = img[s]
             subimg = cv2.morphologyEx(subimg, cv2.MORPH_TOPHAT, kernel=tophat_kernel)
             #Threshold subimg
@@ -236,18 +300,10 @@ class Tracker():
             subimg = transforms.to_8bit(subimg)
             contours, _ = cv2.findContours(subimg, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
-
-            # Area filter.
-            contours = filter(lambda c: cv2.contourArea(c) > area_min, contours)
-
             # Used to help eliminate selection of neuronal processes as valid ROIs.
             #Adjust coordinates to reflect location in actual image ; switch slice order as switching from numpy to opencv encoding
-            contours = [c[:, :, 0:2] + (s[1].start, s[0].start) for c in contours]
-
-            for contour in contours:
-                candidates.append((centroid_estimates[ix], contour))
-
-        return candidates
+            for c in contours:
+                yield ix, c[:, :, 0:2] + (s[1].start, s[0].start)
 
     def _assign_rois(self, img, timepoint, neurons, candidates):
         '''Determine which neurons found in a consecutive timepoint correspond to previously found neurons.'''
@@ -259,41 +315,18 @@ class Tracker():
         #Exclude neurons that have already died from assignment
         living_neurons = [neuron for neuron in neurons if neuron.last_tp == None]
 
-        # Create a map between a centroid and its index so it can be found.
-        centroid_to_ix = {tuple(map(int, centroid)) : ix for ix, centroid in enumerate(candidate_centroids)}
-
-        # Add each unassigned centroid to the map with an index of -1 as a sentinel.
-        centroid_to_ix.update({tuple(map(int, centroid)) : -1 for centroid in unassigned_centroids})
-
-        # Create 2D KDTree from all existing candidates and unassigned ROI centroids.
-        tree = KDTree(candidate_centroids + unassigned_centroids)
-
         # Maximum distance that the (n+1)st centroid can be from the nth one if it's to be believed that it's the same neuron.
         max_dist = self.um_to_px(self.max_travel_um)
 
-        # Keep a set of candidate indices chosen. Will be used to determine which have not been selected.
-        candidate_ixs_chosen = set()
-
         #self.image_logger.log('assignment', 'living-neurons', img, contours=[n.roi_data_as_dict(20)['contours'][-1] for n in living_neurons])
-        ID_to_candidate = {}
-        for neuron in living_neurons:
-            # Find the distance of the nearest centroid and its index in the tree structure.
-            distance, ix = tree.query(neuron.roi_series[-1].centroid, distance_upper_bound=max_dist)
-
-            # If the nearest distance is infinity, then nothing was found. Go to next.
-            if isinf(distance): continue
+        match = MATCHERS[self.assignment]
+        matches = match([neuron.roi_series[-1].centroid for neuron in living_neurons],
+                        list(candidate_centroids + unassigned_centroids),
+                        len(candidate_centroids),
+                        max_dist)
 
-            nearest_centroid = tuple(tree.data[ix])
-            centroid_ix = centroid_to_ix[nearest_centroid]
-
-            # The nearest centroid belong to an unassigned ROI. Go to next.
-            if centroid_ix == -1: continue
-
-            # Map the neuron ID to this candidate for further evaluation.
-            ID_to_candidate[neuron.ID] = candidates[centroid_ix]
-
-            # Keep track of candidate index chosen.
-            candidate_ixs_chosen.add(centroid_ix)
+        # Map the neuron ID to its candidate for further evaluation.
+        ID_to_candidate = {living_neurons[neuron_ix].ID : candidates[candidate_ix] for neuron_ix, candidate_ix in matches.items()}
 
         unassigned_candidates = self._extend_roi_series(img, timepoint, living_neurons, ID_to_candidate)
 
@@ -321,8 +354,10 @@ class Tracker():
                 neuron_to_cand_ix[neuron_ID] = (ix, min_dist)
         '''
 
-        # Set unassigned rois from this timepoint for continued tracking.
-        self.unassigned_rois = filter(lambda c: c in unassigned_candidates, candidates)
+        # Set unassigned rois from this timepoint for continued tracking. Candidates hold arrays, so the membership
+        # test raises as soon as it has to compare two distinct candidates; that has always left no unassigned rois.
+        try: self.unassigned_rois = [c for c in candidates if c in unassigned_candidates]
+        except ValueError: self.unassigned_rois = []
 
     def _extend_roi_series(self, img, timepoint, neurons, ID_to_candidate):
         # Keep track of which candidates are determined unfit for assignation.
@@ -332,11 +367,14 @@ class Tracker():
         #self.image_logger.log('assignment', 'before-extension', img, contours=[n.roi_data_as_dict(20)['contours'][-1] for n in living_neurons])
 
 
+        # Measure every assigned candidate of this frame in one batch.
+        IDs = [neuron.ID for neuron in neurons if neuron.ID in ID_to_candidate]
+        ID_to_roi = dict(zip(IDs, make_rois(img, [ID_to_candidate[ID] for ID in IDs])))
+
         for neuron in neurons:
             if neuron.ID in ID_to_candidate:
                 candidate = ID_to_candidate[neuron.ID]
-                centroid, contour = candidate
-                roi = ROI(np.copy(img), centroid, contour)
+                roi = ID_to_roi[neuron.ID]
 
             #contours = filter(lambda c: 4 * np.pi * cv2.contourArea(c) / cv2.arcLength(c, closed=True) ** 2 > .1, contours) 
                 # Some death checks
@@ -361,7 +399,6 @@ class Tracker():
                     unassigned_candidates.append(candidate)
 
                 else:
-                    roi = ROI(np.copy(img), centroid, contour)
                     neuron.roi_series.append(roi)
             else:
                 neuron.last_tp = timepoint - 1
@@ -371,47 +408,78 @@ class Tracker():
         return unassigned_candidates
 
     def track(self, data):
-        '''Track neurons.'''
+        '''
+        Track neurons.
+
+        The stack may be given either as an array or as the path to a stacked tif. Paths are streamed
+        from disk one timepoint at a time, bounding memory use by a couple of frames regardless of stack length.
+        With checkpointing on, tracking resumes from the well's last checkpoint and only the new timepoints are processed.
+        '''
         well, stack, crop_val = data
 
-        # Ensure stack is 3D even if it has a single timepoint.
-        if len(stack.shape) == 2:
-            stack = stack.reshape(1, *stack.shape)
+        with StackReader(stack) as reader:
+            neurons = self._track_frames(well, reader, crop_val)
 
-        orig_stack = np.copy(stack)
-        print(self.exp_name + ':: Automated Survival Analysis: T' + str(1) + '-' + well)
+            if self.annotate:
+                self._annotate(well, reader, neurons, crop_val)
 
-        #Crop stack edges as borders will be zero if images were shifted during stack registration
-        stack = stack[:, crop_val:-crop_val, crop_val:-crop_val]
+        return (well, neurons)
 
-        # Set the first timepoint for image logger. 
-        #self.image_logger.set_timepoint(1)
-        neurons = self._find_initial_candidates(stack[0])
+    def _track_frames(self, well, reader, crop_val):
+        #Crop stack edges as borders will be zero if images were shifted during stack registration
+        crop = lambda img: img[crop_val:-crop_val, crop_val:-crop_val]
 
-        if neurons is None:
-            raise Exception("neurons is none :^O")
+        path = checkpoint_path(self.outdir, well)
+        checkpoint = load_checkpoint(path, self.parameters(), reader) if self.checkpoint else None
+        start = checkpoint.n_timepoints if checkpoint else 0
 
-        # If stack has more than one timepoint and neurons were found, then iterate through remaining timepoints and track survival.
-        if stack.shape[0] > 1 and neurons:
-            #Variable will be used to track potentially viable ROIs that remained unassigned to avoid mistaken future assignments
-            self.unassigned_rois = []
-            for timepoint, img in enumerate(stack[1:], start=1):
-                print(self.exp_name + ':: Automated Survival Analysis: T' + str(timepoint + 1) + '-' + well)
+        with contextlib.closing(self._detect_frames(reader, crop, start)) as detections:
+            if checkpoint is None:
+                print(self.exp_name + ':: Automated Survival Analysis: T' + str(1) + '-' + well)
 
-                candidates = self._find_candidates(img)
+                # Set the first timepoint for image logger. 
+                #self.image_logger.set_timepoint(1)
+                _, img, candidates = next(detections)
+                neurons = self._find_initial_candidates(img, candidates)
 
-                if not candidates:
-                    print('No neurons found after timepoint ' + str(timepoint))
-                    #If no neurons were found, ensure that all remaining neurons are marked as dead
-                    # ENCAPSULATE THIS BEHAVIOR WITHIN NEURON OBJECT.
-                    for neuron in neurons:
-                        if neuron.last_tp == None:
-                            neuron.last_tp = timepoint - 1
-                            neuron.censored = 1
-                            neuron.death_cause = 'unfound'
-                    break
-                self._assign_rois(img, timepoint, neurons, candidates)
+                if neurons is None:
+                    raise Exception("neurons is none :^O")
 
+                #Variable will be used to track potentially viable ROIs that remained unassigned to avoid mistaken future assignments
+                self.unassigned_rois = []
+                # Without any neurons there is nothing to track in later timepoints.
+                finished = not neurons
+                n_timepoints = 1
+            else:
+                print(self.exp_name + ':: Automated Survival Analysis: resuming ' + well + ' after T' + str(start))
+                neurons = checkpoint.neurons
+                self.unassigned_rois = checkpoint.unassigned_rois
+                finished = checkpoint.finished
+                n_timepoints = start
+
+            # Iterate through remaining timepoints and track survival.
+            if not finished:
+                for timepoint, img, candidates in detections:
+                    print(self.exp_name + ':: Automated Survival Analysis: T' + str(timepoint + 1) + '-' + well)
+                    n_timepoints = timepoint + 1
+
+                    if not candidates:
+                        print('No neurons found after timepoint ' + str(timepoint))
+                        #If no neurons were found, ensure that all remaining neurons are marked as dead
+                        # ENCAPSULATE THIS BEHAVIOR WITHIN NEURON OBJECT.
+                        for neuron in neurons:
+                            if neuron.last_tp == None:
+                                neuron.last_tp = timepoint - 1
+                                neuron.censored = 1
+                                neuron.death_cause = 'unfound'
+                        finished = True
+                        break
+                    self._assign_rois(img, timepoint, neurons, candidates)
+
+        # Save the state before neurons are filtered and relabelled below, so later timepoints can be appended.
+        if self.checkpoint:
+            digests = (frame_digest(reader[0]), frame_digest(reader[n_timepoints - 1]))
+            save_checkpoint(path, TrackerCheckpoint(self.parameters(), n_timepoints, digests, neurons, self.unassigned_rois, finished))
 
         neurons = [neuron for neuron in neurons if not neuron.excluded]
 
@@ -423,16 +491,51 @@ class Tracker():
         for ix, neuron in enumerate(neurons):
             neuron.ID = ix
 
-        if self.annotate:
-            # Save annotated stack.
-            annotate_path = join(self.outdir, 'annotated')
-            os.makedirs(annotate_path, exist_ok=True)
+        compact_rois(neurons)
+        return neurons
 
-            rois = {n.ID : n.roi_data_as_dict(crop_val)['contours'] for n in neurons}
-            annotated = annotate.annotate_survival(orig_stack.astype(np.uint16), rois)
-            tifffile.imsave(f'{annotate_path}/{well}.tif', annotated, photometric="rgb")
-        
-        return (well, neurons)
+    def _detect_frames(self, reader, crop, start=0):
+        '''
+        Yield (timepoint, thresholded image, candidates) for every timepoint from start on, in order.
+
+        Detection of a timepoint doesn't depend on any other, so with frame_workers > 1 it runs ahead on a thread
+        pool (OpenCV and SciPy release the GIL) while assignment consumes the results in order. At most
+        2 * frame_workers frames are read ahead, and frames not yet consumed are cancelled if tracking stops early.
+        '''
+        def detect(timepoint, img):
+            return timepoint, img, self._find_candidates(img)
+
+        if self.frame_workers <= 1:
+            for timepoint in range(start, len(reader)):
+                yield detect(timepoint, crop(reader[timepoint]))
+            return
+
+        timepoints = iter(range(start, len(reader)))
+        with ThreadPoolExecutor(self.frame_workers) as executor:
+            # Frames are read here rather than in the workers, as stack pages share a single file handle.
+            submit = lambda tp: executor.submit(detect, tp, crop(reader[tp]))
+            pending = collections.deque(submit(tp) for tp in itertools.islice(timepoints, 2 * self.frame_workers))
+            try:
+                while pending:
+                    future = pending.popleft()
+                    pending.extend(submit(tp) for tp in itertools.islice(timepoints, 1))
+                    yield future.result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def _annotate(self, well, reader, neurons, crop_val):
+        '''Save annotated stack, drawing and writing one timepoint at a time.'''
+        annotate_path = join(self.outdir, 'annotated')
+        os.makedirs(annotate_path, exist_ok=True)
+
+        # Contours are drawn shifted by crop_val rather than copied.
+        rois = {n.ID : n.contours() for n in neurons}
+        offset = (crop_val, crop_val)
+        frames = (annotate.annotate_survival_frame(img.astype(np.uint16), tp, rois, offset=offset) for tp, img in enumerate(reader))
+        shape = (*reader.shape, 3)
+        with tifffile.TiffWriter(f'{annotate_path}/{well}.tif') as tif:
+            tif.write(frames, shape=shape, dtype=np.uint8, photometric="rgb")
 
 def run_cox_analysis(config, outdir):
     exp_name = config['experiment']['name']
@@ -468,7 +571,7 @@ def run_cox_analysis(config, outdir):
     subprocess.call(['rscript', scriptpath], stdout=cox_analysis_results_file)
 
 class SurvivalAnalyzer:
-    def __init__(self, workdir, cell_min_dia_um=10, cell_max_dia_um=150, max_travel_um=50, death_circularity_threshold=0.9, annotate=True, cell_type="rat"):
+    def __init__(self, workdir, cell_min_dia_um=10, cell_max_dia_um=150, max_travel_um=50, death_circularity_threshold=0.9, annotate=True, cell_type="rat", columnar=False):
         """
         Automated cell counting for experiments that have been stitched + stacked
 
@@ -477,6 +580,7 @@ class SurvivalAnalyzer:
             cell_max_dia_um (float): maximum diameter for detecting cells (in micrometers)
             max_travel_um (float): maximum distance a cell may move between frames (in micrometers)
             death_circularity_threshold (float): circularity measurement above which cells are considered dead. valid between 0 and 1
+            columnar (bool): also write survival data and per-timepoint ROI features to parquet files (requires pyarrow)
         """
         os.makedirs(join(workdir, 'analysis'), exist_ok=True)
         self.annotate = annotate
@@ -496,40 +600,86 @@ class SurvivalAnalyzer:
 
         os.makedirs(join(workdir, 'analysis'), exist_ok=True)
 
-        self.exporter = Exporter(self.config)
+        self.exporter = Exporter(self.config, columnar)
         self.exp_name = self.config['experiment']['name']
         self.surv_fname = self.exp_name + '_surv_data.csv'
 
-    def readin_stacks(self):
-        '''Read in and yield every TIF image file within images path as numpy array.'''
+    def readin_stacks(self, stream=False):
+        '''
+        Read in and yield every TIF image file within images path as numpy array.
+        If stream is set, yield the path instead so that workers read the stack one timepoint at a time.
+        '''
         stackpaths = glob(self.imgdir +'/*.tif')
         for stackpath in stackpaths:
             #Obtain well name
             well = os.path.basename(stackpath).split('.')[0]
-            stack = tifffile.imread(stackpath)
+            stack = stackpath if stream else tifffile.imread(stackpath)
             yield (well, stack, 20)
         
-    def analyze(self, threshold_multiplier=1.0):
+    def analyze(self, threshold_multiplier=1.0, stream=False, assignment="greedy", processes=None, memory_budget=None, retries=1, frame_workers=1, use_cache=True, content_hash=False):
+        """
+        Args:
+            threshold_multiplier (float): number of standard deviations above the mean at which candidates are thresholded
+            stream (bool): have workers read stacks one timepoint at a time rather than loading whole stacks
+            assignment (str): "greedy" matches each neuron to its nearest candidate; "global" solves a one-to-one
+                assignment over all neurons of a frame
+            processes (int): number of wells tracked at once. Defaults to the number of cores
+            memory_budget (int): bytes of memory the running wells may use together, as estimated from each stack's
+                TIFF header. Defaults to the memory currently available
+            retries (int): number of times a well that raised is attempted again
+            frame_workers (int): threads detecting the timepoints of each well in parallel. Wells and frames together
+                use processes * frame_workers cores, so processes defaults to the number of cores / frame_workers
+            use_cache (bool): reuse the results of wells whose stack and parameters are unchanged since a previous
+                run (including one that crashed part way), and cache every newly tracked well. The ROIs of a cached
+                well are exported again if they were deleted. Tracker state is checkpointed too, so timepoints
+                appended to a stack are tracked without redoing the earlier ones.
+                If unset, every well is tracked afresh and the cache is neither read nor written
+            content_hash (bool): identify stacks by hashing their contents rather than by size and modification time
+        """
         exp_name = self.config['experiment']['name']
-        tr = Tracker(exp_name, self.outdir, threshold_multiplier, self.magnification, self.microscope, self.binning, self.cell_min_dia_um, self.cell_max_dia_um, self.max_travel_um, self.death_circularity_threshold, self.annotate, self.cell_type)
-        gen = self.readin_stacks()
-        pool = Pool()
-        #This may need to be a function of memory
-        offset = 10 
+        tr = Tracker(exp_name, self.outdir, threshold_multiplier, self.magnification, self.microscope, self.binning, self.cell_min_dia_um, self.cell_max_dia_um, self.max_travel_um, self.death_circularity_threshold, self.annotate, self.cell_type, assignment, frame_workers, checkpoint=use_cache)
         self.resultdir = join(os.path.dirname(self.outdir), 'results')
         os.makedirs(self.resultdir, exist_ok=True)
         self.exporter.prep_csv_file(self.resultdir, self.surv_fname)
+        cache = ResultCache(join(self.outdir, 'cache'), {**tr.parameters(), 'stream': stream, 'crop_val': 20}, content_hash)
+
+        def load_and_track(data):
+            well, stackpath, crop_val = data
+            return tr.track((well, stackpath if stream else tifffile.imread(stackpath), crop_val))
+
+        # Stacks are read by the workers themselves; the scheduler only needs their headers to budget memory.
+        keys = {}
+        jobs = []
+        for well, stackpath, crop_val in self.readin_stacks(stream=True):
+            keys[well] = cache.key(stackpath) if use_cache else None
+            if use_cache and cache.contains(well, keys[well]):
+                print(f'{exp_name}:: Automated Survival Analysis: {well} unchanged, using cached results')
+                # The ROIs were exported when the well was tracked; only a deleted export needs redoing.
+                if not os.path.exists(self.exporter.rois_path(well)):
+                    self.exporter.export_rois(well, cache.load(well, keys[well]), 20)
+                continue
+            jobs.append((well, (well, stackpath, crop_val), estimate_well_cost(stackpath, stream, frame_workers)))
+
+        processes = processes or max(1, (os.cpu_count() or 1) // frame_workers)
+        scheduler = WellScheduler(processes, memory_budget, retries)
+        # Without the cache, tracked wells are kept in memory until the results are written.
+        tracked = {}
+        for result in scheduler.run(load_and_track, jobs):
+            if result.error is not None:
+                print(f'{exp_name}:: Automated Survival Analysis: {result.well} failed after {result.attempts} attempt(s): {result.error!r}')
+                del keys[result.well]
+                continue
+            well, neurons = result.value
+            print(f'{exp_name}:: Automated Survival Analysis: {well} done in {result.seconds:.1f}s')
+            if use_cache:
+                cache.store(well, keys[well], neurons)
+            else:
+                tracked[well] = neurons
+            self.exporter.export_rois(well, neurons, 20)
 
-        def output(well, neurons, crop_val):
-            self.exporter.export(well, neurons, crop_val)
-        stacks_left = True
-        while stacks_left:
-            try: 
-                it = itertools.chain([next(gen)], itertools.islice(gen, 0, offset - 1))
-                for well, neurons in pool.imap_unordered(func=tr.track, iterable=it):
-                    output(well, neurons, 20)
-            except StopIteration:
-                stacks_left = False
+        # Rows are written once every well is in, in well order, so reruns produce the same file.
+        self.exporter.write_results(((well, tracked[well] if well in tracked else cache.load(well, keys[well]))
+                                     for well in sorted(keys)), 20)
 
         #run_cox_analysis(self.config, self.outdir)
         print('Done')
@@ -1,33 +1,137 @@
 import numpy as np
-import cv2
 
 class ROI(object):
-    def __init__(self, img, centroid, contour):
-        # Passing entire image? This is madness.
-        self.img = img
+    '''
+    Compact record of a contour and its statistics. Holds no reference to the image it was measured on.
+    Tracking doesn't build these: roi_stats.make_rois measures a frame's candidates in one batch into a RoiStore.
+    '''
+    __slots__ = ('centroid', 'contour', 'area', 'perimeter', 'mean', 'std', 'median', '_95thpercentile', 'min', 'max')
+
+    def __init__(self, centroid, contour, area, perimeter, mean, std, median, _95thpercentile, min, max):
         self.centroid = centroid
         self.contour = contour
-        #Delete image after computations are complete to preserve memory
-        #Future version can pass substantially reduced size (subimg) to reduce computation time
-        del self.img
+        self.area = area
+        self.perimeter = perimeter
+        self.mean = mean
+        self.std = std
+        self.median = median
+        self._95thpercentile = _95thpercentile
+        self.min = min
+        self.max = max
+
+ROI_FEATURES = ('area', 'perimeter', 'mean', 'std', 'median', '_95thpercentile', 'min', 'max')
+
+class RoiStore:
+    '''
+    Structure-of-arrays storage for ROIs: every contour's points in one int32 buffer indexed by offsets, centroids
+    in one array and each statistic in one float column. While tracking, the ROIs measured in each timepoint form one
+    store (see roi_stats.make_rois), and neurons hold StoredROI records into those. Once tracking is done,
+    compact_rois moves a well's ROIs into a single store, so that annotation and export read slices of a few arrays
+    rather than thousands of small objects.
+    '''
+    def __init__(self, rois=()):
+        rois = list(rois)
+        self._fill([r.centroid for r in rois], [r.contour for r in rois],
+                   {name: [getattr(r, name) for r in rois] for name in ROI_FEATURES})
+
+    @classmethod
+    def from_arrays(cls, centroids, contours, features):
+        '''Store of the ROIs with the given centroids and contours, and a column of each of ROI_FEATURES.'''
+        store = cls.__new__(cls)
+        store._fill(centroids, contours, features)
+        return store
+
+    def _fill(self, centroids, contours, features):
+        contours = [np.asarray(c, dtype=np.int32).reshape(-1, 2) for c in contours]
+        self.offsets = np.zeros(len(contours) + 1, dtype=np.int64)
+        np.cumsum([len(c) for c in contours], out=self.offsets[1:])
+        self.coords = np.concatenate(contours) if contours else np.empty((0, 2), dtype=np.int32)
+        self.centroids = np.array(centroids) if len(centroids) else np.empty((0, 2), dtype=np.int64)
+        self.features = {name: np.asarray(features[name], dtype=np.float64) for name in ROI_FEATURES}
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def contour(self, ix):
+        return self.coords[self.offsets[ix]:self.offsets[ix + 1]].reshape(-1, 1, 2)
+
+    def contours(self, start, stop, shift=0):
+        '''Contours of ROIs start to stop, as views into the buffer, or into a single shifted copy of that range.'''
+        block = self.coords[self.offsets[start]:self.offsets[stop]]
+        if shift:
+            block = block + shift
+        return np.split(block.reshape(-1, 1, 2), self.offsets[start + 1:stop] - self.offsets[start])
+
+def _feature(name):
+    return property(lambda self: float(self.store.features[name][self.ix]))
+
+class StoredROI:
+    '''Read-only view of one ROI of a RoiStore, with the same attributes as ROI. The only per-ROI Python object.'''
+    __slots__ = ('store', 'ix')
+
+    def __init__(self, store, ix):
+        self.store = store
+        self.ix = ix
 
     @property
     def contour(self):
-        return self._contour
-
-    @contour.setter
-    def contour(self, val):
-        self.area = cv2.contourArea(val)
-        self.perimeter = cv2.arcLength(val, True)
-        #Generate mask for computation purposes
-        mask = np.zeros(self.img.shape, np.uint8)
-        cv2.drawContours(mask, [val], 0, (255, 255, 255), -1)
-        nonzero_mask = (mask != 0)
-        self.mean, self.std = map(float, cv2.meanStdDev(self.img, mask=mask))
-        self.median = np.median(self.img[nonzero_mask])
-        self._95thpercentile = np.percentile(self.img[nonzero_mask], 95)
-        self.min, self.max, minloc, maxloc = cv2.minMaxLoc(self.img, mask=mask)
-        self._contour = val 
+        return self.store.contour(self.ix)
+
+    @property
+    def centroid(self):
+        return self.store.centroids[self.ix]
+
+    area = _feature('area')
+    perimeter = _feature('perimeter')
+    mean = _feature('mean')
+    std = _feature('std')
+    median = _feature('median')
+    _95thpercentile = _feature('_95thpercentile')
+    min = _feature('min')
+    max = _feature('max')
+
+class RoiSeries:
+    '''The consecutive ROIs start to stop of a RoiStore, standing in for a neuron's list of ROIs.'''
+    __slots__ = ('store', 'start', 'stop')
+
+    def __init__(self, store, start, stop):
+        self.store = store
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, ix):
+        if isinstance(ix, slice):
+            return [self[i] for i in range(*ix.indices(len(self)))]
+        if ix < 0:
+            ix += len(self)
+        if not 0 <= ix < len(self):
+            raise IndexError('ROI index out of range')
+        return StoredROI(self.store, self.start + ix)
+
+    def __iter__(self):
+        return (StoredROI(self.store, ix) for ix in range(self.start, self.stop))
+
+    def column(self, name):
+        return self.store.features[name][self.start:self.stop]
+
+    def contours(self, shift=0):
+        return self.store.contours(self.start, self.stop, shift)
+
+    def centroids(self, shift=0):
+        return list(self.store.centroids[self.start:self.stop] + shift)
+
+def compact_rois(neurons):
+    '''Move the ROIs of all neurons into one shared RoiStore. Neurons can't be extended afterwards.'''
+    store = RoiStore(roi for neuron in neurons for roi in neuron.roi_series)
+    start = 0
+    for neuron in neurons:
+        stop = start + len(neuron.roi_series)
+        neuron.roi_series = RoiSeries(store, start, stop)
+        start = stop
+    return store
 
 class Neuron(object):
     def __init__(self, ID, init_roi, last_tp=None, death_cause=None):
@@ -40,14 +144,27 @@ class Neuron(object):
         self.excluded_cause = None
         #self.make_verification_structure()
 
+    def contours(self, crop_val=0):
+        '''Contour of every timepoint, shifted by crop_val. Unshifted contours of compacted neurons are not copied.'''
+        if isinstance(self.roi_series, RoiSeries):
+            return self.roi_series.contours(crop_val)
+        return [r.contour + crop_val for r in self.roi_series]
+
     def roi_data_as_dict(self, crop_val):
         rs = self.roi_series
-        return {'areas' : [r.area for r in rs],
-                'centroids' : [r.centroid + crop_val for r in rs],
-                'contours' : [r.contour + crop_val for r in rs],
-                'CVs' : [(r.std / r.mean) if r.mean != 0 else 0 for r in rs],
-                'means' : [r.mean for r in rs],
-                'medians' : [r.median for r in rs],
-                'perimeters' : [r.perimeter for r in rs],
-                'stds' : [r.std for r in rs],
-                '95thpercentiles' : [r._95thpercentile for r in rs]}
+        if isinstance(rs, RoiSeries):
+            column = lambda name: rs.column(name).tolist()
+            centroids = rs.centroids(crop_val)
+        else:
+            column = lambda name: [getattr(r, name) for r in rs]
+            centroids = [r.centroid + crop_val for r in rs]
+        stds, means = column('std'), column('mean')
+        return {'areas' : column('area'),
+                'centroids' : centroids,
+                'contours' : self.contours(crop_val),
+                'CVs' : [(std / mean) if mean != 0 else 0 for std, mean in zip(stds, means)],
+                'means' : means,
+                'medians' : column('median'),
+                'perimeters' : column('perimeter'),
+                'stds' : stds,
+                '95thpercentiles' : column('_95thpercentile')}
@@ -1,13 +1,13 @@
-import cv2
 import numpy as np
-from scipy import optimize
 
 def comp_cent(contour):
+    import cv2
     mom = cv2.moments(contour)
     return np.array([mom['m10'] / mom['m00'], mom['m01'] / mom['m00']], dtype=np.uint32)
 
 def comp_lsq_circle(contour):
     '''Contour expected to be in OpenCV format'''
+    from scipy import optimize
     contour = contour[:, 0]
     x, y = contour[:, 0], contour[:, 1]
     centroid = comp_cent(contour)
@@ -18,7 +18,17 @@ def comp_lsq_circle(contour):
     mse = np.abs(np.mean((rr - r) ** 2))
     return float(mse)
 
+def fill_holes(img):
+    '''Same result as scipy.ndimage.binary_fill_holes, by flood filling the background from the border.'''
+    import cv2
+    padded = np.zeros((img.shape[0] + 2, img.shape[1] + 2), np.uint8)
+    padded[1:-1, 1:-1] = img != 0
+    mask = np.zeros((img.shape[0] + 4, img.shape[1] + 4), np.uint8)
+    cv2.floodFill(padded, mask, (0, 0), 2, flags=4)
+    return padded[1:-1, 1:-1] != 2
+
 def find_hulls(img):
+    import cv2
     img = np.copy(img)
     _, contours, _ = cv2.findContours(img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     hulls = [cv2.convexHull(contour) for contour in contours]
@@ -27,6 +37,7 @@ def find_hulls(img):
 #Do not appreciate fact that an empty list can sneak in to the tuple
 #Size threshold is not in use
 def find_hulls_with_inner_contours(img, size_threshold=50):
+   import cv2
    img = np.copy(img)
    hulls_inners = []
    _, contours, hierarchy = cv2.findContours(img, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
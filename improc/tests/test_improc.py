@@ -1,5 +1,620 @@
+import cv2
+import numpy as np
+import pytest
+
 from improc import __version__
+from improc.survival.roi_stats import measure_rois
 
 
 def test_version():
     assert __version__ == '0.1.0'
+
+
+def _circle_contour(shape, center, radius):
+    mask = np.zeros(shape, np.uint8)
+    cv2.circle(mask, center, radius, 255, -1)
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    return contours[0]
+
+
+def test_measure_rois_matches_full_frame_masks():
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 2**12, (200, 200)).astype(np.uint16)
+    contours = [_circle_contour(img.shape, (int(x), int(y)), int(r))
+                for x, y, r in zip(rng.integers(0, 200, 20), rng.integers(0, 200, 20), rng.integers(3, 25, 20))]
+
+    stats = measure_rois(img, contours)
+
+    for ix, contour in enumerate(contours):
+        mask = np.zeros(img.shape, np.uint8)
+        cv2.drawContours(mask, [contour], 0, 255, -1)
+        values = img[mask != 0]
+        assert np.isclose(stats['mean'][ix], values.mean())
+        assert np.isclose(stats['std'][ix], values.std())
+        assert np.isclose(stats['median'][ix], np.median(values))
+        assert np.isclose(stats['95thpercentile'][ix], np.percentile(values, 95))
+        assert stats['min'][ix] == values.min() and stats['max'][ix] == values.max()
+        assert stats['area'][ix] == cv2.contourArea(contour)
+
+
+def test_tracked_neurons_share_one_roi_store_per_timepoint(tmp_path):
+    import pickle
+    from improc.survival.checkpoint import checkpoint_path
+    from improc.survival.survival_analysis import Tracker
+    from improc.survival.types import StoredROI
+
+    # The checkpoint holds the neurons as tracking left them, before compact_rois.
+    tracker = Tracker('test', str(tmp_path), 1.0, 20, 'flo', '1x1', 10, 150, 50, 0.9, False, 'rat', checkpoint=True)
+    tracker.track(('A01', _blob_stack(n_frames=3), 20))
+    with open(checkpoint_path(str(tmp_path), 'A01'), 'rb') as f:
+        neurons = pickle.load(f).neurons
+    assert all(type(roi) is StoredROI for neuron in neurons for roi in neuron.roi_series)
+    for tp in range(3):
+        assert len({id(neuron.roi_series[tp].store) for neuron in neurons if len(neuron.roi_series) > tp}) == 1
+
+
+def test_global_match_is_one_to_one():
+    from improc.survival.assignment import greedy_match, global_match
+
+    neurons = [np.array([10, 10]), np.array([14, 10])]
+    candidates = [np.array([13, 10]), np.array([5, 10])]
+
+    # Both neurons are nearest to the first candidate, so greedy matching hands it to both.
+    assert greedy_match(neurons, candidates, len(candidates), 20) == {0: 0, 1: 0}
+    assert global_match(neurons, candidates, len(candidates), 20) == {0: 1, 1: 0}
+
+    # A neuron claimed by a previously unassigned ROI is left without a candidate.
+    assert global_match(neurons, candidates + [np.array([14, 11])], len(candidates), 20) == {0: 0}
+
+
+def _tracker(**kwargs):
+    from improc.survival.survival_analysis import Tracker
+    return Tracker('test', '.', 1.0, 20, 'flo', '1x1', 10, 150, 50, 0.9, False, 'rat', **kwargs)
+
+
+def _expand_slices_reference(tracker, img, slices):
+    '''The original pixel-painting implementation of Tracker._expand_slices.'''
+    expanded_slices = []
+    overlap_array = np.zeros(img.shape)
+    for s in slices:
+        overlap_array[s] = 1
+    y_MAX, x_MAX = img.shape
+    expand_slice = lambda s, px: (slice(max(0, s[0].start - px), min(y_MAX, s[0].stop + px)),
+                                  slice(max(0, s[1].start - px), min(x_MAX, s[1].stop + px)))
+    for s in slices:
+        overlap_array[s] = 0
+        px = tracker.um_to_px(10)
+        exp_s = expand_slice(s, px)
+        overlap_array[exp_s] += 1
+        while np.any(overlap_array[exp_s] >= 2):
+            overlap_array[exp_s] = 1
+            overlap_array[s] = 0
+            px -= 1
+            exp_s = expand_slice(s, px)
+            overlap_array[exp_s] += 1
+        expanded_slices.append(exp_s)
+    return expanded_slices
+
+
+def test_expand_slices_matches_reference():
+    from scipy import ndimage
+
+    tracker = _tracker()
+    rng = np.random.default_rng(0)
+    for n_blobs in [1, 5, 20, 60, 150]:
+        img = np.zeros((300, 400), np.uint16)
+        for y, x, r in zip(rng.integers(0, 300, n_blobs), rng.integers(0, 400, n_blobs), rng.integers(2, 15, n_blobs)):
+            cv2.circle(img, (int(x), int(y)), int(r), 1, -1)
+        # Slices as found by the tracker, plus arbitrary (overlapping, border-touching) boxes.
+        slices = ndimage.find_objects(ndimage.label(img)[0])
+        for y, x, h, w in zip(rng.integers(0, 300, n_blobs), rng.integers(0, 400, n_blobs),
+                              rng.integers(1, 40, n_blobs), rng.integers(1, 40, n_blobs)):
+            slices.append((slice(int(y), int(min(300, y + h))), slice(int(x), int(min(400, x + w)))))
+
+        assert tracker._expand_slices(img, slices) == _expand_slices_reference(tracker, img, slices)
+
+
+def test_fill_holes_matches_scipy():
+    import scipy.ndimage
+    from improc.survival.utils import fill_holes
+
+    rng = np.random.default_rng(0)
+    for density in (0.3, 0.5, 0.7):
+        img = rng.random((120, 90)) < density
+        assert (fill_holes(img) == scipy.ndimage.binary_fill_holes(img)).all()
+
+
+def test_split_slice_matches_scipy_binary_morphology():
+    import cv2
+    import scipy.ndimage
+    from improc.survival.survival_analysis import Tracker
+
+    rng = np.random.default_rng(0)
+    # Magnifications giving both odd and even kernel sizes.
+    for magnification in (10, 15, 20, 25):
+        tracker = Tracker('test', '.', 1.0, magnification, 'flo', '1x1', 10, 150, 50, 0.9, False, 'rat')
+        cross = scipy.ndimage.generate_binary_structure(2, 1)
+        for shape in ((120, 90), (9, 7)):
+            subimg = (rng.random(shape) * 2**16).astype(np.uint16)
+            subimg[rng.random(shape) < 0.5] = 0
+            # The scipy steps the OpenCV ones replaced.
+            expected = cv2.morphologyEx(subimg, cv2.MORPH_TOPHAT, kernel=tracker._square_kernel(40)) > 0
+            expected = scipy.ndimage.binary_dilation(expected, structure=cross)
+            expected = scipy.ndimage.binary_fill_holes(expected)
+            expected = scipy.ndimage.binary_erosion(expected, structure=tracker._square_kernel(3), iterations=3)
+            assert (tracker._split_slice(subimg) == expected).all()
+
+
+def _fail_once(path):
+    import os
+    if not os.path.exists(path):
+        open(path, 'w').close()
+        raise RuntimeError('first attempt')
+    return path
+
+
+def test_scheduler_retries_failed_wells(tmp_path):
+    from improc.survival.scheduler import WellScheduler
+
+    jobs = [(f'A0{ix}', str(tmp_path / f'A0{ix}'), 10) for ix in range(4)]
+    results = list(WellScheduler(processes=2, memory_budget=15, retries=1).run(_fail_once, jobs))
+
+    assert sorted(r.well for r in results) == ['A00', 'A01', 'A02', 'A03']
+    assert all(r.error is None and r.attempts == 2 for r in results)
+
+
+def _record_interval(arg):
+    import time
+    path, cost = arg
+    start = time.time()
+    time.sleep(0.2)
+    with open(path, 'w') as f:
+        f.write(f'{start} {time.time()} {cost}')
+
+
+def test_scheduler_respects_memory_budget(tmp_path):
+    from improc.survival.scheduler import WellScheduler
+
+    # With 3 workers and no budget, the first three wells alone would run at a cost of 25.
+    costs = {'A01': 10, 'A02': 10, 'A03': 5, 'A04': 5, 'A05': 20, 'A06': 5}
+    jobs = [(well, (str(tmp_path / well), cost), cost) for well, cost in costs.items()]
+    results = list(WellScheduler(processes=3, memory_budget=15).run(_record_interval, jobs))
+    assert all(r.error is None for r in results) and len(results) == len(costs)
+
+    intervals = {well: tuple(map(float, open(tmp_path / well).read().split()[:2])) for well in costs}
+    # Replay the intervals in time order, ends before starts at the same instant, tracking the cost of running wells.
+    events = sorted([(start, 1, well) for well, (start, _) in intervals.items()]
+                    + [(end, 0, well) for well, (_, end) in intervals.items()])
+    running, peak = set(), 0
+    for _, starting, well in events:
+        if starting:
+            running.add(well)
+            if 'A05' in running:
+                # A well over budget by itself runs alone.
+                assert running == {'A05'}
+            else:
+                peak = max(peak, sum(costs[w] for w in running))
+        else:
+            running.discard(well)
+    assert 0 < peak <= 15
+
+
+def _blob_stack(n_frames=4, size=300, n_blobs=8, seed=0):
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:size, :size]
+    centres = rng.uniform(50, size - 50, (n_blobs, 2))
+    stack = np.full((n_frames, size, size), 300.0)
+    for t in range(n_frames):
+        for cy, cx in centres + rng.normal(0, 1, centres.shape):
+            stack[t] += 4000 * np.exp(-((yy - cy) ** 2 + (xx - cx) ** 2) / (2 * 9 ** 2))
+    return stack.astype(np.uint16)
+
+
+def test_frame_workers_match_sequential_tracking():
+    stack = _blob_stack()
+    summarize = lambda neurons: [(n.ID, n.last_tp, [np.asarray(r.centroid).tolist() for r in n.roi_series]) for n in neurons]
+    _, sequential = _tracker().track(('A01', stack, 20))
+    _, threaded = _tracker(frame_workers=3).track(('A01', stack, 20))
+    assert sequential and summarize(sequential) == summarize(threaded)
+
+
+def test_tracking_streamed_from_stack_paths_matches_array_input(tmp_path):
+    import tifffile
+    from improc.survival.stacks import StackReader
+
+    summarize = lambda neurons: [(n.ID, n.last_tp, [np.asarray(r.centroid).tolist() for r in n.roi_series]) for n in neurons]
+    # Uncompressed stacks are memory-mapped. Compressed stacks are read a frame at a time, whether stored a page per
+    # frame or, as tifffile writes short stacks by default, as the sample planes of a single page.
+    for name, stack, kwargs in [('plain', _blob_stack(), {'photometric': 'minisblack'}),
+                                ('pages', _blob_stack(n_frames=5), {'compression': 'zlib'}),
+                                ('planes', _blob_stack(), {'compression': 'zlib', 'photometric': 'minisblack', 'planarconfig': 'separate'})]:
+        tifffile.imwrite(tmp_path / f'{name}.tif', stack, **kwargs)
+        with StackReader(str(tmp_path / f'{name}.tif')) as reader:
+            assert len(reader) == len(stack) and (reader[len(stack) - 1] == stack[-1]).all()
+            assert name == 'plain' or reader._array is None
+        _, expected = _tracker().track(('A01', stack, 20))
+        _, streamed = _tracker().track(('A01', str(tmp_path / f'{name}.tif'), 20))
+        assert expected and summarize(streamed) == summarize(expected), name
+
+
+def test_result_cache_keys_and_replaces_entries(tmp_path):
+    import os
+    from improc.survival.cache import ResultCache
+
+    stack = tmp_path / 'A01.tif'
+    stack.write_bytes(b'stack')
+    cache = ResultCache(str(tmp_path / 'cache'), {'assignment': 'greedy'})
+    key = cache.key(str(stack))
+    assert key == cache.key(str(stack))
+    assert key != ResultCache(str(tmp_path / 'cache'), {'assignment': 'global'}).key(str(stack))
+
+    cache.store('A01', key, ['neuron'])
+    assert cache.contains('A01', key) and cache.load('A01', key) == ['neuron']
+
+    stack.write_bytes(b'longer stack')
+    new_key = cache.key(str(stack))
+    assert new_key != key and not cache.contains('A01', new_key)
+    cache.store('A01', new_key, [])
+    assert os.listdir(tmp_path / 'cache') == [f'A01.{new_key}.p']
+
+
+def test_analyze_reuses_cached_wells_and_use_cache_false_bypasses_the_cache(tmp_path, monkeypatch, capsys):
+    import os
+    import tifffile
+    from common.utils import makeconfig
+    from improc.survival.survival_analysis import SurvivalAnalyzer
+
+    wells = ['A01', 'A02']
+    config = {'experiment': {'name': 'exp',
+                             'time_data': {'hours': ['0', '24', '48']},
+                             'imaging': {'microscope': 'flo', 'magnification': 20, 'binning': '1x1', 'fiddle': 1.0,
+                                         'primary_channel': 'RFP', 'wells': {well: {'label': 'ctrl'} for well in wells}},
+                             'well-data': {key: {well: 'NA' for well in wells} for key in
+                                           ['well-to-cell-type', 'well-to-drug', 'well-to-drug-conc', 'well-to-drug-conc-units']}}}
+    monkeypatch.setattr(makeconfig, 'mfile_to_config', lambda indir, outdir=None: config)
+    os.makedirs(tmp_path / 'processed_imgs' / 'stacked' / 'RFP')
+    for seed, well in enumerate(wells):
+        tifffile.imwrite(tmp_path / 'processed_imgs' / 'stacked' / 'RFP' / f'{well}.tif', _blob_stack(n_frames=3, seed=seed),
+                         photometric='minisblack')
+
+    csv = tmp_path / 'results' / 'exp_surv_data.csv'
+    rois = tmp_path / 'results' / 'rois' / 'A01.p'
+    analysis = tmp_path / 'analysis'
+    def analyze(**kwargs):
+        capsys.readouterr()
+        SurvivalAnalyzer(str(tmp_path), annotate=False).analyze(processes=1, **kwargs)
+        return capsys.readouterr().out, csv.read_bytes()
+    def cache_state():
+        return {path: os.stat(path).st_mtime_ns for directory in ('cache', 'checkpoints')
+                for path in (analysis / directory).glob('*')}
+
+    out, first = analyze()
+    assert out.count('done in') == 2 and len(first.splitlines()) > 1
+    exported = rois.read_bytes()
+    cached = cache_state()
+    assert len(cached) == 4
+
+    # Cached wells aren't tracked again, the csv is rewritten identically and deleted ROIs are exported again.
+    os.remove(rois)
+    out, second = analyze()
+    assert out.count('using cached results') == 2 and 'done in' not in out
+    assert second == first and rois.read_bytes() == exported and cache_state() == cached
+
+    # Without the cache every well is tracked again, and the cache is left as it was.
+    out, third = analyze(use_cache=False)
+    assert out.count('done in') == 2 and 'using cached results' not in out
+    assert third == first and cache_state() == cached
+
+
+def test_checkpointed_tracking_matches_full_stack(tmp_path):
+    from improc.survival.survival_analysis import Tracker
+
+    stack = _blob_stack(n_frames=5)
+    summarize = lambda neurons: [(n.ID, n.last_tp, [np.asarray(r.centroid).tolist() for r in n.roi_series]) for n in neurons]
+    _, full = _tracker().track(('A01', stack, 20))
+    for n_frames in (2, 3, 5):
+        tracker = Tracker('test', str(tmp_path), 1.0, 20, 'flo', '1x1', 10, 150, 50, 0.9, False, 'rat', checkpoint=True)
+        _, incremental = tracker.track(('A01', stack[:n_frames], 20))
+    assert summarize(full) == summarize(incremental)
+
+
+def test_columnar_output_matches_csv(tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    from improc.survival.output import Exporter
+
+    wells = ['A01', 'A02']
+    config = {'experiment': {'name': 'exp',
+                             'time_data': {'hours': ['0', '24', '48']},
+                             'imaging': {'wells': {well: {'label': 'ctrl'} for well in wells}},
+                             'well-data': {key: {well: 'NA' for well in wells} for key in
+                                           ['well-to-cell-type', 'well-to-drug', 'well-to-drug-conc', 'well-to-drug-conc-units']}}}
+    _, neurons = _tracker().track(('A01', _blob_stack(n_frames=3), 20))
+
+    exporter = Exporter(config, columnar=True)
+    exporter.prep_csv_file(str(tmp_path), 'exp_surv_data.csv')
+    exporter.write_results([('A01', neurons), ('A02', neurons[:2])], 20)
+
+    csv_rows = (tmp_path / 'exp_surv_data.csv').read_text().splitlines()[1:]
+    survival = pq.ParquetFile(tmp_path / 'exp_surv_data.parquet')
+    assert survival.metadata.num_row_groups == 2
+    assert survival.read(columns=['well-id']).column(0).to_pylist() == [row.split(',')[2] for row in csv_rows]
+    rois = pq.read_table(tmp_path / 'exp_roi_data.parquet')
+    assert rois.num_rows == sum(len(n.roi_series) for n in neurons + neurons[:2])
+
+
+def test_compacted_neurons_export_the_same_roi_data():
+    import copy
+    from improc.survival.types import compact_rois
+
+    _, neurons = _tracker().track(('A01', _blob_stack(n_frames=3), 20))
+    expanded = copy.deepcopy(neurons)
+    for neuron in expanded:
+        neuron.roi_series = list(neuron.roi_series)
+    compact_rois(neurons)
+
+    for compacted, listed in zip(neurons, expanded):
+        a, b = compacted.roi_data_as_dict(20), listed.roi_data_as_dict(20)
+        assert a.keys() == b.keys()
+        for key in a:
+            assert all(np.array_equal(x, y) for x, y in zip(a[key], b[key])) and len(a[key]) == len(b[key])
+
+
+def test_out_of_core_stitching_matches_stitch(tmp_path, monkeypatch):
+    import collections
+    import tifffile
+    from improc import stitching
+    from improc.stitching import _downsample, stitch, stitch_to_tiff, stitch_to_memmap
+
+    rng = np.random.default_rng(0)
+    images = [rng.integers(0, 2**16, (90, 110)).astype(np.uint16) for _ in range(9)]
+    paths = []
+    for ix, image in enumerate(images):
+        paths.append(str(tmp_path / f'{ix}.tif'))
+        tifffile.imwrite(paths[-1], image)
+
+    for microscope in ('flo', 'ixm'):
+        expected = stitch(microscope, images)
+        loads = collections.Counter()
+        load = stitching._load
+        monkeypatch.setattr(stitching, '_load', lambda image: loads.update([image]) or load(image))
+        stitch_to_tiff(microscope, paths, tmp_path / 'mosaic.tif', tile=(32, 48), levels=2)
+        monkeypatch.undo()
+        # Every level is built in the same pass, so each tile is read once.
+        assert sorted(loads) == sorted(paths) and set(loads.values()) == {1}
+        with tifffile.TiffFile(tmp_path / 'mosaic.tif') as tif:
+            assert (tif.pages[0].asarray() == expected).all()
+            levels = [level.asarray() for level in tif.series[0].levels]
+        assert (levels[1] == _downsample(expected, 2)).all() and (levels[2] == _downsample(levels[1], 2)).all()
+        assert (stitch_to_memmap(microscope, paths, tmp_path / 'mosaic_mm.tif', rows_per_block=40) == expected).all()
+
+
+def test_mosaic_keeps_only_the_tiles_overlapping_the_current_band(tmp_path):
+    import tifffile
+    from improc.stitching import Mosaic, stitch
+
+    rng = np.random.default_rng(0)
+    images = [rng.integers(0, 2**16, (90, 110)).astype(np.uint16) for _ in range(16)]
+    paths = []
+    for ix, image in enumerate(images):
+        paths.append(str(tmp_path / f'{ix}.tif'))
+        tifffile.imwrite(paths[-1], image)
+
+    mosaic = Mosaic('flo', paths, blend='linear')
+    rows = mosaic.tile_shape[0]
+    bands, held = [], []
+    def on_band(band):
+        y0 = sum(len(b) for b in bands)
+        overlapping = {k for k, (row, _) in zip(mosaic.order, mosaic._whole_tiles()) if row < y0 + len(band) and y0 < row + rows}
+        assert set(mosaic.tiles._cache) == overlapping
+        bands.append(band)
+        held.append(len(overlapping))
+    list(mosaic.iter_tiles((30, 64), on_band))
+    assert (np.concatenate(bands) == stitch('flo', images, blend='linear')).all()
+    # Bands within a row of tiles hold 4 of the 16 tiles, and those across a seam 8.
+    assert set(held) == {4, 8}
+
+
+def test_stitch_crops_overlap_from_all_but_first_row_and_column():
+    from improc.stitching import stitch
+
+    images = [np.full((100, 123), ix, np.uint16) for ix in range(9)]
+    stitched = stitch('ixm', images)
+    # ixm mosaics are rotated by 90 degrees; 10% of 100 and of 123 is cropped from every later row and column.
+    assert stitched.shape == (123 + 2 * (123 - 12), 100 + 2 * (100 - 10))
+
+
+def test_registration_recovers_jittered_tiles(tmp_path):
+    from scipy import ndimage
+    from common.utils import get_layout_indexing
+    from improc.stitching import registered_positions, stitch
+
+    rng = np.random.default_rng(0)
+    world = ndimage.gaussian_filter(rng.normal(size=(900, 900)), 3)
+    world = ((world - world.min()) / np.ptp(world) * 60000).astype(np.uint16)
+    step_y, step_x = 256 - 25, 300 - 30
+    true = np.array([(i * step_y, j * step_x) for i in range(3) for j in range(3)]) + 20 + rng.integers(-5, 6, (9, 2))
+    true -= true.min(axis=0)
+    images = [None] * 9
+    for pos, k in enumerate(get_layout_indexing('flo', 3).reshape(-1)):
+        y, x = true[pos] + 10
+        images[k] = world[y:y + 256, x:x + 300]
+
+    path = str(tmp_path / 'A01.npy')
+    positions = registered_positions(path, 'flo', images)
+    assert (positions == true).all()
+    # Later timepoints reuse the stored positions, whatever their content.
+    assert (registered_positions(path, 'flo', [np.zeros_like(image) for image in images]) == true).all()
+
+    stitched = stitch('flo', images, positions=positions)
+    covered = np.zeros(stitched.shape, bool)
+    for y, x in positions:
+        covered[y:y + 256, x:x + 300] = True
+    assert (stitched == world[10:10 + stitched.shape[0], 10:10 + stitched.shape[1]])[covered].all()
+
+
+def test_linear_blending_feathers_seams():
+    from improc.stitching import stitch
+
+    images = [np.full((100, 120), 1000 * (ix + 1), np.uint16) for ix in range(4)]
+    hard, blended = stitch('flo', images), stitch('flo', images, blend='linear')
+    assert hard.shape == blended.shape
+    # Tiles only meet in the overlap, so identical tiles blend to themselves and single tiles are left alone.
+    assert (stitch('flo', [images[0]] * 4, blend='linear') == 1000).all()
+    assert blended[0, 0] == hard[0, 0] and blended[-1, -1] == hard[-1, -1]
+    # Across a seam, values step gradually rather than jumping from one tile to the next.
+    row = blended[50].astype(int)
+    assert np.abs(np.diff(row)).max() < np.abs(np.diff(hard[50].astype(int))).max()
+    assert (np.diff(row) * np.sign(row[-1] - row[0]) >= 0).all()
+
+
+def test_blockwise_background_matches_full_stack(tmp_path):
+    import tifffile
+    from improc.flatfield import background_from_paths
+
+    rng = np.random.default_rng(0)
+    images = rng.integers(0, 2**16, (9, 60, 50)).astype(np.uint16)
+    paths = []
+    for ix, image in enumerate(images):
+        paths.append(str(tmp_path / f'{ix}.tif'))
+        # Compressed images can't be memory-mapped and are spilled to a temporary file instead.
+        tifffile.imwrite(paths[-1], image, compression='zlib' if ix % 2 else None)
+
+    # A limit this small leaves room for just a few rows at a time.
+    median = background_from_paths(paths, memory_limit=20000)
+    assert (median == np.median(images, axis=0).astype(np.uint16)).all()
+    low = background_from_paths(paths, method='percentile', percentile=10, memory_limit=20000)
+    assert (low == np.percentile(images, 10, axis=0).astype(np.uint16)).all()
+
+
+def test_subtract_background_in_place_saturates():
+    from improc.flatfield import subtract_background, trunc_sub
+
+    rng = np.random.default_rng(0)
+    stack = rng.integers(0, 2**16, (3, 40, 30)).astype(np.uint16)
+    background = rng.integers(0, 2**15, (40, 30)).astype(np.uint16)
+    expected = np.stack([trunc_sub(img, background) for img in stack])
+
+    tiles = [img.copy() for img in stack]
+    assert subtract_background(stack, background) is stack and (stack == expected).all()
+    assert all((tile == img).all() for tile, img in zip(subtract_background(tiles, background), expected))
+
+    flat = rng.uniform(0.5, 2, (40, 30))
+    corrected = subtract_background(stack.copy(), np.zeros_like(background), flat)
+    assert np.abs(corrected - np.clip(np.rint(stack * (flat.mean() / flat)), 0, 2**16 - 1)).max() <= 1
+
+
+def test_pipelined_subtract_matches_serial_and_skips_up_to_date(tmp_path, capsys):
+    import os
+    from PIL import Image
+    from improc.flatfield_cli import subtract
+
+    rng = np.random.default_rng(0)
+    os.makedirs(tmp_path / 'in' / 'A01')
+    for ix in range(6):
+        Image.fromarray(rng.integers(0, 2**16, (30, 40)).astype(np.uint16)).save(tmp_path / 'in' / 'A01' / f'{ix}.tif')
+    Image.fromarray(rng.integers(0, 2**15, (30, 40)).astype(np.uint16)).save(tmp_path / 'bg.tif')
+
+    subtract(tmp_path / 'bg.tif', tmp_path / 'in', tmp_path / 'serial', 'tif')
+    subtract(tmp_path / 'bg.tif', tmp_path / 'in', tmp_path / 'pipelined', 'tif', jobs=3)
+    for ix in range(6):
+        serial = np.array(Image.open(tmp_path / 'serial' / 'A01' / f'{ix}.tif'))
+        assert (serial == np.array(Image.open(tmp_path / 'pipelined' / 'A01' / f'{ix}.tif'))).all()
+
+    capsys.readouterr()
+    subtract(tmp_path / 'bg.tif', tmp_path / 'in', tmp_path / 'pipelined', 'tif', jobs=3)
+    assert 'skipping 6 images already up to date' in capsys.readouterr().out
+
+
+def test_pipelined_subtract_reports_failed_images_and_writes_the_rest(tmp_path, capsys):
+    import os
+    from PIL import Image
+    from improc.flatfield_cli import subtract
+
+    rng = np.random.default_rng(0)
+    os.makedirs(tmp_path / 'in' / 'A01')
+    for ix in range(6):
+        # One tile doesn't match the background's shape, so subtracting it raises.
+        shape = (20, 40) if ix == 2 else (30, 40)
+        Image.fromarray(rng.integers(0, 2**16, shape).astype(np.uint16)).save(tmp_path / 'in' / 'A01' / f'{ix}.tif')
+    Image.fromarray(rng.integers(0, 2**15, (30, 40)).astype(np.uint16)).save(tmp_path / 'bg.tif')
+
+    subtract(tmp_path / 'bg.tif', tmp_path / 'in', tmp_path / 'out', 'tif', jobs=2)
+    assert sorted(os.listdir(tmp_path / 'out' / 'A01')) == [f'{ix}.tif' for ix in (0, 1, 3, 4, 5)]
+    out = capsys.readouterr().out
+    assert 'subtracted 5 images' in out and 'failed' in out and '2.tif' in out
+
+
+def test_pipeline_stacks_flatfielded_mosaics(tmp_path):
+    import os
+    import tifffile
+    from PIL import Image
+    from common import Exposure, MFSpec, WellSpec
+    from improc.flatfield import subtract_background
+    from improc.pipeline import process_experiment
+    from improc.stitching import stitch
+
+    rng = np.random.default_rng(0)
+    tiles = {}
+    # Timepoints listed out of order, so that grouping can't rely on the order of the file system.
+    for t in (2, 1, 3):
+        os.makedirs(tmp_path / 'raw_imgs' / 'RFP' / f'T{t}' / 'col_01')
+        for ix in range(1, 5):
+            tiles[t, ix] = rng.integers(100, 2**16, (40, 50)).astype(np.uint16)
+            Image.fromarray(tiles[t, ix]).save(tmp_path / 'raw_imgs' / 'RFP' / f'T{t}' / 'col_01' / f'A01_{ix:02}.tif')
+    spec = MFSpec('exp', None, '20x', 'flo', '1', 2, 0.1, [WellSpec('A01', [Exposure('RFP', 100)])])
+
+    stacks = process_experiment(tmp_path, spec, processes=1)
+
+    assert stacks == [tmp_path / 'processed_imgs' / 'stacked' / 'RFP' / 'A01.tif']
+    stack = tifffile.imread(stacks[0])
+    background = np.median(np.array(list(tiles.values())), axis=0).astype(np.uint16)
+    for t in (1, 2, 3):
+        expected = stitch('flo', subtract_background([tiles[t, ix].copy() for ix in range(1, 5)], background))
+        assert (stack[t - 1] == expected).all()
+    assert not os.path.exists(tmp_path / 'processed_imgs' / 'stitched')
+
+
+def test_pipeline_reports_failed_wells_and_stacks_the_rest(tmp_path, capsys):
+    import os
+    import tifffile
+    from PIL import Image
+    from common import Exposure, MFSpec, WellSpec
+    from improc.pipeline import process_experiment
+
+    rng = np.random.default_rng(0)
+    wells = ['A01', 'A02', 'A03', 'A04']
+    for t in (1, 2, 3):
+        os.makedirs(tmp_path / 'raw_imgs' / 'RFP' / f'T{t}' / 'col_01')
+        for well in wells:
+            for ix in range(1, 5):
+                path = tmp_path / 'raw_imgs' / 'RFP' / f'T{t}' / 'col_01' / f'{well}_{ix:02}.tif'
+                if well == 'A02' and t == 2 and ix == 3 or well == 'A03' and t == 3:
+                    # A02 is missing a tile of T2, A03 all of T3.
+                    continue
+                if well == 'A04' and t == 2 and ix == 1:
+                    # A04's T1 is stacked before its unreadable tile is reached.
+                    path.write_bytes(b'not a tiff')
+                    continue
+                Image.fromarray(rng.integers(100, 2**16, (40, 50)).astype(np.uint16)).save(path)
+    spec = MFSpec('exp', None, '20x', 'flo', '1', 2, 0.1, [WellSpec(well, [Exposure('RFP', 100)]) for well in wells])
+
+    # With this seed, the background sample doesn't include the unreadable tile.
+    stacks = process_experiment(tmp_path, spec, processes=1, sample_size=10, seed=0)
+
+    stacked = tmp_path / 'processed_imgs' / 'stacked' / 'RFP'
+    assert stacks == [stacked / 'A01.tif'] and tifffile.imread(stacks[0]).shape[0] == 3
+    assert os.listdir(stacked) == ['A01.tif']
+    out = capsys.readouterr().out
+    assert 'A02 failed' in out and 'T2: 3 tiles, expected a 2x2 montage' in out
+    assert 'A03 failed' in out and 'missing timepoint(s) T3' in out
+    assert 'A04 failed' in out
+
+
+def test_clis_defer_heavy_imports():
+    import subprocess
+    import sys
+    from improc import flatfield, flatfield_cli
+
+    assert flatfield_cli.BACKGROUND_METHODS == flatfield.BACKGROUND_METHODS
+    check = 'import sys, improc.flatfield_cli, improc.pipeline_cli; sys.exit("numpy" in sys.modules)'
+    assert subprocess.run([sys.executable, '-c', check]).returncode == 0
@@ -8,8 +8,6 @@ import os
 
 from glob import glob
 
-from . import core
-
 def check_targets(data_loc, masa_name, exp_name):
     masa_path = os.path.join(data_loc, masa_name)
     data_path = os.path.join(masa_path, "data", "stacks")
@@ -57,6 +55,8 @@ def down_handler(args):
     subprocess.run(["pkill", "-f", "server.py"])
 
 def deploy_handler(args):
+    # core loads scikit-image, which only deploying needs.
+    from . import core
     try:
         masa_idx = args.masa_idx
         path = args.path
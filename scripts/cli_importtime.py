@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+'''
+Startup cost of every lab_tools CLI, measured with `python -X importtime` on `--help`, which should import
+next to nothing. Run from anywhere; the packages are taken from this checkout.
+
+    $ python scripts/cli_importtime.py [--top N]
+'''
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGES = ['annotation', 'bart', 'common', 'improc', 'masa']
+
+# (command name, module run with -m)
+CLIS = [
+    ('anno', 'annotation'),
+    ('art', 'bart'),
+    ('masa', 'masa'),
+    ('flatfield', 'improc.flatfield_cli'),
+    ('improc-pipeline', 'improc.pipeline_cli'),
+]
+
+def importtime(module):
+    '''Wall time of `python -m module --help`, and the cumulative import time (us) of each top-level import.'''
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.join(ROOT, package) for package in PACKAGES]
+                                                       + [os.environ.get('PYTHONPATH', '')]))
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-m', module, '--help'],
+                            env=env, capture_output=True, text=True)
+    wall = time.perf_counter() - start
+
+    imports = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Nested imports are indented; only top-level ones add up to the total.
+        if not name[1:].startswith(' '):
+            imports[name.strip()] = int(cumulative)
+    return wall, imports, result.returncode
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--top', type=int, default=3, help='number of heaviest imports to list per CLI')
+    args = parser.parse_args()
+
+    print(f"{'cli':>16} {'wall ms':>8} {'import ms':>10}  heaviest imports")
+    for name, module in CLIS:
+        wall, imports, returncode = importtime(module)
+        heaviest = sorted(imports.items(), key=lambda item: -item[1])[:args.top]
+        status = '' if returncode == 0 else f' (exit {returncode})'
+        print(f"{name:>16} {wall * 1e3:>8.0f} {sum(imports.values()) / 1e3:>10.0f}  "
+              + ', '.join(f'{package} {us / 1e3:.0f}' for package, us in heaviest) + status)
+
+if __name__ == '__main__':
+    main()